@@ -26,6 +26,9 @@ static const uint8_t manufacturer_data[] = {
     'v', VERSION_MAJOR, VERSION_MINOR, VERSION_PATCH
 };
 
+// Indoor Positioning Service data. After the UUID, the 7-byte payload is
+// big-endian uint16 building, uint8 floor, float16 north, float16 east.
+// The handheld decodes this layout in handheld/payload.py; keep them in sync.
 static uint8_t service_data[] = {
     // Use Indoor Positioning Service Shorthand UUID
     0x21, 0x18, // 16-bit shorthand UUID (little endian)
@@ -1,10 +1,18 @@
 import os
 import sys
+import json
+import math
+import time
 import datetime
 from hmac import compare_digest as safe_str_cmp
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import insert, select, func, text, tuple_, inspect
+
+from token_cache import TokenCache
+from live_cache import LiveCache
+from telemetry_codec import MIMETYPE as BINARY_MIMETYPE, decode_positions
 
 # ------------------------------------------------------
 # Environment / runtime checks
@@ -35,6 +43,14 @@ except Exception as e:
 # ------------------------------------------------------
 JWT_SECRET = os.getenv("JWT_SECRET", "change-me-in-prod")
 REGISTRATION_SECRET = os.getenv("REGISTRATION_SECRET", "change-me-in-prod")
+# Bearer credential for dashboards and operators reading other devices'
+# positions. Unset disables it: a device token can only read its own track.
+VIEWER_SECRET = os.getenv("VIEWER_SECRET", "")
+
+# Verified-token cache sizing. TTL also bounds how long a revoked token may
+# still be accepted by other worker processes.
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))
 
 # ------------------------------------------------------
 # Convert Azure PostgreSQL connection string → SQLAlchemy URL
@@ -73,7 +89,12 @@ for key, val in os.environ.items():
         raw_azure_conn = val
         break
 
-if not raw_azure_conn:
+if raw_azure_conn:
+    DB_URL = convert_azure_pg_connstr(raw_azure_conn)
+elif os.getenv("DATABASE_URL"):
+    # Local development / benchmarks, e.g. sqlite:///positions.db
+    DB_URL = os.getenv("DATABASE_URL")
+else:
     # Do not raise at import time; put an informative message in logs instead
     print(
         "ERROR: No Azure PostgreSQL connection string found. "
@@ -81,15 +102,37 @@ if not raw_azure_conn:
         flush=True,
     )
     DB_URL = None
-else:
-    DB_URL = convert_azure_pg_connstr(raw_azure_conn)
 
 # ------------------------------------------------------
 # Flask + DB
 # ------------------------------------------------------
+# Connection pool sizing (per worker process). pool_pre_ping replaces
+# connections the server dropped while idle (e.g. Azure's idle timeout)
+# instead of failing the next request with them.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+
+def engine_options(url: str) -> dict:
+    """SQLAlchemy engine options shared by the WSGI and ASGI apps."""
+    if not url or url.startswith("sqlite"):
+        # SQLite stand-ins use SQLAlchemy's default pool for the driver
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+
 app = Flask(__name__)
 if DB_URL:
     app.config["SQLALCHEMY_DATABASE_URI"] = DB_URL
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(DB_URL)
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
 db = SQLAlchemy(app)
@@ -107,19 +150,220 @@ class ActiveJWT(db.Model):
 
 class Position(db.Model):
     __tablename__ = "positions"
-    id = db.Column(db.BigInteger, primary_key=True)
+    # SQLite only autoincrements INTEGER primary keys (local stand-in databases)
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
     device_id = db.Column(db.String(255), nullable=False)
     building_id = db.Column(db.Integer, nullable=False)
     floor = db.Column(db.Integer, nullable=False)
     loc_east = db.Column(db.Integer, nullable=False)
     loc_north = db.Column(db.Integer, nullable=False)
-    created_at = db.Column(db.DateTime, default=db.func.now())
+    # Stamped by the app (UTC, like the query windows) rather than the server,
+    # so keyset cursors round-trip exactly on every backend
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    # When the handheld took the fix (UTC), if it sent a timestamp. Batched
+    # uploads share nearly one created_at, so motion models use this instead.
+    recorded_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        # "Where was device X between t1 and t2"
+        db.Index("ix_positions_device_time", "device_id", "created_at"),
+        # "Who is on floor N of building B now"
+        db.Index("ix_positions_floor_time", "building_id", "floor", "created_at"),
+    )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "device_id": self.device_id,
+            "building_id": self.building_id,
+            "floor": self.floor,
+            "loc_east": self.loc_east,
+            "loc_north": self.loc_north,
+            "created_at": self.created_at.isoformat(),
+            "recorded_at": self.recorded_at.isoformat() if self.recorded_at else None,
+        }
+
+
+class SmoothedPosition(db.Model):
+    """
+    Cleaned track written by smooth_tracks.py: one row per source position,
+    smoothed with the whole track around it. Outliers keep their row with
+    the smoothed position in place of the rejected fix.
+    """
+    __tablename__ = "smoothed_positions"
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    # Source row in positions (not a foreign key: its primary key is (id, created_at))
+    position_id = db.Column(db.BigInteger, nullable=False)
+    device_id = db.Column(db.String(255), nullable=False)
+    building_id = db.Column(db.Integer, nullable=False)
+    floor = db.Column(db.Integer, nullable=False)
+    loc_east = db.Column(db.Integer, nullable=False)
+    loc_north = db.Column(db.Integer, nullable=False)
+    # The source row's created_at, and the fix time the smoother used
+    created_at = db.Column(db.DateTime, nullable=False)
+    recorded_at = db.Column(db.DateTime, nullable=False)
+    outlier = db.Column(db.Boolean, nullable=False, default=False)
+
+    __table_args__ = (
+        db.Index("ix_smoothed_positions_device_time", "device_id", "created_at"),
+    )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "position_id": self.position_id,
+            "device_id": self.device_id,
+            "building_id": self.building_id,
+            "floor": self.floor,
+            "loc_east": self.loc_east,
+            "loc_north": self.loc_north,
+            "created_at": self.created_at.isoformat(),
+            "recorded_at": self.recorded_at.isoformat(),
+            "outlier": self.outlier,
+        }
+
+
+class DeviceLatest(db.Model):
+    """Most recent position of each device, upserted on every write."""
+    __tablename__ = "device_latest"
+    device_id = db.Column(db.String(255), primary_key=True)
+    building_id = db.Column(db.Integer, nullable=False)
+    floor = db.Column(db.Integer, nullable=False)
+    loc_east = db.Column(db.Integer, nullable=False)
+    loc_north = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    __table_args__ = (
+        db.Index("ix_device_latest_floor", "building_id", "floor"),
+    )
+
+    def to_record(self):
+        return {
+            "device_id": self.device_id,
+            "building_id": self.building_id,
+            "floor": self.floor,
+            "loc_east": self.loc_east,
+            "loc_north": self.loc_north,
+            "updated_at": self.updated_at,
+        }
 
 
 # ------------------------------------------------------
-# Create tables on first request (safe, non-fatal)
+# Daily partitioning of positions (PostgreSQL only)
 # ------------------------------------------------------
-@app.before_first_request
+# On PostgreSQL, positions is a table partitioned by RANGE (created_at) with
+# one partition per day, so time-bounded queries only touch the days they
+# cover and old days can be detached or dropped cheaply. Indexes created on
+# the parent are propagated to every partition. Other databases (e.g. a
+# local SQLite stand-in) get the plain table with the same indexes.
+PARTITION_DAYS_AHEAD = int(os.getenv("PARTITION_DAYS_AHEAD", "7"))
+
+PARTITIONED_POSITIONS_DDL = """
+CREATE TABLE IF NOT EXISTS positions (
+    id BIGSERIAL,
+    device_id VARCHAR(255) NOT NULL,
+    building_id INTEGER NOT NULL,
+    floor INTEGER NOT NULL,
+    loc_east INTEGER NOT NULL,
+    loc_north INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT now(),
+    recorded_at TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at)
+"""
+
+_partitions_ensured_through = None
+
+
+def is_postgresql() -> bool:
+    return bool(DB_URL) and DB_URL.startswith("postgresql")
+
+
+def partition_name(day: datetime.date) -> str:
+    return "positions_%s" % day.strftime("%Y%m%d")
+
+
+def create_partitioned_positions(conn):
+    """
+    Create positions as a partitioned table, plus a DEFAULT partition so
+    rows outside the pre-created days are never rejected.
+    Must run before create_all, which then leaves the table alone.
+    """
+    existing = conn.execute(text(
+        "SELECT c.relkind FROM pg_class c WHERE c.relname = 'positions' "
+        "AND pg_table_is_visible(c.oid)"
+    )).scalar()
+    if existing == "r":
+        print(
+            "WARNING: positions exists as an unpartitioned table; "
+            "migrate it manually to enable daily partitions.",
+            flush=True,
+        )
+        return False
+
+    conn.execute(text(PARTITIONED_POSITIONS_DDL))
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS positions_default PARTITION OF positions DEFAULT"
+    ))
+    return True
+
+
+def ensure_partitions(conn, days_ahead: int = PARTITION_DAYS_AHEAD):
+    """Create daily partitions from today through today + days_ahead."""
+    global _partitions_ensured_through
+    today = datetime.datetime.utcnow().date()
+    if _partitions_ensured_through and _partitions_ensured_through >= today + datetime.timedelta(days=days_ahead):
+        return
+
+    for offset in range(days_ahead + 1):
+        day = today + datetime.timedelta(days=offset)
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS %s PARTITION OF positions "
+            "FOR VALUES FROM ('%s') TO ('%s')"
+            % (partition_name(day), day.isoformat(), (day + datetime.timedelta(days=1)).isoformat())
+        ))
+    _partitions_ensured_through = today + datetime.timedelta(days=days_ahead)
+
+
+def partitions_due() -> bool:
+    """True once a day, when the next days' partitions should be created."""
+    today = datetime.datetime.utcnow().date()
+    return _partitions_ensured_through is None or _partitions_ensured_through < today + datetime.timedelta(days=1)
+
+
+def maintain_partitions():
+    """
+    Cheap check on the write path: creates the next days' partitions once per
+    day so rows land in a daily partition rather than the default one.
+    """
+    if is_postgresql() and partitions_due():
+        try:
+            with db.engine.begin() as conn:
+                ensure_partitions(conn)
+        except Exception as exc:
+            print("PARTITION MAINTENANCE ERROR: %s" % (exc,), flush=True)
+
+
+# ------------------------------------------------------
+# Schema setup at startup (safe, non-fatal)
+# ------------------------------------------------------
+# Runs once before serving rather than during the first user request:
+#   - gunicorn: on_starting hook in gunicorn.conf.py (used by Azure App Service)
+#   - ASGI:     before_serving hook in asgi.py
+#   - manually: flask --app app init-db
+def setup_schema(conn):
+    """Create/verify every table and index on a synchronous Connection."""
+    if conn.dialect.name == "postgresql" and create_partitioned_positions(conn):
+        ensure_partitions(conn)
+    db.metadata.create_all(conn)
+    # create_all skips tables that already exist, so add any missing columns and indexes
+    columns = {column["name"] for column in inspect(conn).get_columns("positions")}
+    if "recorded_at" not in columns:
+        conn.execute(text("ALTER TABLE positions ADD COLUMN recorded_at TIMESTAMP"))
+    for index in Position.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
 def init_database():
     if not DB_URL:
         print(
@@ -128,13 +372,20 @@ def init_database():
         return
 
     try:
-        db.create_all()
+        with db.engine.begin() as conn:
+            setup_schema(conn)
         print("Database tables created/verified.", flush=True)
     except Exception as exc:
         # Do not raise — log for Azure diagnostics
         print("DATABASE INITIALIZATION ERROR: %s" % (exc,), flush=True)
 
 
+@app.cli.command("init-db")
+def init_db_command():
+    """Create/verify the database schema."""
+    init_database()
+
+
 # ------------------------------------------------------
 # JWT helpers (use lazy checks)
 # ------------------------------------------------------
@@ -163,9 +414,428 @@ def verify_jwt(token: str):
         return None
 
 
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+
+def verify_device_token(token: str):
+    """
+    Return the device_id for a valid, unrevoked token, or None.
+    Cache hits skip both the JWT decode and the active_jwts lookup.
+    """
+    device_id = token_cache.get(token)
+    if device_id:
+        return device_id
+
+    payload = verify_jwt(token)
+    if not payload or not payload.get("device_id"):
+        return None
+
+    # Only tokens still present in active_jwts are accepted
+    active = ActiveJWT.query.filter_by(token=token).first()
+    if active is None:
+        return None
+
+    token_cache.put(token, active.device_id)
+    return active.device_id
+
+
+# ------------------------------------------------------
+# Latest position per device (device_latest + in-process cache)
+# ------------------------------------------------------
+# Each worker keeps live_cache current from its own writes, and pulls rows
+# written by other workers from device_latest at most this often.
+LIVE_CACHE_REFRESH = float(os.getenv("LIVE_CACHE_REFRESH", "2"))
+# Refreshes re-read this far behind the newest row seen, so rows committed
+# late by another worker (with an older updated_at) are not skipped
+LIVE_CACHE_OVERLAP = datetime.timedelta(seconds=5)
+
+live_cache = LiveCache()
+_live_cache_refreshed = 0.0
+_live_cache_watermark = None
+
+
+def latest_records(rows):
+    """Reduce position rows to one device_latest record per device (last wins)."""
+    now = datetime.datetime.utcnow()
+    latest = {}
+    for row in rows:
+        latest[row["device_id"]] = {
+            "device_id": row["device_id"],
+            "building_id": row["building_id"],
+            "floor": row["floor"],
+            "loc_east": row["loc_east"],
+            "loc_north": row["loc_north"],
+            "updated_at": now,
+        }
+    return list(latest.values())
+
+
+def upsert_latest_stmt(dialect: str, records):
+    """
+    Build an INSERT ... ON CONFLICT upsert of device_latest records, or
+    return None if the dialect has no native upsert.
+    """
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return None
+
+    stmt = dialect_insert(DeviceLatest).values(records)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DeviceLatest.device_id],
+        set_={
+            "building_id": stmt.excluded.building_id,
+            "floor": stmt.excluded.floor,
+            "loc_east": stmt.excluded.loc_east,
+            "loc_north": stmt.excluded.loc_north,
+            "updated_at": stmt.excluded.updated_at,
+        },
+    )
+    return stmt
+
+
+def upsert_latest(records):
+    """Upsert device_latest within the current session's transaction."""
+    stmt = upsert_latest_stmt(db.engine.dialect.name, records)
+    if stmt is None:
+        # Portable fallback: one merge per device
+        for record in records:
+            db.session.merge(DeviceLatest(**record))
+        return
+    db.session.execute(stmt)
+
+
+def refresh_live_cache(force=False):
+    """Load device_latest rows changed since the cache was last updated."""
+    global _live_cache_refreshed, _live_cache_watermark
+    now = time.monotonic()
+    if not force and now - _live_cache_refreshed < LIVE_CACHE_REFRESH:
+        return
+    _live_cache_refreshed = now
+
+    records = [row.to_record() for row in db.session.execute(latest_changes_query(_live_cache_watermark)).scalars()]
+    if records:
+        _live_cache_watermark = max(r["updated_at"] for r in records)
+        live_cache.update(records)
+
+
+def latest_changes_query(watermark):
+    """device_latest rows that may have changed since the given watermark."""
+    query = select(DeviceLatest)
+    if watermark is not None:
+        query = query.where(DeviceLatest.updated_at > watermark - LIVE_CACHE_OVERLAP)
+    return query
+
+
+# ------------------------------------------------------
+# Request helpers
+# ------------------------------------------------------
+POSITION_FIELDS = ["building_id", "floor", "loc_east", "loc_north"]
+
+# Accepted range of each position field: the INTEGER columns are 32-bit,
+# and floors fit the binary telemetry format's signed byte
+INT32_RANGE = (-2 ** 31, 2 ** 31 - 1)
+FIELD_RANGES = {
+    "building_id": INT32_RANGE,
+    "floor": (-128, 127),
+    "loc_east": INT32_RANGE,
+    "loc_north": INT32_RANGE,
+}
+
+# Maximum number of positions accepted by one batch request
+MAX_BATCH_SIZE = 5000
+
+# Request body types the upload endpoints accept, advertised in Accept-Post.
+# BINARY_MIMETYPE is the compact encoding in telemetry_codec.py.
+UPLOAD_MIMETYPES = ["application/json", "application/x-ndjson", BINARY_MIMETYPE]
+
+
+def authenticate():
+    """
+    Validate the Bearer JWT on the current request.
+    Returns (device_id, None) on success or (None, error_response) on failure.
+    """
+    auth_header = request.headers.get("Authorization", "")
+    if not auth_header.startswith("Bearer "):
+        return None, (jsonify({"error": "missing or invalid Authorization header"}), 401)
+
+    token = auth_header.replace("Bearer ", "").strip()
+    try:
+        device_id = verify_device_token(token)
+    except Exception as e:
+        print("DB error verifying token: %s" % (e,), flush=True)
+        return None, (jsonify({"error": "database error verifying token"}), 500)
+
+    if not device_id:
+        return None, (jsonify({"error": "invalid or revoked token"}), 401)
+
+    return device_id, None
+
+
+def is_viewer(auth_header: str) -> bool:
+    """True if the Authorization header carries VIEWER_SECRET."""
+    if not VIEWER_SECRET or not auth_header.startswith("Bearer "):
+        return False
+    return safe_str_cmp(auth_header[len("Bearer "):].strip().encode(), VIEWER_SECRET.encode())
+
+
+READ_FORBIDDEN = {"error": "token may not read these positions"}
+VIEWER_REQUIRED = {"error": "viewer credential required"}
+
+
+def authorize_read(device_id=None):
+    """
+    Authorize reading stored positions: the viewer credential may read
+    anything, a device token only its own track (device_id).
+    Returns None on success or an error response.
+    """
+    if is_viewer(request.headers.get("Authorization", "")):
+        return None
+    caller, error = authenticate()
+    if error:
+        return error
+    if device_id is None or caller != device_id:
+        return jsonify(READ_FORBIDDEN), 403
+    return None
+
+
+def validate_position(data, device_id):
+    """
+    Validate one position object and build its row for the positions table.
+    Returns (row, None) on success or (None, error message) on failure.
+    """
+    if not isinstance(data, dict):
+        return None, "position must be an object"
+    if not all(k in data for k in POSITION_FIELDS):
+        return None, "missing required fields"
+
+    row = {"device_id": device_id}
+    for k in POSITION_FIELDS:
+        value = data[k]
+        # bool is an int subclass; reject it explicitly
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None, "field %s must be a number" % k
+        if not math.isfinite(value):
+            return None, "field %s must be finite" % k
+        value = int(round(value))
+        low, high = FIELD_RANGES[k]
+        if not low <= value <= high:
+            return None, "field %s must be between %d and %d" % (k, low, high)
+        row[k] = value
+
+    # Optional fix time (Unix seconds)
+    row["recorded_at"] = None
+    timestamp = data.get("timestamp")
+    if timestamp is not None:
+        if isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)):
+            return None, "field timestamp must be a number"
+        if not math.isfinite(timestamp):
+            return None, "field timestamp must be finite"
+        try:
+            row["recorded_at"] = datetime.datetime.utcfromtimestamp(timestamp)
+        except (OverflowError, OSError, ValueError):
+            return None, "field timestamp is out of range"
+    return row, None
+
+
+# Page size limits for the read endpoints
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+# Rows fetched per round trip while streaming a page
+STREAM_FETCH_SIZE = 500
+
+
+def parse_time(value, default=None):
+    """Parse an ISO 8601 query parameter; raises ValueError if malformed."""
+    if not value:
+        return default
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        # created_at is stored as naive UTC
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def page_size(args):
+    return max(1, min(args.get("limit", DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+
+
+def encode_row(row, first):
+    return ("" if first else ",") + json.dumps(row.to_dict())
+
+
+def encode_page_end(cursor):
+    return '], "next": %s}' % json.dumps(cursor)
+
+
+def stream_page(query, limit, cursor_of):
+    """
+    Stream a page of positions as a JSON object:
+      {"positions": [...], "next": <cursor or null>}
+    Rows are fetched STREAM_FETCH_SIZE at a time (a server-side cursor on
+    PostgreSQL) and written out as they arrive, so a full page is never held
+    in memory. One extra row is requested to decide whether a next page exists.
+    """
+    def generate():
+        yield '{"positions": ['
+        count = 0
+        last = None
+        more = False
+        result = db.session.execute(
+            query.limit(limit + 1).execution_options(yield_per=STREAM_FETCH_SIZE)
+        ).scalars()
+        for row in result:
+            if count == limit:
+                more = True
+                break
+            yield encode_row(row, count == 0)
+            count += 1
+            last = row
+        result.close()
+        yield encode_page_end(cursor_of(last) if more else None)
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def parse_binary_position(body):
+    """
+    Read the single position of a binary telemetry body (bytes).
+    Returns (data, None) or (None, error message).
+    """
+    try:
+        items = decode_positions(body)
+    except ValueError as e:
+        return None, str(e)
+    if len(items) != 1:
+        return None, "expected one position, got %d" % len(items)
+    return items[0], None
+
+
+def parse_position_batch(mimetype, body):
+    """
+    Read a batch of positions from a request body (bytes).
+    Accepts a JSON array, a JSON object with a "positions" array,
+    newline-delimited JSON (Content-Type: application/x-ndjson), or binary
+    telemetry (Content-Type: BINARY_MIMETYPE).
+    Returns (items, None) or (None, error message). Unparseable NDJSON lines
+    are returned as None items so they can be reported individually.
+    """
+    if mimetype == BINARY_MIMETYPE:
+        try:
+            return decode_positions(body), None
+        except ValueError as e:
+            return None, str(e)
+
+    if mimetype in ("application/x-ndjson", "application/jsonl"):
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+        return items, None
+
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        data = data.get("positions")
+    if not isinstance(data, list):
+        return None, "expected a JSON array of positions"
+    return data, None
+
+
+def validate_batch(items, device_id):
+    """Validate every item; returns (rows, per-item errors)."""
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        if item is None:
+            errors.append({"index": index, "error": "invalid JSON"})
+            continue
+        row, message = validate_position(item, device_id)
+        if message:
+            errors.append({"index": index, "error": message})
+        else:
+            rows.append(row)
+    return rows, errors
+
+
+def parse_track_args(args):
+    """
+    Parse ?start=, ?end= and ?after= for a device track.
+    Returns (start, end, after) where after is None or (created_at, id);
+    raises ValueError if any parameter is malformed.
+    """
+    start = parse_time(args.get("start"), datetime.datetime.min)
+    end = parse_time(args.get("end"), datetime.datetime.utcnow() + datetime.timedelta(days=1))
+    after = args.get("after")
+    if after:
+        after_time, after_id = after.rsplit("|", 1)
+        after = (parse_time(after_time), int(after_id))
+    return start, end, after or None
+
+
+def track_cursor(row):
+    return "%s|%d" % (row.created_at.isoformat(), row.id)
+
+
+def track_query(device_id, start, end, after):
+    # Served by ix_positions_device_time, and by partition pruning on PostgreSQL
+    query = select(Position).where(
+        Position.device_id == device_id,
+        Position.created_at >= start,
+        Position.created_at < end,
+    )
+    if after:
+        # Keyset pagination: resume strictly after the last (created_at, id) seen
+        query = query.where(tuple_(Position.created_at, Position.id) > tuple_(*after))
+    return query.order_by(Position.created_at, Position.id)
+
+
+def snapshot_query(building_id, floor, window, after):
+    # Served by ix_positions_floor_time over just the recent partitions
+    since = datetime.datetime.utcnow() - datetime.timedelta(seconds=max(1, window))
+    conditions = [
+        Position.building_id == building_id,
+        Position.floor == floor,
+        Position.created_at >= since,
+    ]
+    if after:
+        conditions.append(Position.device_id > after)
+
+    # ids only grow, so the highest id per device is its latest row even when
+    # several rows of a batch share one created_at
+    latest = (
+        select(func.max(Position.id).label("id"))
+        .where(*conditions)
+        .group_by(Position.device_id)
+        .subquery()
+    )
+    return (
+        select(Position)
+        .join(latest, Position.id == latest.c.id)
+        .where(*conditions)
+        .order_by(Position.device_id)
+    )
+
+
 # ------------------------------------------------------
 # Routes
 # ------------------------------------------------------
+@app.after_request
+def advertise_upload_types(response):
+    """Advertise the body types the upload endpoints accept (Accept-Post)."""
+    if request.endpoint in ("position", "positions_batch"):
+        response.headers["Accept-Post"] = ", ".join(UPLOAD_MIMETYPES)
+    return response
+
+
 @app.route("/api/register", methods=["POST"])
 def register_device():
     if not PYJWT_AVAILABLE:
@@ -203,48 +873,189 @@ def register_device():
         print("DB error saving active_jwt: %s" % (e,), flush=True)
         return jsonify({"error": "database error saving token"}), 500
 
+    token_cache.put(token, device_id)
     return jsonify({"jwt": token})
 
 
+@app.route("/api/revoke", methods=["POST"])
+def revoke():
+    """
+    Revoke a single token, or every token issued to a device.
+    Body: {"secret": REGISTRATION_SECRET, "token": "..."} or
+          {"secret": REGISTRATION_SECRET, "device_id": "..."}
+    """
+    data = request.get_json(silent=True) or {}
+    provided_secret = data.get("secret")
+    token = data.get("token")
+    device_id = data.get("device_id")
+
+    if not provided_secret or not (token or device_id):
+        return jsonify({"error": "secret and token or device_id required"}), 400
+
+    if not safe_str_cmp(provided_secret, REGISTRATION_SECRET):
+        return jsonify({"error": "invalid secret"}), 403
+
+    try:
+        query = ActiveJWT.query.filter_by(token=token) if token else ActiveJWT.query.filter_by(device_id=device_id)
+        revoked = query.delete()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print("DB error revoking token: %s" % (e,), flush=True)
+        return jsonify({"error": "database error revoking token"}), 500
+
+    if token:
+        token_cache.invalidate(token)
+    else:
+        token_cache.invalidate_device(device_id)
+
+    return jsonify({"status": "ok", "revoked": revoked})
+
+
 @app.route("/api/position", methods=["POST"])
 def position():
     # Authentication
-    auth_header = request.headers.get("Authorization", "")
-    if not auth_header.startswith("Bearer "):
-        return jsonify({"error": "missing or invalid Authorization header"}), 401
-
-    token = auth_header.replace("Bearer ", "").strip()
-    payload = verify_jwt(token)
-    if not payload:
-        return jsonify({"error": "invalid token"}), 401
-
-    device_id = payload.get("device_id")
-    if not device_id:
-        return jsonify({"error": "token missing device_id"}), 401
+    device_id, error = authenticate()
+    if error:
+        return error
 
     # Data validation
-    data = request.get_json(silent=True) or {}
-    required = ["building_id", "floor", "loc_east", "loc_north"]
-    if not all(k in data for k in required):
-        return jsonify({"error": "missing required fields"}), 400
+    if request.mimetype == BINARY_MIMETYPE:
+        data, message = parse_binary_position(request.get_data())
+        if message:
+            return jsonify({"error": message}), 400
+    else:
+        data = request.get_json(silent=True) or {}
+    row, message = validate_position(data, device_id)
+    if message:
+        return jsonify({"error": message}), 400
 
+    maintain_partitions()
+    latest = latest_records([row])
     try:
-        entry = Position(
-            device_id=device_id,
-            building_id=data["building_id"],
-            floor=data["floor"],
-            loc_east=data["loc_east"],
-            loc_north=data["loc_north"],
-        )
-        db.session.add(entry)
+        db.session.add(Position(**row))
+        upsert_latest(latest)
         db.session.commit()
     except Exception as e:
+        db.session.rollback()
         print("DB error saving position: %s" % (e,), flush=True)
         return jsonify({"error": "database error saving position"}), 500
 
+    live_cache.update(latest)
     return jsonify({"status": "ok"}), 200
 
 
+@app.route("/api/positions/batch", methods=["POST"])
+def positions_batch():
+    # Authentication
+    device_id, error = authenticate()
+    if error:
+        return error
+
+    items, error = parse_position_batch(request.mimetype, request.get_data())
+    if error:
+        return jsonify({"error": error}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({"error": "batch exceeds %d positions" % MAX_BATCH_SIZE}), 413
+
+    # Validate everything up front; invalid items are reported, not fatal
+    rows, errors = validate_batch(items, device_id)
+
+    if rows:
+        maintain_partitions()
+        latest = latest_records(rows)
+        try:
+            # One multi-row INSERT for the whole batch, in a single transaction
+            db.session.execute(insert(Position), rows)
+            upsert_latest(latest)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print("DB error saving position batch: %s" % (e,), flush=True)
+            return jsonify({"error": "database error saving positions"}), 500
+        live_cache.update(latest)
+
+    status = 200 if rows or not items else 400
+    return jsonify({"status": "ok" if rows else "error", "inserted": len(rows), "errors": errors}), status
+
+
+@app.route("/api/devices/<device_id>/track", methods=["GET"])
+def device_track(device_id):
+    """
+    Positions of one device between ?start= and ?end= (ISO 8601, end exclusive),
+    oldest first. Pass the previous response's "next" as ?after= for the next page.
+    Readable by the device itself or with the viewer credential.
+    """
+    error = authorize_read(device_id)
+    if error:
+        return error
+
+    try:
+        start, end, after = parse_track_args(request.args)
+    except ValueError:
+        return jsonify({"error": "invalid start, end or after parameter"}), 400
+
+    query = track_query(device_id, start, end, after)
+    return stream_page(query, page_size(request.args), track_cursor)
+
+
+@app.route("/api/buildings/<int:building_id>/floors/<int:floor>/snapshot", methods=["GET"])
+def floor_snapshot(building_id, floor):
+    """
+    Latest position of every device seen on a floor in the last ?window=
+    seconds (default 60), ordered by device_id. Page with ?after=<device_id>.
+    Requires the viewer credential.
+    """
+    error = authorize_read()
+    if error:
+        return error
+
+    window = request.args.get("window", 60, type=int)
+    query = snapshot_query(building_id, floor, window, request.args.get("after"))
+    return stream_page(query, page_size(request.args), lambda row: row.device_id)
+
+
+@app.route("/api/live", methods=["GET"])
+def live():
+    """
+    Current position of every device, optionally filtered by ?building_id=
+    and ?floor=, served from memory. Supports If-None-Match: an unchanged
+    snapshot returns 304 without being re-serialized.
+    """
+    _, error = authenticate()
+    if error:
+        return error
+
+    building_id = request.args.get("building_id", type=int)
+    floor = request.args.get("floor", type=int)
+
+    try:
+        refresh_live_cache()
+    except Exception as e:
+        # Serve what we have; the next request will retry the refresh
+        print("DB error refreshing live cache: %s" % (e,), flush=True)
+
+    # Memoized until the cache changes, so a 304 still costs only a lookup
+    etag, body = live_cache.snapshot(building_id, floor)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response
+
+
+@app.route("/api/stats", methods=["GET"])
+def stats():
+    """Cache and connection statistics. Requires the viewer credential."""
+    if not is_viewer(request.headers.get("Authorization", "")):
+        return jsonify(VIEWER_REQUIRED), 401
+    return jsonify({
+        "token_cache": token_cache.stats(),
+        "live_cache": {"devices": len(live_cache.devices), "version": live_cache.version},
+    })
+
+
 # Health check
 @app.route("/", methods=["GET"])
 def root():
@@ -253,4 +1064,6 @@ def root():
 
 # Local dev only
 if __name__ == "__main__":
+    with app.app_context():
+        init_database()
     app.run(host="0.0.0.0", port=8000)
@@ -0,0 +1,410 @@
+"""
+ASGI variant of the cloud API: the same endpoints as app.py, served by Quart
+on an async SQLAlchemy engine (asyncpg on PostgreSQL), so one worker can keep
+many slow device connections open without a thread per request.
+
+Models, validation and query building are shared with app.py; only the
+request handling and database I/O differ. Run with e.g.
+  hypercorn asgi:app --bind 0.0.0.0:8000 --workers 2
+"""
+import time
+from hmac import compare_digest as safe_str_cmp
+
+from quart import Quart, Response, request, jsonify
+from sqlalchemy import insert, select, delete
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from app import (
+    DB_URL, REGISTRATION_SECRET, PYJWT_AVAILABLE, TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL,
+    LIVE_CACHE_REFRESH, MAX_BATCH_SIZE, STREAM_FETCH_SIZE, UPLOAD_MIMETYPES, BINARY_MIMETYPE,
+    ActiveJWT, DeviceLatest, Position,
+    READ_FORBIDDEN, VIEWER_REQUIRED, is_viewer, engine_options, setup_schema, ensure_partitions, partitions_due,
+    create_device_jwt, verify_jwt, latest_records, upsert_latest_stmt, latest_changes_query,
+    validate_position, parse_binary_position, parse_position_batch, validate_batch, page_size,
+    parse_track_args, track_query, track_cursor, snapshot_query,
+    encode_row, encode_page_end,
+)
+from token_cache import TokenCache
+from live_cache import LiveCache
+
+
+# ------------------------------------------------------
+# Async engine
+# ------------------------------------------------------
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_database_url(url: str):
+    """
+    Point a sync SQLAlchemy URL at the matching async driver.
+    Returns (url, connect_args); asyncpg takes ssl instead of sslmode.
+    """
+    url = make_url(url)
+    connect_args = {}
+    if "sslmode" in url.query:
+        connect_args["ssl"] = url.query["sslmode"]
+        url = url.difference_update_query(["sslmode"])
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver:
+        url = url.set(drivername=driver)
+    return url, connect_args
+
+
+app = Quart(__name__)
+
+engine = None
+Session = None
+if DB_URL:
+    _url, _connect_args = async_database_url(DB_URL)
+    engine = create_async_engine(_url, connect_args=_connect_args, **engine_options(DB_URL))
+    Session = async_sessionmaker(engine, expire_on_commit=False)
+else:
+    print("ERROR: DB_URL is not configured; database endpoints will fail.", flush=True)
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+live_cache = LiveCache()
+_live_cache_refreshed = 0.0
+_live_cache_watermark = None
+
+
+# ------------------------------------------------------
+# Startup / shutdown
+# ------------------------------------------------------
+@app.before_serving
+async def init_database():
+    if engine is None:
+        print("Skipping schema setup because DB_URL is not configured.", flush=True)
+        return
+
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(setup_schema)
+        print("Database tables created/verified.", flush=True)
+        await refresh_live_cache(force=True)
+    except Exception as exc:
+        # Do not raise — log for Azure diagnostics
+        print("DATABASE INITIALIZATION ERROR: %s" % (exc,), flush=True)
+
+
+@app.after_serving
+async def close_database():
+    if engine is not None:
+        await engine.dispose()
+
+
+async def maintain_partitions():
+    if engine.dialect.name == "postgresql" and partitions_due():
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(ensure_partitions)
+        except Exception as exc:
+            print("PARTITION MAINTENANCE ERROR: %s" % (exc,), flush=True)
+
+
+async def upsert_latest(session, records):
+    stmt = upsert_latest_stmt(engine.dialect.name, records)
+    if stmt is None:
+        for record in records:
+            await session.merge(DeviceLatest(**record))
+        return
+    await session.execute(stmt)
+
+
+async def refresh_live_cache(force=False):
+    """Load device_latest rows changed since the cache was last updated."""
+    global _live_cache_refreshed, _live_cache_watermark
+    now = time.monotonic()
+    if not force and now - _live_cache_refreshed < LIVE_CACHE_REFRESH:
+        return
+    _live_cache_refreshed = now
+
+    async with Session() as session:
+        rows = await session.scalars(latest_changes_query(_live_cache_watermark))
+        records = [row.to_record() for row in rows]
+    if records:
+        _live_cache_watermark = max(r["updated_at"] for r in records)
+        live_cache.update(records)
+
+
+# ------------------------------------------------------
+# Request helpers
+# ------------------------------------------------------
+async def verify_device_token(token: str):
+    device_id = token_cache.get(token)
+    if device_id:
+        return device_id
+
+    payload = verify_jwt(token)
+    if not payload or not payload.get("device_id"):
+        return None
+
+    async with Session() as session:
+        device_id = await session.scalar(
+            select(ActiveJWT.device_id).where(ActiveJWT.token == token).limit(1)
+        )
+    if device_id is None:
+        return None
+
+    token_cache.put(token, device_id)
+    return device_id
+
+
+async def authenticate():
+    """Same contract as app.authenticate(): (device_id, error_response)."""
+    auth_header = request.headers.get("Authorization", "")
+    if not auth_header.startswith("Bearer "):
+        return None, (jsonify({"error": "missing or invalid Authorization header"}), 401)
+
+    token = auth_header.replace("Bearer ", "").strip()
+    try:
+        device_id = await verify_device_token(token)
+    except Exception as e:
+        print("DB error verifying token: %s" % (e,), flush=True)
+        return None, (jsonify({"error": "database error verifying token"}), 500)
+
+    if not device_id:
+        return None, (jsonify({"error": "invalid or revoked token"}), 401)
+
+    return device_id, None
+
+
+async def authorize_read(device_id=None):
+    """Same contract as app.authorize_read(): None or an error response."""
+    if is_viewer(request.headers.get("Authorization", "")):
+        return None
+    caller, error = await authenticate()
+    if error:
+        return error
+    if device_id is None or caller != device_id:
+        return jsonify(READ_FORBIDDEN), 403
+    return None
+
+
+async def store_positions(rows):
+    """Insert rows and upsert device_latest in one transaction."""
+    await maintain_partitions()
+    latest = latest_records(rows)
+    async with Session.begin() as session:
+        await session.execute(insert(Position), rows)
+        await upsert_latest(session, latest)
+    live_cache.update(latest)
+
+
+def stream_page(query, limit, cursor_of):
+    """Async counterpart of app.stream_page()."""
+    async def generate():
+        yield '{"positions": ['
+        count = 0
+        last = None
+        more = False
+        async with Session() as session:
+            result = await session.stream_scalars(
+                query.limit(limit + 1).execution_options(yield_per=STREAM_FETCH_SIZE)
+            )
+            async for row in result:
+                if count == limit:
+                    more = True
+                    break
+                yield encode_row(row, count == 0)
+                count += 1
+                last = row
+            await result.close()
+        yield encode_page_end(cursor_of(last) if more else None)
+
+    return Response(generate(), mimetype="application/json")
+
+
+# ------------------------------------------------------
+# Routes
+# ------------------------------------------------------
+@app.after_request
+async def advertise_upload_types(response):
+    """Advertise the body types the upload endpoints accept (Accept-Post)."""
+    if request.endpoint in ("position", "positions_batch"):
+        response.headers["Accept-Post"] = ", ".join(UPLOAD_MIMETYPES)
+    return response
+
+
+@app.route("/api/register", methods=["POST"])
+async def register_device():
+    if not PYJWT_AVAILABLE:
+        return jsonify({"error": "PyJWT dependency not installed. Add 'PyJWT' to requirements.txt and redeploy."}), 500
+
+    data = await request.get_json(silent=True) or {}
+    provided_secret = data.get("secret")
+    device_id = data.get("device_id")
+
+    if not provided_secret or not device_id:
+        return jsonify({"error": "secret and device_id required"}), 400
+
+    if not safe_str_cmp(provided_secret, REGISTRATION_SECRET):
+        return jsonify({"error": "invalid secret"}), 403
+
+    try:
+        token = create_device_jwt(device_id)
+    except RuntimeError as e:
+        print("JWT creation error: %s" % (e,), flush=True)
+        return jsonify({"error": str(e)}), 500
+
+    try:
+        async with Session.begin() as session:
+            session.add(ActiveJWT(token=token, device_id=device_id))
+    except Exception as e:
+        print("DB error saving active_jwt: %s" % (e,), flush=True)
+        return jsonify({"error": "database error saving token"}), 500
+
+    token_cache.put(token, device_id)
+    return jsonify({"jwt": token})
+
+
+@app.route("/api/revoke", methods=["POST"])
+async def revoke():
+    data = await request.get_json(silent=True) or {}
+    provided_secret = data.get("secret")
+    token = data.get("token")
+    device_id = data.get("device_id")
+
+    if not provided_secret or not (token or device_id):
+        return jsonify({"error": "secret and token or device_id required"}), 400
+
+    if not safe_str_cmp(provided_secret, REGISTRATION_SECRET):
+        return jsonify({"error": "invalid secret"}), 403
+
+    condition = ActiveJWT.token == token if token else ActiveJWT.device_id == device_id
+    try:
+        async with Session.begin() as session:
+            revoked = (await session.execute(delete(ActiveJWT).where(condition))).rowcount
+    except Exception as e:
+        print("DB error revoking token: %s" % (e,), flush=True)
+        return jsonify({"error": "database error revoking token"}), 500
+
+    if token:
+        token_cache.invalidate(token)
+    else:
+        token_cache.invalidate_device(device_id)
+
+    return jsonify({"status": "ok", "revoked": revoked})
+
+
+@app.route("/api/position", methods=["POST"])
+async def position():
+    device_id, error = await authenticate()
+    if error:
+        return error
+
+    if request.mimetype == BINARY_MIMETYPE:
+        data, message = parse_binary_position(await request.get_data())
+        if message:
+            return jsonify({"error": message}), 400
+    else:
+        data = await request.get_json(silent=True) or {}
+    row, message = validate_position(data, device_id)
+    if message:
+        return jsonify({"error": message}), 400
+
+    try:
+        await store_positions([row])
+    except Exception as e:
+        print("DB error saving position: %s" % (e,), flush=True)
+        return jsonify({"error": "database error saving position"}), 500
+
+    return jsonify({"status": "ok"}), 200
+
+
+@app.route("/api/positions/batch", methods=["POST"])
+async def positions_batch():
+    device_id, error = await authenticate()
+    if error:
+        return error
+
+    items, error = parse_position_batch(request.mimetype, await request.get_data())
+    if error:
+        return jsonify({"error": error}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({"error": "batch exceeds %d positions" % MAX_BATCH_SIZE}), 413
+
+    rows, errors = validate_batch(items, device_id)
+    if rows:
+        try:
+            await store_positions(rows)
+        except Exception as e:
+            print("DB error saving position batch: %s" % (e,), flush=True)
+            return jsonify({"error": "database error saving positions"}), 500
+
+    status = 200 if rows or not items else 400
+    return jsonify({"status": "ok" if rows else "error", "inserted": len(rows), "errors": errors}), status
+
+
+@app.route("/api/devices/<device_id>/track", methods=["GET"])
+async def device_track(device_id):
+    error = await authorize_read(device_id)
+    if error:
+        return error
+
+    try:
+        start, end, after = parse_track_args(request.args)
+    except ValueError:
+        return jsonify({"error": "invalid start, end or after parameter"}), 400
+
+    return stream_page(track_query(device_id, start, end, after), page_size(request.args), track_cursor)
+
+
+@app.route("/api/buildings/<int:building_id>/floors/<int:floor>/snapshot", methods=["GET"])
+async def floor_snapshot(building_id, floor):
+    error = await authorize_read()
+    if error:
+        return error
+
+    window = request.args.get("window", 60, type=int)
+    query = snapshot_query(building_id, floor, window, request.args.get("after"))
+    return stream_page(query, page_size(request.args), lambda row: row.device_id)
+
+
+@app.route("/api/live", methods=["GET"])
+async def live():
+    _, error = await authenticate()
+    if error:
+        return error
+
+    building_id = request.args.get("building_id", type=int)
+    floor = request.args.get("floor", type=int)
+
+    try:
+        await refresh_live_cache()
+    except Exception as e:
+        print("DB error refreshing live cache: %s" % (e,), flush=True)
+
+    # Memoized until the cache changes, so a 304 still costs only a lookup
+    etag, body = live_cache.snapshot(building_id, floor)
+    if request.if_none_match.contains(etag):
+        response = Response("", status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response
+
+
+@app.route("/api/stats", methods=["GET"])
+async def stats():
+    if not is_viewer(request.headers.get("Authorization", "")):
+        return jsonify(VIEWER_REQUIRED), 401
+    return jsonify({
+        "token_cache": token_cache.stats(),
+        "live_cache": {"devices": len(live_cache.devices), "version": live_cache.version},
+        "pool": engine.pool.status() if engine is not None else None,
+    })
+
+
+# Health check
+@app.route("/", methods=["GET"])
+async def root():
+    return "API is running."
+
+
+# Local dev only
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=8000)
@@ -0,0 +1,95 @@
+"""
+Codec benchmark: payload size and cost of JSON, NDJSON and binary telemetry.
+
+For single positions and batches, reports bytes per message, the handheld's
+encode time and the cloud's parse + validate time (parse_position_batch and
+validate_batch, without the database), per position.
+  python bench_codec.py [repeat]
+
+First checks that handheld/telemetry_codec.py is identical to this
+directory's copy, and exits with an error if it is not.
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+
+if not os.getenv("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+
+from app import parse_position_batch, validate_batch  # noqa: E402
+from telemetry_codec import MIMETYPE, encode_positions  # noqa: E402
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SHARED_CODEC = ("telemetry_codec.py", os.path.join(HERE, "..", "handheld", "telemetry_codec.py"))
+
+
+def check_shared_codec():
+    """Fail if the handheld's copy of the codec has drifted from the cloud's."""
+    ours = os.path.join(HERE, SHARED_CODEC[0])
+    theirs = SHARED_CODEC[1]
+    if not os.path.exists(theirs):
+        print("Skipping codec sync check: %s not found" % theirs)
+        return
+    with open(ours, "rb") as a, open(theirs, "rb") as b:
+        if a.read() != b.read():
+            sys.exit("%s and %s differ: copy one over the other so both sides speak the same format"
+                     % (ours, os.path.normpath(theirs)))
+
+
+def make_track(count):
+    """Telemetry records as the handheld builds them: a walk sampled every 5 s."""
+    north, east = 2000.0, 2000.0
+    t = time.time()
+    records = []
+    for _ in range(count):
+        north += random.uniform(-300, 300)
+        east += random.uniform(-300, 300)
+        t += random.uniform(4.9, 5.1)
+        records.append({"device_id": "handheld-1", "building_id": 1, "floor": 4,
+                        "loc_north": north, "loc_east": east, "timestamp": t})
+    return records
+
+
+def per_call(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+CODECS = {
+    "json": ("application/json", lambda records: json.dumps(records).encode()),
+    "ndjson": ("application/x-ndjson", lambda records: "\n".join(json.dumps(r) for r in records).encode()),
+    "binary": (MIMETYPE, encode_positions),
+}
+
+
+def main():
+    check_shared_codec()
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    print("%-7s | %5s | %9s | %9s | %14s | %14s" % (
+        "Codec", "batch", "bytes", "bytes/pos", "encode us/pos", "decode us/pos"))
+    for size in (1, 12, 100, 1000):
+        records = make_track(size)
+        calls = max(1, repeat * 100 // size)
+        for name, (mimetype, encode) in CODECS.items():
+            body = encode(records)
+
+            def decode():
+                items, error = parse_position_batch(mimetype, body)
+                rows, errors = validate_batch(items, "bench-device")
+                assert not error and not errors and len(rows) == size
+
+            encode_time = per_call(lambda: encode(records), calls) / size
+            decode_time = per_call(decode, calls) / size
+            print("%-7s | %5d | %9d | %9.1f | %14.2f | %14.2f" % (
+                name, size, len(body), len(body) / size, encode_time * 1e6, decode_time * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Smoothing benchmark: runs smooth_tracks.py over simulated walks.
+
+Generates DEVICES devices walking for HOURS hours with fixes every 5 s
+(noise of NOISE px plus occasional wild fixes), stores them as batched
+uploads do (a dozen fixes sharing one created_at), smooths every track, and
+reports throughput and the error of raw and smoothed positions against the
+true walk. Uses a temporary SQLite file unless DATABASE_URL is set:
+  python bench_smooth.py [devices] [hours] [workers]
+"""
+import os
+import sys
+import math
+import time
+import random
+import datetime
+import tempfile
+
+if not os.getenv("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+
+from sqlalchemy import insert, select  # noqa: E402
+from app import app, db, Position, SmoothedPosition, DeviceLatest, init_database  # noqa: E402
+import smooth_tracks  # noqa: E402
+
+INTERVAL = 5.0
+BATCH = 12
+NOISE = 200.0
+OUTLIER_RATE = 0.02
+# Walking speed (px/s, about 1.2 m/s) and how often the heading changes
+SPEED = 120.0
+TURN_EVERY = 30.0
+
+
+def walk(steps, start):
+    """True positions: a random walk at walking speed inside a 4000 px square."""
+    north, east = random.uniform(500, 3500), random.uniform(500, 3500)
+    heading = random.uniform(0, 2 * math.pi)
+    points = []
+    for step in range(steps):
+        if random.random() < INTERVAL / TURN_EVERY:
+            heading = random.uniform(0, 2 * math.pi)
+        north += SPEED * INTERVAL * math.cos(heading)
+        east += SPEED * INTERVAL * math.sin(heading)
+        if not 0 < north < 4000 or not 0 < east < 4000:
+            heading += math.pi
+            north = min(max(north, 0), 4000)
+            east = min(max(east, 0), 4000)
+        points.append((start + datetime.timedelta(seconds=step * INTERVAL), north, east))
+    return points
+
+
+def generate(devices, hours):
+    now = datetime.datetime.utcnow()
+    steps = int(hours * 3600 / INTERVAL)
+    truth = {}
+    with app.app_context():
+        for index in range(devices):
+            device_id = "device-%04d" % index
+            points = walk(steps, now - datetime.timedelta(hours=hours))
+            rows = []
+            for step, (recorded_at, north, east) in enumerate(points):
+                if random.random() < OUTLIER_RATE:
+                    north_fix, east_fix = random.uniform(0, 4000), random.uniform(0, 4000)
+                else:
+                    north_fix, east_fix = random.gauss(north, NOISE), random.gauss(east, NOISE)
+                # Uploaded in batches: every fix of a batch is stored when the last one is taken
+                uploaded = points[min(len(points) - 1, (step // BATCH + 1) * BATCH - 1)][0]
+                rows.append({"device_id": device_id, "building_id": 1, "floor": 4,
+                             "loc_north": int(round(north_fix)), "loc_east": int(round(east_fix)),
+                             "created_at": uploaded, "recorded_at": recorded_at})
+            db.session.execute(insert(Position), rows)
+            db.session.execute(insert(DeviceLatest), [{
+                "device_id": device_id, "building_id": 1, "floor": 4,
+                "loc_north": rows[-1]["loc_north"], "loc_east": rows[-1]["loc_east"], "updated_at": now}])
+            truth[device_id] = {recorded_at: (north, east) for recorded_at, north, east in points}
+        db.session.commit()
+    return truth
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def main():
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    hours = float(sys.argv[2]) if len(sys.argv) > 2 else 6
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+
+    with app.app_context():
+        init_database()
+    random.seed(546)
+    truth = generate(devices, hours)
+
+    start = datetime.datetime.min
+    end = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    began = time.perf_counter()
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers, initializer=smooth_tracks.init_worker) as pool:
+            results = list(pool.map(smooth_tracks.smooth_device, truth, [start] * devices, [end] * devices))
+    else:
+        smooth_tracks.init_worker()
+        results = [smooth_tracks.smooth_device(device_id, start, end) for device_id in truth]
+    elapsed = time.perf_counter() - began
+    rows = sum(r[1] for r in results)
+    outliers = sum(r[2] for r in results)
+
+    raw_errors = []
+    smoothed_errors = []
+    with app.app_context():
+        for position in db.session.execute(select(Position)).scalars():
+            north, east = truth[position.device_id][position.recorded_at]
+            raw_errors.append(math.hypot(position.loc_north - north, position.loc_east - east))
+        for position in db.session.execute(select(SmoothedPosition)).scalars():
+            north, east = truth[position.device_id][position.recorded_at]
+            smoothed_errors.append(math.hypot(position.loc_north - north, position.loc_east - east))
+
+    print("Database: %s" % app.config["SQLALCHEMY_DATABASE_URI"])
+    print("Smoothed %d rows (%d flagged outliers) for %d devices with %d workers in %.2f s: %.0f rows/s" % (
+        rows, outliers, devices, workers, elapsed, rows / elapsed))
+    print("%-9s | %11s | %8s | %8s" % ("Track", "median (px)", "p90 (px)", "p99 (px)"))
+    for name, errors in (("raw", raw_errors), ("smoothed", smoothed_errors)):
+        print("%-9s | %11.0f | %8.0f | %8.0f" % (
+            name, percentile(errors, 50), percentile(errors, 90), percentile(errors, 99)))
+
+
+if __name__ == "__main__":
+    main()
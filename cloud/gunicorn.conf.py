@@ -0,0 +1,12 @@
+# Picked up automatically by gunicorn from the working directory
+# (Azure App Service starts the app with gunicorn from here).
+
+# Create/verify the schema once in the master process, before any worker
+# accepts a request, instead of on each worker's first request
+def on_starting(server):
+    from app import app, db, init_database
+
+    with app.app_context():
+        init_database()
+        # Workers import the app themselves; don't let them inherit these connections
+        db.engine.dispose()
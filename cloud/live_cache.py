@@ -0,0 +1,68 @@
+import json
+import hashlib
+import threading
+
+
+class LiveCache:
+    """
+    In-process copy of the device_latest table: the current position of
+    every device, keyed by device_id.
+
+    Every change bumps `version`. Serialized snapshots are memoized per
+    (building_id, floor) filter and version, so repeated reads of an
+    unchanged snapshot cost a dictionary lookup. The ETag for If-None-Match
+    is a hash of the serialized body rather than the version, which only
+    counts this process's updates: every worker, before or after a
+    restart, gives the same snapshot the same ETag.
+    """
+
+    def __init__(self):
+        self.devices = {}
+        self.version = 0
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def update(self, records):
+        """Apply device_latest records (dicts with device_id and updated_at)."""
+        if not records:
+            return
+        with self._lock:
+            changed = False
+            for record in records:
+                current = self.devices.get(record["device_id"])
+                # Ignore stale or repeated updates, e.g. from a refresh racing a write
+                if current is not None and current["updated_at"] >= record["updated_at"]:
+                    continue
+                self.devices[record["device_id"]] = record
+                changed = True
+            if changed:
+                self.version += 1
+                self._snapshots.clear()
+
+    def snapshot(self, building_id=None, floor=None):
+        """Return (etag, serialized JSON body) for the filtered snapshot."""
+        key = (building_id, floor)
+        with self._lock:
+            cached = self._snapshots.get(key)
+            if cached is not None:
+                return cached
+
+            devices = [
+                {
+                    "device_id": d["device_id"],
+                    "building_id": d["building_id"],
+                    "floor": d["floor"],
+                    "loc_east": d["loc_east"],
+                    "loc_north": d["loc_north"],
+                    "updated_at": d["updated_at"].isoformat(),
+                }
+                # Sorted, so the body doesn't depend on the order updates arrived in
+                for _, d in sorted(self.devices.items())
+                if (building_id is None or d["building_id"] == building_id)
+                and (floor is None or d["floor"] == floor)
+            ]
+            body = json.dumps({"devices": devices})
+            etag = hashlib.blake2b(body.encode(), digest_size=16).hexdigest()
+            cached = (etag, body)
+            self._snapshots[key] = cached
+            return cached
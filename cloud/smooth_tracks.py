@@ -0,0 +1,294 @@
+"""
+Offline track smoothing: rebuilds smoothed_positions from positions.
+
+Each device's fixes are read in time order and run through a
+constant-velocity Kalman filter followed by a Rauch-Tung-Striebel smoother,
+so every position is estimated from the fixes before and after it instead
+of from its own snapshot. Fixes the filter finds implausible (innovation
+beyond GATE) are flagged as outliers and replaced by the smoothed estimate.
+
+Memory stays bounded however long a track is: rows are read in keyset
+chunks of CHUNK_SIZE (each streamed through a server-side cursor on
+PostgreSQL), and the smoother only holds WINDOW + LAG fixes, finalizing the
+oldest WINDOW of them with LAG fixes of look-ahead. A track is split into
+segments at gaps longer than MAX_GAP and at building or floor changes.
+Devices are spread over a process pool, one task per device, each worker
+with its own connections.
+
+Rerunning over a window replaces that window's smoothed rows:
+  python smooth_tracks.py [--start 2024-01-01] [--end 2024-02-01] [--device ID ...] [--workers N]
+"""
+import os
+import sys
+import time
+import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from sqlalchemy import create_engine, select, insert, delete, func, tuple_
+
+from app import DB_URL, engine_options, parse_time, Position, SmoothedPosition
+
+# Motion model, in floorplan pixels (98.4252 px per meter): fix noise and
+# the random acceleration of a walking person
+MEASUREMENT_SIGMA = float(os.getenv("SMOOTH_MEASUREMENT_SIGMA", "200"))
+ACCELERATION_SIGMA = float(os.getenv("SMOOTH_ACCELERATION_SIGMA", "50"))
+# Velocity uncertainty at the start of a segment (px/s)
+INITIAL_VELOCITY_SIGMA = float(os.getenv("SMOOTH_INITIAL_VELOCITY_SIGMA", "200"))
+# Squared Mahalanobis distance beyond which a fix is an outlier
+# (chi-square, 2 degrees of freedom, 99.9%)
+GATE = float(os.getenv("SMOOTH_GATE", "13.8"))
+# Seconds without a fix that end a segment
+MAX_GAP = float(os.getenv("SMOOTH_MAX_GAP", "60"))
+
+# Fixes finalized per smoothing pass, and the look-ahead each is smoothed with
+WINDOW = int(os.getenv("SMOOTH_WINDOW", "2000"))
+LAG = int(os.getenv("SMOOTH_LAG", "200"))
+# Rows per keyset query, rows fetched per round trip, and rows per insert
+CHUNK_SIZE = int(os.getenv("SMOOTH_CHUNK_SIZE", "10000"))
+FETCH_SIZE = int(os.getenv("SMOOTH_FETCH_SIZE", "1000"))
+WRITE_SIZE = int(os.getenv("SMOOTH_WRITE_SIZE", "5000"))
+
+
+class TrackSmoother:
+    """
+    Kalman filter + RTS smoother over one device's fixes, fed in time order.
+
+    The state per axis is (position, velocity). Both axes share one
+    covariance (same model, same time steps), so each step computes the
+    2x2 covariance algebra once and applies it to north and east together.
+    feed() and finish() return the rows that are final.
+    """
+
+    def __init__(self, window=WINDOW, lag=LAG):
+        self.window = window
+        self.lag = lag
+        self.r = MEASUREMENT_SIGMA ** 2
+        self.q = ACCELERATION_SIGMA ** 2
+        # Forward pass entries not yet emitted:
+        # [row, dt, predicted state, predicted cov, filtered state, filtered cov, outlier]
+        self.entries = []
+        self.last = None
+
+    def feed(self, row):
+        """row: (position_id, building_id, floor, loc_north, loc_east, created_at, recorded_at)."""
+        output = []
+        last = self.last
+        if last is not None:
+            dt = (row[6] - last[6]).total_seconds()
+            if dt > MAX_GAP or row[1] != last[1] or row[2] != last[2]:
+                output = self.finish()
+        self.last = row
+
+        z_n, z_e = row[3], row[4]
+        if not self.entries:
+            state = (z_n, 0.0, z_e, 0.0)
+            cov = (self.r, 0.0, INITIAL_VELOCITY_SIGMA ** 2)
+            self.entries.append([row, 0.0, state, cov, state, cov, False])
+            return output
+
+        dt = max(0.0, (row[6] - self.entries[-1][0][6]).total_seconds())
+        pn, vn, pe, ve = self.entries[-1][4]
+        a, b, d = self.entries[-1][5]
+
+        # Predict: x = F x, P = F P F^T + Q (white noise acceleration)
+        pred = (pn + vn * dt, vn, pe + ve * dt, ve)
+        q = self.q
+        pa = a + 2 * b * dt + d * dt * dt + q * dt ** 3 / 3
+        pb = b + d * dt + q * dt ** 2 / 2
+        pd = d + q * dt
+        pred_cov = (pa, pb, pd)
+
+        # Update with the fix unless it falls outside the gate
+        s = pa + self.r
+        y_n = z_n - pred[0]
+        y_e = z_e - pred[2]
+        outlier = (y_n * y_n + y_e * y_e) / s > GATE
+        if outlier:
+            state, cov = pred, pred_cov
+        else:
+            k_p = pa / s
+            k_v = pb / s
+            state = (pred[0] + k_p * y_n, pred[1] + k_v * y_n, pred[2] + k_p * y_e, pred[3] + k_v * y_e)
+            cov = (pa - k_p * pa, pb - k_p * pb, pd - k_v * pb)
+        self.entries.append([row, dt, pred, pred_cov, state, cov, outlier])
+
+        if len(self.entries) >= self.window + self.lag:
+            output.extend(self._smooth(self.window))
+        return output
+
+    def finish(self):
+        """Smooth and return every held fix, ending the segment."""
+        output = self._smooth(len(self.entries))
+        self.last = None
+        return output
+
+    def _smooth(self, count):
+        """Backward pass over every held entry; emit and drop the oldest count."""
+        entries = self.entries
+        if not entries:
+            return []
+        smoothed = [None] * len(entries)
+        smoothed[-1] = entries[-1][4]
+        for i in range(len(entries) - 2, -1, -1):
+            _, dt, pred, pred_cov, _, _, _ = entries[i + 1]
+            state, (a, b, d) = entries[i][4], entries[i][5]
+            pa, pb, pd = pred_cov
+            det = pa * pd - pb * pb
+            if det <= 0:
+                smoothed[i] = state
+                continue
+            # C = P F^T P_pred^-1
+            m00, m01 = a + b * dt, b
+            m10, m11 = b + d * dt, d
+            c00 = (m00 * pd - m01 * pb) / det
+            c01 = (m01 * pa - m00 * pb) / det
+            c10 = (m10 * pd - m11 * pb) / det
+            c11 = (m11 * pa - m10 * pb) / det
+            nxt = smoothed[i + 1]
+            dn_p, dn_v = nxt[0] - pred[0], nxt[1] - pred[1]
+            de_p, de_v = nxt[2] - pred[2], nxt[3] - pred[3]
+            smoothed[i] = (state[0] + c00 * dn_p + c01 * dn_v, state[1] + c10 * dn_p + c11 * dn_v,
+                           state[2] + c00 * de_p + c01 * de_v, state[3] + c10 * de_p + c11 * de_v)
+
+        output = []
+        for entry, state in zip(entries[:count], smoothed):
+            row = entry[0]
+            output.append((row, state[0], state[2], entry[6]))
+        del entries[:count]
+        return output
+
+
+# Per-process engine, created by init_worker (connections can't cross a fork)
+_engine = None
+
+
+def init_worker():
+    global _engine
+    _engine = create_engine(DB_URL, **engine_options(DB_URL))
+
+
+def track_chunks(conn, device_id, start, end):
+    """Yield a device's positions in (created_at, id) order, CHUNK_SIZE rows per query."""
+    fix_time = func.coalesce(Position.recorded_at, Position.created_at)
+    after = None
+    while True:
+        query = select(
+            Position.id, Position.building_id, Position.floor, Position.loc_north, Position.loc_east,
+            Position.created_at, fix_time,
+        ).where(
+            Position.device_id == device_id,
+            Position.created_at >= start,
+            Position.created_at < end,
+        )
+        if after:
+            query = query.where(tuple_(Position.created_at, Position.id) > tuple_(*after))
+        query = query.order_by(Position.created_at, Position.id).limit(CHUNK_SIZE)
+
+        result = conn.execution_options(stream_results=True, yield_per=FETCH_SIZE).execute(query)
+        rows = [tuple(row) for row in result]
+        # End the read transaction so no snapshot is held between chunks
+        conn.rollback()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < CHUNK_SIZE:
+            return
+        after = (rows[-1][5], rows[-1][0])
+
+
+def smooth_device(device_id, start, end):
+    """Replace a device's smoothed rows in [start, end). Returns (device_id, rows, outliers)."""
+    smoother = TrackSmoother()
+    pending = []
+    written = 0
+    outliers = 0
+
+    def write(conn, output):
+        nonlocal written, outliers
+        pending.extend({
+            "position_id": row[0], "device_id": device_id, "building_id": row[1], "floor": row[2],
+            "loc_north": int(round(north)), "loc_east": int(round(east)),
+            "created_at": row[5], "recorded_at": row[6], "outlier": outlier,
+        } for row, north, east, outlier in output)
+        outliers += sum(1 for _, _, _, outlier in output if outlier)
+        if len(pending) >= WRITE_SIZE or (not output and pending):
+            conn.execute(insert(SmoothedPosition.__table__), pending)
+            conn.commit()
+            written += len(pending)
+            pending.clear()
+
+    with _engine.connect() as reader, _engine.connect() as writer:
+        writer.execute(delete(SmoothedPosition.__table__).where(
+            SmoothedPosition.device_id == device_id,
+            SmoothedPosition.created_at >= start,
+            SmoothedPosition.created_at < end,
+        ))
+        for rows in track_chunks(reader, device_id, start, end):
+            for row in rows:
+                output = smoother.feed(row)
+                if output:
+                    write(writer, output)
+        write(writer, smoother.finish())
+        write(writer, [])
+        writer.commit()
+    return device_id, written, outliers
+
+
+def device_ids(engine, start, end):
+    """Every device with positions in [start, end), CHUNK_SIZE devices per query."""
+    devices = []
+    with engine.connect() as conn:
+        while True:
+            # Served by ix_positions_device_time
+            query = select(Position.device_id).distinct().where(
+                Position.created_at >= start,
+                Position.created_at < end,
+            )
+            if devices:
+                query = query.where(Position.device_id > devices[-1])
+            chunk = [row[0] for row in conn.execute(query.order_by(Position.device_id).limit(CHUNK_SIZE))]
+            devices.extend(chunk)
+            if len(chunk) < CHUNK_SIZE:
+                return devices
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smooth stored device tracks into smoothed_positions")
+    parser.add_argument("--start", help="ISO 8601 start of the window (default: everything)")
+    parser.add_argument("--end", help="ISO 8601 end of the window (default: now)")
+    parser.add_argument("--device", action="append", help="device to smooth (default: every device with positions in the window)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+    args = parser.parse_args()
+
+    if not DB_URL:
+        sys.exit("DATABASE_URL is not configured")
+    start = parse_time(args.start, datetime.datetime.min)
+    end = parse_time(args.end, datetime.datetime.utcnow() + datetime.timedelta(days=1))
+
+    if args.device:
+        devices = args.device
+    else:
+        engine = create_engine(DB_URL, **engine_options(DB_URL))
+        devices = device_ids(engine, start, end)
+        # Workers open their own connections
+        engine.dispose()
+
+    began = time.perf_counter()
+    total = 0
+    total_outliers = 0
+    with ProcessPoolExecutor(max(1, args.workers), initializer=init_worker) as pool:
+        futures = [pool.submit(smooth_device, device_id, start, end) for device_id in devices]
+        for done, future in enumerate(as_completed(futures), 1):
+            device_id, rows, outliers = future.result()
+            total += rows
+            total_outliers += outliers
+            print("[%d/%d] %s: %d rows, %d outliers" % (done, len(devices), device_id, rows, outliers), flush=True)
+
+    elapsed = time.perf_counter() - began
+    print("Smoothed %d rows (%d outliers) for %d devices in %.1f s (%.0f rows/s)" % (
+        total, total_outliers, len(devices), elapsed, total / elapsed if elapsed else 0), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class TokenCache:
+    """
+    LRU cache of verified device tokens with a time-to-live.
+
+    Entries are keyed by the SHA-256 of the token so raw credentials are not
+    kept in memory longer than the request, and map to the token's device_id.
+    A hit means the token's signature was already verified and it was present
+    in the active_jwts table less than `ttl` seconds ago. Revocation calls
+    invalidate() locally; other worker processes pick it up when the entry
+    expires, so `ttl` bounds how long a revoked token can still be accepted.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, token: str):
+        key = token_hash(token)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token: str, device_id: str):
+        key = token_hash(token)
+        with self._lock:
+            self._entries[key] = (device_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, token: str):
+        with self._lock:
+            if self._entries.pop(token_hash(token), None) is not None:
+                self.invalidations += 1
+
+    def invalidate_device(self, device_id: str):
+        with self._lock:
+            stale = [k for k, (d, _) in self._entries.items() if d == device_id]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -1,41 +1,347 @@
 import os
+import sys
 import json
-from azure.iot.device import IoTHubDeviceClient, Message
+import time
+import asyncio
+import logging
+import log
 from position import Position
+import metrics
+from telemetry_codec import MIMETYPE as BINARY_MIMETYPE, encode_positions
+
+# Lazy import of the Azure SDK so the uploader can run against a stub client
+try:
+    from azure.iot.device import IoTHubDeviceClient, Message
+    AZURE_IOT_AVAILABLE = True
+except ImportError:
+    IoTHubDeviceClient = None
+    Message = None
+    AZURE_IOT_AVAILABLE = False
+
+DEVICE_ID = "handheld-1"
+# Telemetry message encodings: verbose "json", or compact "binary" (see
+# telemetry_codec.py), which the cloud selects by content type
+TELEMETRY_FORMATS = ("json", "binary")
+
+logger = logging.getLogger("azure_iot")
+
+
+# Build the telemetry record for a position (meters) in floorplan pixels
+def telemetry_record(pos, device_id=DEVICE_ID):
+    return {
+        "device_id": device_id,
+        "building_id": pos.building_id,
+        "floor": pos.floor,
+        "loc_north": pos.loc_north * 98.4252,
+        "loc_east": pos.loc_east * 98.4252,
+        "timestamp": time.time()
+    }
+
+
+def json_message(payload):
+    message = Message(payload) if AZURE_IOT_AVAILABLE else StubMessage(payload)
+    message.content_type = "application/json"
+    message.content_encoding = "utf-8"
+    return message
+
+
+def binary_message(payload):
+    message = Message(payload) if AZURE_IOT_AVAILABLE else StubMessage(payload)
+    message.content_type = BINARY_MIMETYPE
+    return message
+
 
 class AzureDevice:
-    def __init__(self, connection_string):
+    def __init__(self, connection_string, client=None, telemetry_format="json"):
+        if telemetry_format not in TELEMETRY_FORMATS:
+            raise ValueError(f"Unknown telemetry format {telemetry_format!r}, expected one of {TELEMETRY_FORMATS}")
+        self.telemetry_format = telemetry_format
+
+        if client is not None:
+            # Use a caller-supplied client, e.g. StubClient for local testing
+            self.client = client
+            return
+
         if not connection_string:
             raise ValueError("Mandatory environment variable unset: AZURE_IOT_CONNECTION_STRING")
+        if not AZURE_IOT_AVAILABLE:
+            raise RuntimeError("azure-iot-device is not installed. Run `pip install -r requirements.txt`")
         self.client = IoTHubDeviceClient.create_from_connection_string(connection_string)
         self.client.connect()
-        print("Azure IoT Hub device client connected.")
+        logger.info("Azure IoT Hub device client connected")
     
     # Use our position class as a wrapper for building, floor, and coordinate
     def send_telemetry(self, pos):
-        print("Send Telemetry Called")
         if not isinstance(pos, Position): 
             return
-        payload = json.dumps({
-            "device_id": "handheld-1",
-            "building_id": pos.building_id,
-            "floor": pos.floor,
-            "loc_north": pos.loc_north * 98.4252,
-            "loc_east": pos.loc_east * 98.4252
-        })
-        message = Message(payload)
-        message.content_type = "application/json"
-        message.content_encoding = "utf-8"
-        self.client.send_message(message)
-        print(f"Sent telemetry to Azure:\r\n {payload}")
+        record = telemetry_record(pos)
+        self.client.send_message(self.message([record], single=True))
+        log.event(logger, logging.DEBUG, "telemetry", "Sent telemetry to Azure", payload=record)
+
+    # Send several telemetry records as a single message (a JSON array, or
+    # one binary message). Blocks for the network round trip; raises if the
+    # send fails.
+    def send_batch(self, records):
+        self.client.send_message(self.message(records))
+
+    # Encode records in the configured format. Records the binary format
+    # can't hold (e.g. coordinates out of range) go as JSON instead.
+    def message(self, records, single=False):
+        if self.telemetry_format == "binary":
+            try:
+                return binary_message(encode_positions(records))
+            except ValueError as e:
+                log.event(logger, logging.WARNING, "telemetry_failure", "Sending telemetry as JSON", error=e)
+        return json_message(json.dumps(records[0] if single else records))
     
     def disconnect_client(self):
         if self.client:
             self.client.disconnect()
-            print("Azure IoT Hub device client disconnected.")
+            logger.info("Azure IoT Hub device client disconnected")
+
+
+# Minimal stand-ins for the SDK's Message and IoTHubDeviceClient so the
+# uploader can be exercised without an IoT Hub. Set `online` to False to
+# simulate losing connectivity.
+class StubMessage:
+    def __init__(self, data):
+        self.data = data
+        self.content_type = None
+        self.content_encoding = None
+
+
+class StubClient:
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.online = True
+        self.messages = []
+
+    def send_message(self, message):
+        time.sleep(self.latency)
+        if not self.online:
+            raise ConnectionError("Stub client is offline")
+        self.messages.append(message)
+
+    def disconnect(self):
+        pass
+
+
+# Asynchronous, batched telemetry uploader.
+# Records are queued in memory by submit() and sent by run() as one message
+# per batch, on a worker thread so the event loop never waits on the network.
+# If the in-memory queue overflows, or a send fails, records spill to an
+# append-only spool file on disk, which is replayed (oldest first) once sends
+# succeed again. Failed sends are retried with exponential backoff.
+class TelemetryUploader:
+    def __init__(self, send_batch, spool_path, batch_size=20, flush_interval=5.0,
+                 queue_size=1000, min_backoff=1.0, max_backoff=60.0):
+        self.send_batch = send_batch
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.queue = []
+        self._ready = asyncio.Event()
+        self._backoff = 0
+
+        # The spool is a JSON-lines file; spool_offset is the byte offset of the
+        # first record not yet sent, persisted alongside it.
+        self.spool_offset = self._read_offset()
+        self.spool_depth = self._count_spooled()
+
+        # Metrics
+        self.sent = 0            # Records delivered
+        self.batches = 0         # Messages delivered
+        self.failures = 0        # Failed send attempts
+        self.spooled = 0         # Records written to the spool
+        self.corrupt = 0         # Spooled lines skipped as undecodable
+        self.last_latency = 0.0  # Seconds taken by the last successful send
+        self.max_latency = 0.0
+
+    def submit(self, record):
+        if len(self.queue) >= self.queue_size:
+            # Spill the oldest half to disk rather than dropping anything
+            spill = self.queue[:self.queue_size // 2]
+            del self.queue[:self.queue_size // 2]
+            self._spool(spill)
+        self.queue.append(record)
+        if len(self.queue) >= self.batch_size:
+            self._ready.set()
+
+    def stats(self):
+        return {
+            "queue_depth": len(self.queue),
+            "spool_depth": self.spool_depth,
+            "sent": self.sent,
+            "batches": self.batches,
+            "failures": self.failures,
+            "spooled": self.spooled,
+            "corrupt": self.corrupt,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+        }
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._ready.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                # e.g. the spool's disk failing: keep running and retry later
+                self._backoff = min(self.max_backoff, max(self.min_backoff, self._backoff * 2))
+                log.event(logger, logging.ERROR, "telemetry_failure", "Telemetry flush failed",
+                          error=e, retry_in=round(self._backoff, 1))
+
+            if self._backoff:
+                await asyncio.sleep(self._backoff)
+
+    # Send everything we can: spooled records first to preserve ordering
+    async def flush(self):
+        while self.spool_depth:
+            batch, end_offset, lines = self._read_spool(self.batch_size)
+            if not lines:
+                self._truncate_spool()
+                break
+            if batch and not await self._send(batch):
+                return
+            self._advance_spool(end_offset, lines)
+
+        while self.queue:
+            batch = self.queue[:self.batch_size]
+            del self.queue[:self.batch_size]
+            if not await self._send(batch):
+                self._spool(batch)
+                return
+
+    async def _send(self, batch):
+        start = time.monotonic()
+        try:
+            await asyncio.to_thread(self.send_batch, batch)
+        except Exception as e:
+            self.failures += 1
+            if metrics.ENABLED:
+                metrics.TELEMETRY_FAILURES.inc()
+            self._backoff = min(self.max_backoff, max(self.min_backoff, self._backoff * 2))
+            log.event(logger, logging.WARNING, "telemetry_failure", "Telemetry upload failed",
+                      error=e, retry_in=round(self._backoff, 1), batch=len(batch))
+            return False
+
+        self.last_latency = time.monotonic() - start
+        if metrics.ENABLED:
+            metrics.TELEMETRY_SECONDS.observe(self.last_latency)
+        self.max_latency = max(self.max_latency, self.last_latency)
+        self.sent += len(batch)
+        self.batches += 1
+        log.event(logger, logging.DEBUG, "telemetry", "Sent telemetry batch", records=len(batch),
+                  latency=round(self.last_latency, 3))
+        self._backoff = 0
+        return True
+
+    def _spool(self, records):
+        with open(self.spool_path, "a+b") as f:
+            # A write torn by power loss leaves a partial last line; end it so
+            # the next record starts on a line of its own
+            if f.seek(0, os.SEEK_END):
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            f.write("".join(json.dumps(record) + "\n" for record in records).encode())
+        self.spool_depth += len(records)
+        self.spooled += len(records)
+
+    # Read up to count records from the spool offset. Returns the records, the
+    # offset after them and the number of complete lines read; lines that do
+    # not decode (torn writes) are skipped and counted in self.corrupt.
+    def _read_spool(self, count):
+        records = []
+        lines = 0
+        with open(self.spool_path, "rb") as f:
+            f.seek(self.spool_offset)
+            while len(records) < count:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    # End of file, or a torn last line not yet terminated
+                    f.seek(-len(line), os.SEEK_CUR)
+                    break
+                lines += 1
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    self.corrupt += 1
+                    log.event(logger, logging.WARNING, "telemetry_spool", "Skipped undecodable spool line",
+                              offset=f.tell() - len(line))
+            return records, f.tell(), lines
+
+    def _advance_spool(self, offset, count):
+        self.spool_offset = offset
+        self.spool_depth = max(0, self.spool_depth - count)
+        if self.spool_depth == 0:
+            self._truncate_spool()
+        else:
+            with open(self.spool_path + ".offset", "w") as f:
+                f.write(str(offset))
+
+    def _truncate_spool(self):
+        for path in (self.spool_path, self.spool_path + ".offset"):
+            if os.path.exists(path):
+                os.remove(path)
+        self.spool_offset = 0
+        self.spool_depth = 0
+
+    def _read_offset(self):
+        try:
+            with open(self.spool_path + ".offset") as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _count_spooled(self):
+        try:
+            with open(self.spool_path, "rb") as f:
+                f.seek(self.spool_offset)
+                return sum(1 for line in f if line.endswith(b"\n"))
+        except OSError:
+            return 0
+
+
+# Exercise the uploader against StubClient, including an offline period
+async def stub_demo():
+    client = StubClient()
+    device = AzureDevice(None, client=client)
+    uploader = TelemetryUploader(device.send_batch, "telemetry-demo.spool",
+                                 batch_size=10, flush_interval=0.5, queue_size=50,
+                                 min_backoff=0.2, max_backoff=1.0)
+    task = asyncio.create_task(uploader.run())
+
+    pos = Position(loc_north=10.0, loc_east=12.0, building_id=1, floor=4)
+    for i in range(200):
+        if i == 50:
+            client.online = False
+        if i == 150:
+            client.online = True
+        uploader.submit(telemetry_record(pos))
+        await asyncio.sleep(0.01)
+        if i % 50 == 0:
+            print(uploader.stats())
+
+    await asyncio.sleep(2)
+    print(uploader.stats())
+    print(f"Stub received {len(client.messages)} messages")
+    task.cancel()
 
 
 def main():
+    if "--stub" in sys.argv:
+        asyncio.run(stub_demo())
+        return
+
     # Create AzureDevice with no parameters
     device = AzureDevice(os.getenv("AZURE_IOT_CONNECTION_STRING"))
 
@@ -0,0 +1,72 @@
+import json
+import math
+import numpy as np
+
+# Grid cell edge in px. At 98.4 px/m this is about 5 m, so a query for the
+# ~12 m a beacon can be heard at touches a 5x5 block of cells at most.
+CELL_SIZE = 500
+
+
+# Convert a floorplan coordinate to the value a beacon actually broadcasts.
+# Payloads carry positions as float16, so e.g. 2075 arrives as 2076.
+def broadcast_coord(value):
+    return float(np.float16(value))
+
+
+# Spatial index of beacon positions, one uniform grid per (building, floor).
+# Keys are the same (building, floor, north, east) tuples the BeaconTable uses,
+# so "which beacons are near this point" costs O(cells touched) no matter
+# how many beacons the site has.
+class BeaconRegistry:
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        # (building, floor) -> {(cell_north, cell_east): [key, ...]}
+        self.floors = {}
+        self.keys = set()
+
+    # Load beacon positions (px) from a floorplan file such as static/beacons.json
+    @classmethod
+    def load(cls, path, cell_size=CELL_SIZE):
+        registry = cls(cell_size)
+        with open(path) as f:
+            for beacon in json.load(f):
+                registry.add((int(beacon["building"]), int(beacon["floor"]),
+                              broadcast_coord(beacon["loc_north"]), broadcast_coord(beacon["loc_east"])))
+        return registry
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def has_floor(self, building_id, floor):
+        return (building_id, floor) in self.floors
+
+    def _cell(self, north, east):
+        return math.floor(north / self.cell_size), math.floor(east / self.cell_size)
+
+    def add(self, key):
+        if key in self.keys:
+            return
+        building_id, floor, north, east = key
+        grid = self.floors.setdefault((building_id, floor), {})
+        grid.setdefault(self._cell(north, east), []).append(key)
+        self.keys.add(key)
+
+    # Keys of every beacon on the floor within radius (px) of (north, east)
+    def near(self, building_id, floor, north, east, radius):
+        grid = self.floors.get((building_id, floor))
+        if not grid:
+            return []
+
+        min_n, min_e = self._cell(north - radius, east - radius)
+        max_n, max_e = self._cell(north + radius, east + radius)
+        radius_sq = radius * radius
+        found = []
+        for cell_n in range(min_n, max_n + 1):
+            for cell_e in range(min_e, max_e + 1):
+                for key in grid.get((cell_n, cell_e), ()):
+                    if (key[2] - north) ** 2 + (key[3] - east) ** 2 <= radius_sq:
+                        found.append(key)
+        return found
@@ -0,0 +1,141 @@
+import numpy as np
+from kalman import KalmanBank
+from calibration import TX_POWER, PATH_LOSS
+
+# Number of raw RSSI samples kept per beacon
+HISTORY_LEN = 10
+# Rows allocated up front. The table doubles in size if more beacons are heard.
+INITIAL_CAPACITY = 64
+
+
+# Struct-of-arrays store for every beacon we are tracking.
+# Each beacon occupies one row (slot) across a set of preallocated NumPy
+# columns, and `slots` maps the beacon's (building, floor, north, east) key
+# to its row. Keys may carry leading identifiers (e.g. a tag, see fusion.py)
+# as long as they end with the position. Freed rows are recycled so the columns stay compact.
+# RSSI filtering state lives in a KalmanBank sharing the same row indices.
+class BeaconTable:
+    def __init__(self, capacity=INITIAL_CAPACITY, history_len=HISTORY_LEN, kalman=None):
+        self.capacity = 0
+        self.history_len = history_len
+        self.slots = {}
+        self.keys = []
+        self.free = []
+
+        self.active = np.zeros(0, dtype=bool)
+        self.building = np.zeros(0, dtype=np.int32)
+        self.floor = np.zeros(0, dtype=np.int16)
+        self.north = np.zeros(0)
+        self.east = np.zeros(0)
+        self.time = np.zeros(0)
+        self.avg_rssi = np.zeros(0)
+        self.distance = np.zeros(0)
+        # Log-distance model parameters of each beacon (see calibration.py)
+        self.tx_power = np.zeros(0)
+        self.path_loss = np.zeros(0)
+        self.kalman = kalman if kalman is not None else KalmanBank()
+        # Ring buffer of raw RSSI samples. RSSI is a small signed integer in dBm.
+        self.history = np.zeros((0, history_len), dtype=np.int16)
+        self.history_head = np.zeros(0, dtype=np.int16)
+        self.history_count = np.zeros(0, dtype=np.int16)
+
+        self._grow(capacity)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _grow(self, capacity):
+        extra = capacity - self.capacity
+        if extra <= 0:
+            return
+
+        def extend(column, fill=0):
+            pad = np.full((extra,) + column.shape[1:], fill, dtype=column.dtype)
+            return np.concatenate((column, pad))
+
+        self.active = extend(self.active, False)
+        self.building = extend(self.building)
+        self.floor = extend(self.floor)
+        self.north = extend(self.north)
+        self.east = extend(self.east)
+        self.time = extend(self.time)
+        self.avg_rssi = extend(self.avg_rssi)
+        self.distance = extend(self.distance)
+        self.tx_power = extend(self.tx_power)
+        self.path_loss = extend(self.path_loss)
+        self.kalman.resize(capacity)
+        self.history = extend(self.history)
+        self.history_head = extend(self.history_head)
+        self.history_count = extend(self.history_count)
+
+        self.keys.extend([None] * extra)
+        # Pop from the end, so push in reverse to hand out low rows first
+        self.free.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    # Return the row for a beacon, allocating a fresh one if it is new.
+    # profile is the (tx_power, path_loss) used for a new beacon.
+    # The row is filled in before the key is registered, so a value that
+    # does not fit its column leaves no half-built row behind.
+    def slot(self, key, profile=(TX_POWER, PATH_LOSS)):
+        row = self.slots.get(key)
+        if row is not None:
+            return row
+
+        if not self.free:
+            self._grow(self.capacity * 2)
+
+        row = self.free[-1]
+        building_id, floor, loc_north, loc_east = key[-4:]
+        self.building[row] = building_id
+        self.floor[row] = floor
+        self.north[row] = loc_north
+        self.east[row] = loc_east
+        self.time[row] = 0
+        self.avg_rssi[row] = 0
+        self.distance[row] = 0
+        self.tx_power[row], self.path_loss[row] = profile
+        self.kalman.reset(row)
+        self.history_head[row] = 0
+        self.history_count[row] = 0
+
+        self.free.pop()
+        self.slots[key] = row
+        self.keys[row] = key
+        self.active[row] = True
+        return row
+
+    # Release a set of rows so they may be reused by new beacons
+    def release(self, rows):
+        for row in rows:
+            row = int(row)
+            del self.slots[self.keys[row]]
+            self.keys[row] = None
+            self.free.append(row)
+        self.active[rows] = False
+
+    # Indices of every occupied row
+    def rows(self):
+        return np.flatnonzero(self.active)
+
+    def last_rssi(self, row):
+        if self.history_count[row] == 0:
+            return None
+        return int(self.history[row, self.history_head[row] - 1])
+
+    # Most recent raw RSSI sample of each row (rows must have at least one)
+    def latest_rssi(self, rows):
+        return self.history[rows, self.history_head[rows].astype(np.intp) - 1]
+
+    def push_history(self, row, rssi):
+        head = self.history_head[row]
+        self.history[row, head] = rssi
+        self.history_head[row] = (head + 1) % self.history_len
+        self.history_count[row] = min(self.history_count[row] + 1, self.history_len)
+
+    # Return the RSSI history of a row, oldest first
+    def history_of(self, row):
+        count = self.history_count[row]
+        start = self.history_head[row] - count
+        idx = np.arange(start, start + count) % self.history_len
+        return self.history[row, idx].tolist()
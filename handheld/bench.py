@@ -0,0 +1,504 @@
+import os
+import sys
+import asyncio
+import json
+import time
+import tempfile
+import numpy as np
+import payload as ips
+from solver import solve_position, range_weights
+from sensors import PATH_LOSS, SensorCache, meters_to_px, px_to_meters, TX_POWER
+from beacon_registry import BeaconRegistry, broadcast_coord
+from position import Position
+from engines import create_engine
+from floorplan import WallMap, PIL_AVAILABLE
+from fingerprint import FingerprintDB, compile_survey, beacon_id
+from calibration import CalibrationProfiles, fit_path_loss
+from capture import CaptureWriter, ReplayDevice, ReplayAdvertisement, read_capture
+import replay
+import fusion
+
+# Microbenchmarks for the handheld hot paths.
+# Run with `python bench.py` for everything or `python bench.py <name>` for one.
+
+
+def timeit(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+# Cost per solve as the number of beacons in range grows
+def bench_solver(repeat=2000):
+    rng = np.random.default_rng(546)
+    truth = np.array([15.0, 20.0])
+
+    print("Beacons | us/solve | error (m)")
+    for n in (3, 5, 10, 20, 50, 100, 200):
+        points = rng.uniform(0, 40, size=(n, 2))
+        ranges = np.hypot(*(points - truth).T)
+        distances = ranges + rng.normal(0, 0.5, size=n)
+        weights = range_weights(distances, np.full(n, 2.0), PATH_LOSS)
+
+        result = solve_position(points, distances, weights)
+        error = np.hypot(*(result - truth)) if result is not None else float("nan")
+        per_solve = timeit(lambda: solve_position(points, distances, weights), repeat)
+        print(f"{n:7d} | {per_solve * 1e6:8.1f} | {error:.3f}")
+
+
+# The decoder main.py used before payload.py, kept as a baseline
+def decode_frombuffer(value):
+    building_id = int.from_bytes(value[0:2], byteorder='big')
+    floor = value[2]
+    loc_north = np.frombuffer(value[3:5], dtype=">f2")[0].astype(float)
+    loc_east = np.frombuffer(value[5:7], dtype=">f2")[0].astype(float)
+    return building_id, floor, loc_north, loc_east
+
+
+# Cost per decoded 0x1821 payload for each decoding strategy
+def bench_payload(count=20000):
+    rng = np.random.default_rng(546)
+    # A realistic mix: a few dozen beacons each repeating their static payload
+    beacons = [ips.encode(1, 4, float(n), float(e)) for n, e in rng.uniform(0, 4000, size=(40, 2))]
+    payloads = [beacons[i] for i in rng.integers(0, len(beacons), size=count)]
+
+    def run_frombuffer():
+        for p in payloads:
+            decode_frombuffer(p)
+
+    def run_struct():
+        for p in payloads:
+            ips.PAYLOAD.unpack(p)
+
+    def run_memo():
+        for p in payloads:
+            ips.decode(p)
+
+    def run_batch():
+        ips.decode_batch(payloads)
+
+    print("Decoder    | ns/payload")
+    for name, fn in (("frombuffer", run_frombuffer), ("struct", run_struct),
+                     ("memoized", run_memo), ("batch", run_batch)):
+        per_payload = timeit(fn, 5) / count
+        print(f"{name:10s} | {per_payload * 1e9:10.1f}")
+
+
+# Beacon selection on a large site: candidate lookup cost as the number of
+# cached beacons grows, and how often nearest-three vs GDOP selection fails
+# or lands far from the truth
+def bench_selection(repeat=2000):
+    rng = np.random.default_rng(546)
+
+    print("Cached beacons | us/select | us/nearest-3 sort")
+    for count in (50, 500, 2000, 5000):
+        # Beacons every ~4 m along corridors of a 300 m x 300 m floor
+        north = rng.uniform(0, 300, count)
+        east = np.round(rng.uniform(0, 300, count) / 10) * 10
+        keys = [(1, 4, broadcast_coord(meters_to_px(n)), broadcast_coord(meters_to_px(e))) for n, e in zip(north, east)]
+        registry = BeaconRegistry()
+        for key in keys:
+            registry.add(key)
+
+        cache = SensorCache(0, registry=registry)
+        truth = np.array([150.0, 150.0])
+        cache.record_sensors([(key, -60 - 5 * rng.random(), 0.0) for key in keys])
+        cache.last_position = Position(truth[0], truth[1], 1, 4)
+
+        table = cache.table
+        per_select = timeit(cache.select_rows, repeat)
+        per_sort = timeit(lambda: np.argsort(table.distance[table.rows()], kind='stable')[:3], repeat)
+        print(f"{count:14d} | {per_select * 1e6:9.1f} | {per_sort * 1e6:9.1f}")
+
+    # Accuracy: handheld walking a corridor lined with beacons on both walls,
+    # where the three nearest are often nearly collinear
+    trials = 500
+    failures = {"nearest-3": 0, "gdop": 0}
+    errors = {"nearest-3": [], "gdop": []}
+    walls = [(n, e) for n in np.arange(0, 60, 3.0) for e in (0.0, 0.5, 3.0)]
+    for _ in range(trials):
+        truth = np.array([rng.uniform(5, 55), rng.uniform(0.5, 2.5)])
+        cache = SensorCache(0)
+        samples = []
+        for n, e in walls:
+            d = np.hypot(n - truth[0], e - truth[1])
+            if d > 10:
+                continue
+            rssi = TX_POWER - 10 * PATH_LOSS * np.log10(max(d, 0.1)) + rng.normal(0, 2)
+            samples.append(((1, 4, broadcast_coord(meters_to_px(n)), broadcast_coord(meters_to_px(e))), rssi, 0.0))
+        cache.record_sensors(samples)
+
+        table = cache.table
+        rows = table.rows()
+        rows = rows[np.argsort(table.distance[rows], kind='stable')[:3]]
+        points = np.column_stack((table.north[rows], table.east[rows])) / meters_to_px(1)
+        result = solve_position(points, table.distance[rows])
+        if result is None:
+            failures["nearest-3"] += 1
+        else:
+            errors["nearest-3"].append(np.hypot(*(result - truth)))
+
+        pos = cache.trilaterate()
+        if pos is None:
+            failures["gdop"] += 1
+        else:
+            errors["gdop"].append(np.hypot(pos.loc_north - truth[0], pos.loc_east - truth[1]))
+
+    print("")
+    print("Selection  | failed | median err (m) | p90 err (m)")
+    for name in ("nearest-3", "gdop"):
+        e = np.array(errors[name])
+        print(f"{name:10s} | {failures[name]:6d} | {np.median(e):14.2f} | {np.percentile(e, 90):11.2f}")
+
+
+# A 40 m x 16 m synthetic floor: a 3 m corridor along the north wall with
+# 8 m rooms to the south, one door each. Cells are WallMap cells (~10 cm).
+def synthetic_floor():
+    cell_px = 10
+    per_meter = meters_to_px(1) / cell_px
+    walls = np.zeros((int(16 * per_meter), int(40 * per_meter)), dtype=bool)
+
+    def wall(n0, e0, n1, e1):
+        walls[int(n0 * per_meter):int(n1 * per_meter) + 1, int(e0 * per_meter):int(e1 * per_meter) + 1] = True
+
+    wall(0, 0, 0.1, 40)
+    wall(15.9, 0, 16, 40)
+    wall(0, 0, 16, 0.1)
+    wall(0, 39.9, 16, 40)
+    # Corridor wall, with a 1 m door into each room
+    for room in range(5):
+        wall(12.9, room * 8, 13, room * 8 + 3.5)
+        wall(12.9, room * 8 + 4.5, 13, room * 8 + 8)
+        wall(0, room * 8, 13, room * 8 + 0.1)
+    return WallMap(walls, cell_px)
+
+
+# Walk down the corridor, into the third room and back out
+WALK = [(14.5, 2.0), (14.5, 20.0), (10.0, 20.0), (5.0, 18.0), (10.0, 20.0), (14.5, 20.0), (14.5, 38.0)]
+
+
+def walk_positions(rate, speed=1.2):
+    points = []
+    for (n0, e0), (n1, e1) in zip(WALK, WALK[1:]):
+        length = np.hypot(n1 - n0, e1 - e0)
+        steps = max(1, int(length / speed * rate))
+        for t in np.arange(steps) / steps:
+            points.append((n0 + (n1 - n0) * t, e0 + (e1 - e0) * t))
+    points.append(WALK[-1])
+    return np.array(points)
+
+
+# Beacons of the simulated floor: every 6 m along the corridor and two per room.
+# Returns their keys and positions in meters.
+def walk_beacons():
+    points = [(15.5, e) for e in np.arange(1.0, 40.0, 6.0)]
+    points += [(n, room * 8 + 4.0) for room in range(5) for n in (1.0, 8.0)]
+    keys = [(1, 4, broadcast_coord(meters_to_px(n)), broadcast_coord(meters_to_px(e))) for n, e in points]
+    return keys, np.array([(px_to_meters(k[2]), px_to_meters(k[3])) for k in keys])
+
+
+# Replays a simulated walk through every engine, each with its own cache fed
+# identical advertisements. RSSI follows the log-distance model plus
+# Gaussian noise; model is each beacon's true (tx_power, path_loss) arrays
+# (default: the global constants) and profiles optionally gives an engine's
+# cache its CalibrationProfiles.
+def run_walk(engines, rate=10.0, noise=4.0, ad_probability=0.5, seed=546, model=None, profiles=None):
+    rng = np.random.default_rng(seed)
+    keys, beacon_points = walk_beacons()
+    tx_power, path_loss = model if model is not None else (TX_POWER, PATH_LOSS)
+    profiles = profiles or {}
+
+    caches = {name: SensorCache(15, profiles=profiles.get(name)) for name in engines}
+    errors = {name: [] for name in engines}
+    elapsed = {name: 0.0 for name in engines}
+
+    for step, truth in enumerate(walk_positions(rate)):
+        now = step / rate
+        ranges = np.maximum(np.hypot(*(beacon_points - truth).T), 0.1)
+        heard = (ranges < 15) & (rng.random(len(keys)) < ad_probability)
+        rssi = tx_power - 10 * path_loss * np.log10(ranges) + rng.normal(0, noise, len(keys))
+        samples = [(keys[i], float(round(rssi[i])), now) for i in np.flatnonzero(heard)]
+
+        for name, engine in engines.items():
+            caches[name].record_sensors(samples)
+            start = time.perf_counter()
+            pos = engine.solve(caches[name], now)
+            elapsed[name] += time.perf_counter() - start
+            if pos is not None:
+                errors[name].append(np.hypot(pos.loc_north - truth[0], pos.loc_east - truth[1]))
+
+    return errors, elapsed, step + 1
+
+
+# Write a fingerprint survey of the simulated floor: the model RSSI of every
+# beacon within range at grid points `step` meters apart
+def synthetic_survey(path, step=1.0):
+    keys, beacon_points = walk_beacons()
+    with open(path, "w") as out:
+        for n in np.arange(0.5, 15.5 + step / 2, step):
+            for e in np.arange(0.5, 39.5 + step / 2, step):
+                ranges = np.maximum(np.hypot(*(beacon_points - (n, e)).T), 0.1)
+                rssi = TX_POWER - 10 * PATH_LOSS * np.log10(ranges)
+                out.write(json.dumps({
+                    "building": 1, "floor": 4, "north": float(n), "east": float(e),
+                    "rssi": {beacon_id(k): float(v) for k, v, r in zip(keys, rssi, ranges) if r < 15},
+                }) + "\n")
+
+
+# Accuracy of each position engine on the simulated walk
+def bench_engines():
+    walls = {(1, 4): synthetic_floor()}
+    directory = tempfile.mkdtemp()
+    survey = os.path.join(directory, "survey.jsonl")
+    synthetic_survey(survey, step=0.5)
+    compile_survey(survey, os.path.join(directory, "fingerprints.bin"))
+
+    engines = {
+        "trilateration": create_engine("trilateration"),
+        "particle": create_engine("particle", seed=546),
+        "particle+walls": create_engine("particle", wall_maps=walls, seed=546),
+        "fingerprint": create_engine("fingerprint", db=FingerprintDB(os.path.join(directory, "fingerprints.bin"))),
+    }
+    errors, elapsed, steps = run_walk(engines)
+
+    print(f"{steps} steps at 10 Hz")
+    print("Engine         | fixes | median (m) | p90 (m) | rmse (m) | ms/step")
+    for name in engines:
+        e = np.array(errors[name])
+        print(f"{name:14s} | {len(e):5d} | {np.median(e):10.2f} | {np.percentile(e, 90):7.2f} "
+              f"| {np.sqrt(np.mean(e ** 2)):8.2f} | {elapsed[name] / steps * 1000:7.2f}")
+
+
+# Beacons whose TX power and path loss differ from the global constants, as
+# real hardware does: first how well each calibration method recovers n from
+# simulated txandncal.py sessions, then positioning accuracy on the walk with
+# the global constants versus the fitted per-beacon profiles
+def bench_calibration(noise=4.0, samples=25):
+    rng = np.random.default_rng(546)
+    keys, _ = walk_beacons()
+    tx_power = TX_POWER + rng.normal(0, 3.0, len(keys))
+    path_loss = rng.uniform(1.5, 2.5, len(keys))
+    distances = np.repeat([1, 2, 3, 4, 5], samples)
+
+    entries = {}
+    averaged_error = []
+    fitted_error = []
+    for key, tx, n in zip(keys, tx_power, path_loss):
+        rssi = tx - 10 * n * np.log10(distances) + rng.normal(0, noise, len(distances))
+        tx_1m = rssi[distances == 1].mean()
+        # txandncal.py before: one n estimate per distance, averaged
+        averaged = np.mean([(tx_1m - rssi[distances == d].mean()) / (10 * np.log10(d)) for d in (2, 3, 4, 5)])
+        _, fitted, _ = fit_path_loss(distances, rssi, tx_1m)
+        averaged_error.append(abs(averaged - n))
+        fitted_error.append(abs(fitted - n))
+        entries[beacon_id(key)] = {"tx_power": tx_1m, "path_loss": fitted}
+
+    print(f"{len(keys)} beacons, {samples} samples per distance at 1-5 m, {noise} dB noise")
+    print(f"Mean |n error|: per-distance average {np.mean(averaged_error):.3f}, "
+          f"least squares {np.mean(fitted_error):.3f}")
+
+    engines = {
+        "global constants": create_engine("trilateration"),
+        "per-beacon profiles": create_engine("trilateration"),
+    }
+    errors, elapsed, steps = run_walk(engines, model=(tx_power, path_loss),
+                                      profiles={"per-beacon profiles": CalibrationProfiles(entries)})
+    print("Model               | fixes | median (m) | p90 (m)")
+    for name in engines:
+        e = np.array(errors[name])
+        print(f"{name:19s} | {len(e):5d} | {np.median(e):10.2f} | {np.percentile(e, 90):7.2f}")
+
+
+# Write a capture of the simulated walk as the beacons' firmware would produce
+# it (one advertisement every 500-1000 ms per beacon, heard within 15 m),
+# and the matching truth track for replay.py
+def synthetic_capture(path, truth_path, noise=4.0, seed=546):
+    rng = np.random.default_rng(seed)
+    keys, beacon_points = walk_beacons()
+    track = walk_positions(10.0)
+    duration = (len(track) - 1) / 10.0
+
+    events = []
+    for i in range(len(keys)):
+        t = rng.uniform(0, 1.0)
+        while t < duration:
+            events.append((t, i))
+            t += rng.uniform(0.5, 1.0)
+    events.sort()
+
+    uuid = f"0000{ips.SERVICE_UUID}-0000-1000-8000-00805f9b34fb"
+    payloads = [ips.encode(*key) for key in keys]
+    with CaptureWriter(path) as capture:
+        for t, i in events:
+            truth = track[min(int(round(t * 10)), len(track) - 1)]
+            distance = max(np.hypot(*(beacon_points[i] - truth)), 0.1)
+            if distance > 15:
+                continue
+            rssi = int(round(TX_POWER - 10 * PATH_LOSS * np.log10(distance) + rng.normal(0, noise)))
+            device = ReplayDevice(f"C0:00:00:00:00:{i:02X}", "blepos")
+            capture.write(device, ReplayAdvertisement("blepos", rssi, {uuid: payloads[i]}, {}, None), t)
+
+    with open(truth_path, "w") as out:
+        for step, (n, e) in enumerate(track):
+            out.write(json.dumps({"t": step / 10.0, "north": float(n), "east": float(e)}) + "\n")
+
+
+# The full ingest -> cache -> engine path replayed from a capture of the
+# simulated walk: deterministically as fast as possible, then through the
+# live tasks at 10x the recorded pace for latency
+def bench_replay():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "walk.cap")
+    truth_path = os.path.join(directory, "walk.jsonl")
+    synthetic_capture(path, truth_path)
+    records = read_capture(path)
+    truth = replay.load_truth(truth_path)
+    print(f"Capture: {os.path.getsize(path)} bytes for {len(records)} advertisements")
+
+    runs = [
+        ("trilateration", 0),
+        ("particle", 0),
+        ("trilateration", 10),
+    ]
+    print("Engine        | speed | adverts/s | solves | p50 solve (ms) | p99 latency (ms) | median err (m)")
+    for name, speed in runs:
+        engine = create_engine(name, **({"seed": 546} if name == "particle" else {}))
+        stats = replay.replay(records, speed, beacons=SensorCache(15), engine=engine, truth=truth)
+        print(f"{name:13s} | {speed or 'max':>5} | {stats['rate']:9.0f} | {stats['solves']:6d} "
+              f"| {stats['solve_p50_ms']:14.2f} | {stats['latency_p99_ms']:16.1f} | {stats['error_median']:14.2f}")
+
+
+# Particle filter step cost by particle count, with the real floorplan's
+# wall raster when Pillow is installed (otherwise the synthetic floor)
+def bench_particle(repeat=50):
+    floorplan = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "floorplans", "0001-04.png")
+    if PIL_AVAILABLE and os.path.exists(floorplan):
+        walls, source = WallMap.from_image(floorplan), "0001-04.png"
+    else:
+        walls, source = synthetic_floor(), "synthetic floor"
+
+    rng = np.random.default_rng(546)
+    cache = SensorCache(0)
+    truth = np.array([25.0, 18.0])
+    keys = []
+    for n, e in truth + rng.uniform(-10, 10, size=(8, 2)):
+        keys.append((1, 4, broadcast_coord(meters_to_px(n)), broadcast_coord(meters_to_px(e))))
+
+    print(f"Walls: {source}")
+    print("Particles | ms/step | max rate (Hz)")
+    for count in (1000, 10000, 20000, 50000):
+        engine = create_engine("particle", count=count, wall_maps={(1, 4): walls}, seed=546)
+        per_step = 0.0
+        for step in range(repeat):
+            now = step * 0.1
+            cache.record_sensors([(key, -65 - 10 * rng.random(), now) for key in keys])
+            start = time.perf_counter()
+            engine.solve(cache, now)
+            per_step += time.perf_counter() - start
+        per_step /= repeat
+        print(f"{count:9d} | {per_step * 1000:7.2f} | {1 / per_step:13.0f}")
+
+
+# Fingerprint lookup latency as the survey grows, with 8 beacons heard
+def bench_fingerprint(repeat=2000):
+    rng = np.random.default_rng(546)
+    directory = tempfile.mkdtemp()
+    keys = [(1, 4, broadcast_coord(n), broadcast_coord(e)) for n, e in rng.uniform(0, 8000, size=(300, 2))]
+
+    print("Points | Beacons | DB bytes | us/lookup")
+    for count in (1000, 10000, 50000):
+        survey = os.path.join(directory, f"survey{count}.jsonl")
+        with open(survey, "w") as out:
+            for n, e in rng.uniform(0, 80, size=(count, 2)):
+                heard = rng.choice(len(keys), 20, replace=False)
+                out.write(json.dumps({"building": 1, "floor": 4, "north": n, "east": e,
+                                      "rssi": {beacon_id(keys[i]): float(rng.uniform(-95, -50)) for i in heard}}) + "\n")
+        path = os.path.join(directory, f"fingerprints{count}.bin")
+        compile_survey(survey, path)
+
+        db = FingerprintDB(path)
+        heard = [keys[i] for i in rng.choice(len(keys), 8, replace=False)]
+        rssi = rng.uniform(-90, -55, 8)
+        per_lookup = timeit(lambda: db.lookup(1, 4, heard, rssi), repeat)
+        print(f"{count:6d} | {len(keys):7d} | {os.path.getsize(path):8d} | {per_lookup * 1e6:9.1f}")
+        db.close()
+
+
+# Fixed scanners every `spacing` m on each floor observing `tags` tags per
+# floor, fed to the fusion service as one batch per scanner per second.
+# Reports ingest rate, the time to solve every tag inline and through the
+# process pool, and accuracy against the tags' true positions.
+def bench_fusion(floors=4, tags=1000, size=80.0, spacing=8.0, seconds=5, noise=4.0, seed=546):
+    rng = np.random.default_rng(seed)
+    grid = np.arange(spacing / 2, size, spacing)
+    scanner_points = np.array([(n, e) for n in grid for e in grid])
+    scanner_keys = [(1, floor, broadcast_coord(meters_to_px(n)), broadcast_coord(meters_to_px(e)))
+                    for floor in range(floors) for n, e in scanner_points]
+    scanner_points = np.array([(px_to_meters(k[2]), px_to_meters(k[3])) for k in scanner_keys])
+    truth = rng.uniform(0, size, (floors, tags, 2))
+
+    # Observations per scanner and second: every tag in range, half the adverts lost
+    batches = []
+    for second in range(seconds):
+        for index, key in enumerate(scanner_keys):
+            floor = key[1]
+            ranges = np.maximum(np.hypot(*(truth[floor] - scanner_points[index]).T), 0.1)
+            heard = np.flatnonzero((ranges < 15) & (rng.random(tags) < 0.5))
+            rssi = TX_POWER - 10 * PATH_LOSS * np.log10(ranges[heard]) + rng.normal(0, noise, len(heard))
+            batches.append({"receiver": f"scanner-{index}", "t": float(second), "anchor": list(key),
+                            "observations": [[f"tag-{floor}-{tag}", int(round(value)), 0]
+                                             for tag, value in zip(heard.tolist(), rssi.tolist())]})
+    observations = sum(len(batch["observations"]) for batch in batches)
+    encoded = [json.dumps(batch) for batch in batches]
+
+    state = fusion.FusionState(expiry=seconds + 1)
+    start = time.perf_counter()
+    for raw in encoded:
+        state.record(json.loads(raw))
+    ingest = time.perf_counter() - start
+    print(f"{floors} floors, {floors * tags} tags, {len(scanner_keys)} scanners, {len(state.table)} links")
+    print(f"Ingest: {observations} observations in {ingest:.2f} s ({observations / ingest:.0f}/s)")
+
+    async def solve_all(workers, repeat=5):
+        service = fusion.FusionService(state, workers, min_pool_tags=1)
+        await service.solve(seconds)  # warm up the pool
+        start = time.perf_counter()
+        for _ in range(repeat):
+            await service.solve(seconds)
+        service.close()
+        return (time.perf_counter() - start) / repeat
+
+    print(f"Solve every tag inline: {asyncio.run(solve_all(0)) * 1000:.1f} ms")
+    workers = os.cpu_count()
+    print(f"Solve every tag with {workers} processes: {asyncio.run(solve_all(workers)) * 1000:.1f} ms")
+
+    errors = [np.hypot(fix["loc_north"] - truth[fix["floor"], int(name.split("-")[2]), 0],
+                       fix["loc_east"] - truth[fix["floor"], int(name.split("-")[2]), 1])
+              for name, fix in state.positions.items()]
+    print(f"Fixes: {len(errors)}, error median {np.median(errors):.2f} m, p90 {np.percentile(errors, 90):.2f} m")
+
+
+BENCHMARKS = {
+    "solver": bench_solver,
+    "payload": bench_payload,
+    "selection": bench_selection,
+    "particle": bench_particle,
+    "engines": bench_engines,
+    "fingerprint": bench_fingerprint,
+    "calibration": bench_calibration,
+    "replay": bench_replay,
+    "fusion": bench_fusion,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
+        print("")
+
+
+if __name__ == '__main__':
+    main()
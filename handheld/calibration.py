@@ -0,0 +1,100 @@
+import json
+import os
+import time
+import numpy as np
+from fingerprint import parse_beacon_id
+
+# Log-distance path loss model parameters used for any beacon and receiver
+# that has not been calibrated
+TX_POWER = -61.623
+PATH_LOSS = 1.806
+
+# Plausible path loss exponents; a fit outside this range means the samples
+# were bad (e.g. someone stood between the beacon and the receiver)
+MIN_PATH_LOSS = 1.0
+MAX_PATH_LOSS = 6.0
+
+# Key for a receiver's beacon-independent profile in the store
+ANY_BEACON = "*"
+
+
+# Batch least-squares fit of the log-distance model
+#   rssi = tx_power - 10 * n * log10(d)
+# over every (distance, rssi) sample at once. With tx_power given (measured
+# at 1 m), only n is fitted; otherwise both are. Distances with more samples
+# count for more, unlike averaging one n estimate per distance.
+# Returns (tx_power, path_loss, rms residual in dB).
+def fit_path_loss(distances, rssi, tx_power=None):
+    distances = np.asarray(distances, dtype=float)
+    rssi = np.asarray(rssi, dtype=float)
+    x = -10 * np.log10(distances)
+
+    if tx_power is None:
+        A = np.column_stack((np.ones_like(x), x))
+        (tx_power, path_loss), _, rank, _ = np.linalg.lstsq(A, rssi, rcond=None)
+        if rank < 2:
+            raise ValueError("Need samples at two or more distances to fit TX power and path loss")
+    else:
+        denominator = np.dot(x, x)
+        if denominator == 0:
+            raise ValueError("Need samples away from 1 m to fit path loss")
+        path_loss = np.dot(x, rssi - tx_power) / denominator
+
+    residual = rssi - (tx_power - 10 * path_loss * np.log10(distances))
+    return float(tx_power), float(path_loss), float(np.sqrt(np.mean(residual ** 2)))
+
+
+# Calibration profiles on disk, one (tx_power, path_loss) pair per beacon per
+# receiver, since antennas and enclosures differ on both ends:
+#   {"receivers": {receiver_id: {beacon_id | "*": {"tx_power", "path_loss", ...}}}}
+# beacon_id is the "b,f,n,e" key from fingerprint.beacon_id(). The "*" entry
+# applies to every beacon the receiver has no profile for.
+class CalibrationStore:
+    def __init__(self, path, receivers=None):
+        self.path = path
+        self.receivers = receivers or {}
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path) as f:
+            return cls(path, json.load(f).get("receivers", {}))
+
+    def save(self):
+        # Write a temporary file and rename so a crash never leaves half a store
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"receivers": self.receivers}, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def set(self, receiver, beacon, tx_power, path_loss, **details):
+        self.receivers.setdefault(receiver, {})[beacon] = dict(
+            tx_power=round(tx_power, 3), path_loss=round(path_loss, 4), calibrated=time.time(), **details)
+
+    def profiles(self, receiver):
+        return CalibrationProfiles(self.receivers.get(receiver, {}))
+
+
+# One receiver's profiles, keyed the way SensorCache keys beacons
+# (building, floor, north, east). lookup() is a dict hit per beacon.
+class CalibrationProfiles:
+    def __init__(self, entries=None):
+        entries = entries or {}
+        fallback = entries.get(ANY_BEACON)
+        if fallback is not None:
+            self.default = (fallback["tx_power"], fallback["path_loss"])
+        else:
+            self.default = (TX_POWER, PATH_LOSS)
+        self.beacons = {
+            parse_beacon_id(beacon): (entry["tx_power"], entry["path_loss"])
+            for beacon, entry in entries.items()
+            if beacon != ANY_BEACON
+        }
+
+    def __len__(self):
+        return len(self.beacons)
+
+    # (tx_power, path_loss) for a beacon key
+    def lookup(self, key):
+        return self.beacons.get(key, self.default)
@@ -0,0 +1,231 @@
+import asyncio
+import functools
+import struct
+import time
+import uuid
+from collections import namedtuple
+
+# Advertisement capture log (little-endian):
+#   header   MAGIC, version, capture start (Unix time)
+#   records  RECORD: seconds since start, RSSI (RSSI_NONE if unknown), and the
+#            byte lengths of the address and name and the service data entry
+#            count, followed by the address and name (UTF-8) and each entry
+#            as ENTRY (UUID length, data length), UUID, data.
+# UUIDs built on the Bluetooth base UUID are stored as their 16-bit short form.
+MAGIC = b"BLECAP\0\0"
+VERSION = 1
+HEADER = struct.Struct("<8sHd")
+RECORD = struct.Struct("<dbBBB")
+ENTRY = struct.Struct("<BB")
+RSSI_NONE = -128
+BASE_UUID = uuid.UUID("00000000-0000-1000-8000-00805f9b34fb")
+
+# Replaying as fast as possible still hands the event loop back this often
+# (in advertisements) so consumers and other tasks keep running
+REPLAY_YIELD_EVERY = 64
+
+# Stand-ins for the BLEDevice and AdvertisementData passed to a BleakScanner
+# detection callback, carrying the fields the handheld reads
+ReplayDevice = namedtuple("ReplayDevice", "address name")
+ReplayAdvertisement = namedtuple("ReplayAdvertisement", "local_name rssi service_data manufacturer_data tx_power")
+
+
+def _pack_uuid(text):
+    value = uuid.UUID(text)
+    if value.bytes[4:] == BASE_UUID.bytes[4:] and value.bytes[:2] == b"\0\0":
+        return value.bytes[2:4]
+    return value.bytes
+
+
+def _unpack_uuid(raw):
+    if len(raw) == 2:
+        return str(uuid.UUID(bytes=b"\0\0" + raw + BASE_UUID.bytes[4:]))
+    return str(uuid.UUID(bytes=raw))
+
+
+# Appends advertisements, as delivered to a detection callback, to a capture log
+class CaptureWriter:
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._start = time.monotonic()
+        self._file = open(path, "wb")
+        self._file.write(HEADER.pack(MAGIC, VERSION, time.time()))
+
+    # t is seconds since the capture started (default: now)
+    def write(self, device, adv_data, t=None):
+        if t is None:
+            t = time.monotonic() - self._start
+        address = (device.address or "").encode()
+        name = (device.name or "").encode()
+        rssi = RSSI_NONE if adv_data.rssi is None else adv_data.rssi
+        service_data = adv_data.service_data
+
+        parts = [RECORD.pack(t, rssi, len(address), len(name), len(service_data)), address, name]
+        for key, value in service_data.items():
+            raw = _pack_uuid(key)
+            parts.append(ENTRY.pack(len(raw), len(value)))
+            parts.append(raw)
+            parts.append(bytes(value))
+        self._file.write(b"".join(parts))
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Read a capture log into a list of (t, ReplayDevice, ReplayAdvertisement)
+def read_capture(path):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    magic, version, _ = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} advertisement capture")
+
+    records = []
+    offset = HEADER.size
+    while offset < len(data):
+        t, rssi, address_len, name_len, entries = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        address = data[offset:offset + address_len].decode()
+        offset += address_len
+        name = data[offset:offset + name_len].decode() or None
+        offset += name_len
+
+        service_data = {}
+        for _ in range(entries):
+            uuid_len, value_len = ENTRY.unpack_from(data, offset)
+            offset += ENTRY.size
+            key = _unpack_uuid(data[offset:offset + uuid_len])
+            offset += uuid_len
+            service_data[key] = data[offset:offset + value_len]
+            offset += value_len
+
+        records.append((t, ReplayDevice(address, name),
+                        ReplayAdvertisement(name, None if rssi == RSSI_NONE else rssi, service_data, {}, None)))
+    return records
+
+
+# Stand-in for BleakScanner that replays a capture into the detection
+# callback: at the recorded pace scaled by speed, or as fast as possible
+# when speed is 0. now() is the capture time of the replay, so code that
+# times its work with it behaves the same at any speed.
+class ReplayScanner:
+    def __init__(self, detection_callback=None, path=None, records=None, speed=1.0, **kwargs):
+        self.detection_callback = detection_callback
+        self.records = records if records is not None else read_capture(path)
+        self.speed = speed
+        self.delivered = 0
+        self.finished = asyncio.Event()
+        self._time = self.records[0][0] if self.records else 0.0
+        self._task = None
+
+    def now(self):
+        return self._time
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        first = self._time
+
+        for t, device, adv_data in self.records:
+            if self.speed:
+                delay = (t - first) / self.speed - (loop.time() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif self.delivered % REPLAY_YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+
+            self._time = t
+            self.delivered += 1
+            if self.detection_callback is not None:
+                self.detection_callback(device, adv_data)
+
+        self.finished.set()
+
+
+# A factory with BleakScanner's call signature that replays path instead
+def replay_scanner(path, speed=1.0):
+    return functools.partial(ReplayScanner, records=read_capture(path), speed=speed)
+
+
+# Summary of a capture: advertisements, duration, and per-device counts
+def describe(records):
+    devices = {}
+    for _, device, _ in records:
+        devices[device.address] = devices.get(device.address, 0) + 1
+    duration = records[-1][0] - records[0][0] if records else 0.0
+    return len(records), duration, devices
+
+
+async def record(path, duration, everything=False):
+    from bleak import BleakScanner
+
+    with CaptureWriter(path) as capture:
+        def callback(device, adv_data):
+            # Like main.py, only our beacons unless asked for everything
+            if everything or device.name == "blepos":
+                capture.write(device, adv_data)
+
+        async with BleakScanner(callback):
+            elapsed = 0.0
+            while duration is None or elapsed < duration:
+                await asyncio.sleep(1.0)
+                elapsed += 1.0
+                print(f"{elapsed:.0f}s: {capture.count} advertisements")
+    return capture.count
+
+
+#   python capture.py record advertisements.cap --duration 60
+#       Records advertisements (from beacons named "blepos", or every device
+#       with --all) until the duration passes or Ctrl-C.
+#   python capture.py info advertisements.cap
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Record and inspect BLE advertisement captures")
+    commands = parser.add_subparsers(dest="command", required=True)
+    rec = commands.add_parser("record", help="record advertisements from the radio")
+    rec.add_argument("capture")
+    rec.add_argument("--duration", type=float, help="seconds to record (default: until Ctrl-C)")
+    rec.add_argument("--all", action="store_true", help="record every device, not just beacons")
+    info = commands.add_parser("info", help="summarize a capture")
+    info.add_argument("capture")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        try:
+            asyncio.run(record(args.capture, args.duration, args.all))
+        except KeyboardInterrupt:
+            pass
+    else:
+        count, duration, devices = describe(read_capture(args.capture))
+        print(f"{count} advertisements from {len(devices)} devices over {duration:.1f} s")
+        for address, seen in sorted(devices.items()):
+            print(f"\t{address}: {seen}")
@@ -0,0 +1,35 @@
+from particle_filter import ParticleFilterEngine
+from fingerprint import FingerprintEngine
+
+# A position engine turns the SensorCache's filtered beacon state into a
+# Position (meters). Engines are plain objects with:
+#   name                     - identifier used in ENGINES and logs
+#   solve(beacons, now=None) - return a Position, or None if there is no fix;
+#                              now is a monotonic timestamp (default: now)
+#   reset()                  - forget any state carried between solves
+# PositionTracker calls solve() whenever new samples arrive.
+
+
+# Independent fix from the current beacon ranges on every solve
+class TrilaterationEngine:
+    name = "trilateration"
+
+    def solve(self, beacons, now=None):
+        return beacons.trilaterate()
+
+    def reset(self):
+        pass
+
+
+ENGINES = {
+    TrilaterationEngine.name: TrilaterationEngine,
+    ParticleFilterEngine.name: ParticleFilterEngine,
+    FingerprintEngine.name: FingerprintEngine,
+}
+
+
+# Build an engine by name, passing any engine-specific options through
+def create_engine(name, **options):
+    if name not in ENGINES:
+        raise ValueError(f"Unknown position engine {name!r}, expected one of {sorted(ENGINES)}")
+    return ENGINES[name](**options)
@@ -0,0 +1,185 @@
+import json
+import mmap
+import struct
+import time
+import numpy as np
+from position import Position
+
+# Fingerprint database layout (little-endian), written by compile_survey():
+#   header   MAGIC, version, point count P, beacon count B
+#   beacons  B x BEACON records: building, floor, north, east (px, as broadcast)
+#   points   P x POINT records: building, floor, north, east (meters)
+#   rssi     B x P int8 matrix of mean RSSI (dBm), one row per beacon so the
+#            columns for the beacons currently heard are contiguous reads
+# Points are sorted by (building, floor) so each floor is one column range.
+MAGIC = b"BLEFP\0\0\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIII")
+BEACON = struct.Struct("<HBxff")
+POINT = struct.Struct("<HBxff")
+
+# RSSI stored for a beacon that was not heard at a reference point. Treating
+# it as a very weak signal (rather than skipping it) penalizes reference
+# points where a beacon we hear now was absent.
+MISSING_RSSI = -100
+
+# Reference points averaged per estimate
+DEFAULT_K = 4
+# Only the strongest beacons heard in the last HEARD_WINDOW seconds are
+# matched. Far beacons have the noisiest RSSI and are the most likely to be
+# missing from a reference point; beacons we stopped hearing still hold the
+# RSSI from where we were until they expire from the cache.
+MATCH_BEACONS = 8
+HEARD_WINDOW = 2.0
+
+
+# Key used for beacons in survey files, matching static/beacons.js: "b,f,n,e"
+def beacon_id(key):
+    return ",".join(str(v) for v in key)
+
+
+def parse_beacon_id(text):
+    building_id, floor, north, east = text.split(",")
+    return int(building_id), int(floor), float(north), float(east)
+
+
+# Compile a survey (JSON lines written by survey.py, one reference point per
+# line: building, floor, north, east in meters and {beacon_id: mean RSSI})
+# into the binary database at path. Returns (points, beacons) written.
+def compile_survey(survey_path, path):
+    records = []
+    with open(survey_path) as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    records.sort(key=lambda r: (r["building"], r["floor"]))
+
+    beacons = sorted({parse_beacon_id(b) for r in records for b in r["rssi"]})
+    column = {key: i for i, key in enumerate(beacons)}
+
+    rssi = np.full((len(beacons), len(records)), MISSING_RSSI, dtype=np.int8)
+    for p, record in enumerate(records):
+        for b, value in record["rssi"].items():
+            rssi[column[parse_beacon_id(b)], p] = int(np.clip(round(value), -127, 0))
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records), len(beacons)))
+        for building_id, floor, north, east in beacons:
+            f.write(BEACON.pack(building_id, floor, north, east))
+        for r in records:
+            f.write(POINT.pack(r["building"], r["floor"], r["north"], r["east"]))
+        f.write(rssi.tobytes())
+
+    return len(records), len(beacons)
+
+
+# Read-only view of a compiled fingerprint database. The file is memory
+# mapped, so opening it is cheap and the RSSI matrix is paged in on demand
+# and shared between processes.
+class FingerprintDB:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, points, beacons = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} fingerprint database")
+
+        offset = HEADER.size
+        beacon_table = np.frombuffer(self._map, dtype=[("building", "<u2"), ("floor", "u1"), ("pad", "u1"),
+                                                       ("north", "<f4"), ("east", "<f4")],
+                                     count=beacons, offset=offset)
+        offset += beacons * BEACON.size
+        point_table = np.frombuffer(self._map, dtype=[("building", "<u2"), ("floor", "u1"), ("pad", "u1"),
+                                                      ("north", "<f4"), ("east", "<f4")],
+                                    count=points, offset=offset)
+        offset += points * POINT.size
+        self.rssi = np.frombuffer(self._map, dtype=np.int8, count=beacons * points, offset=offset).reshape(beacons, points)
+
+        # Beacon keys use the same float values the payload decoder produces
+        self.columns = {
+            (int(b), int(f), float(n), float(e)): i
+            for i, (b, f, _, n, e) in enumerate(beacon_table.tolist())
+        }
+        self.coords = np.column_stack((point_table["north"], point_table["east"])).astype(np.float64)
+
+        # Column range of each floor's reference points
+        self.floors = {}
+        keys = list(zip(point_table["building"].tolist(), point_table["floor"].tolist()))
+        for i, key in enumerate(keys):
+            start, _ = self.floors.get(key, (i, i))
+            self.floors[key] = (start, i + 1)
+
+    def __len__(self):
+        return self.coords.shape[0]
+
+    def close(self):
+        self.rssi = None
+        self._map.close()
+        self._file.close()
+
+    # Weighted k-nearest-neighbour position from heard beacons.
+    # keys/rssi: beacons heard now and their (filtered) RSSI. Only those
+    # columns are read; the distance to every reference point on the floor is
+    # computed in one pass and the k closest are averaged, weighted by
+    # inverse signal distance. Returns (north, east) in meters or None.
+    def lookup(self, building_id, floor, keys, rssi, k=DEFAULT_K):
+        span = self.floors.get((building_id, floor))
+        if span is None:
+            return None
+
+        known = [(self.columns[key], value) for key, value in zip(keys, rssi) if key in self.columns]
+        if not known:
+            return None
+        columns = np.array([c for c, _ in known], dtype=np.intp)
+        observed = np.array([v for _, v in known], dtype=np.float32)
+
+        start, stop = span
+        reference = self.rssi[columns, start:stop].astype(np.float32)
+        diff = reference - observed[:, None]
+        distance = np.einsum("ij,ij->j", diff, diff)
+
+        k = min(k, stop - start)
+        nearest = np.argpartition(distance, k - 1)[:k] if k < len(distance) else np.arange(len(distance))
+        weights = 1.0 / (np.sqrt(distance[nearest]) + 1e-6)
+        return weights @ self.coords[start + nearest] / weights.sum()
+
+
+# Position engine backed by a FingerprintDB (see engines.py)
+class FingerprintEngine:
+    name = "fingerprint"
+
+    def __init__(self, db, k=DEFAULT_K, match_beacons=MATCH_BEACONS):
+        self.db = db
+        self.k = k
+        self.match_beacons = match_beacons
+
+    def solve(self, beacons, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        table = beacons.table
+        rows = table.rows()
+        rows = rows[table.time[rows] >= now - HEARD_WINDOW]
+        if len(rows) == 0:
+            return None
+
+        # Match against the floor of the nearest beacon, like trilateration
+        nearest = rows[np.argmin(table.distance[rows])]
+        building_id = int(table.building[nearest])
+        floor = int(table.floor[nearest])
+        rows = rows[(table.building[rows] == building_id) & (table.floor[rows] == floor)]
+        if len(rows) > self.match_beacons:
+            rows = rows[np.argpartition(-table.avg_rssi[rows], self.match_beacons)[:self.match_beacons]]
+
+        result = self.db.lookup(building_id, floor, [table.keys[row] for row in rows], table.avg_rssi[rows], self.k)
+        if result is None:
+            return None
+
+        calc_pos = Position(float(result[0]), float(result[1]), building_id, floor)
+        beacons.last_position = calc_pos
+        return calc_pos
+
+    def reset(self):
+        pass
@@ -0,0 +1,91 @@
+import os
+import re
+import numpy as np
+from sensors import meters_to_px
+
+# Lazy import of Pillow, only needed to read floorplan images. Without it
+# position engines run without wall constraints.
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    Image = None
+    PIL_AVAILABLE = False
+
+# Raster resolution: one wall cell per WALL_CELL_PX floorplan pixels (~10 cm)
+WALL_CELL_PX = 10
+# Pixels darker than this are wall outlines. Door swings and windows are
+# drawn in grey on our floorplans, so they stay passable.
+WALL_LUMINANCE = 100
+
+# Floorplan files are named <building>-<floor>.png, e.g. 0001-04.png
+FLOORPLAN_NAME = re.compile(r"^(\d+)-(\d+)\.png$")
+
+
+# Boolean occupancy grid of walls for one floor, in the same frame as beacon
+# positions: row 0 is the bottom (south) edge of the floorplan image, and
+# one floorplan pixel is one map px. Everything outside the image is wall.
+class WallMap:
+    def __init__(self, walls, cell_px=WALL_CELL_PX):
+        self.walls = np.ascontiguousarray(walls, dtype=bool)
+        self.cell_px = cell_px
+        # Grid cells per meter
+        self.scale = meters_to_px(1) / cell_px
+        self.rows, self.cols = self.walls.shape
+
+    # Build from a floorplan image. A cell is wall if any of its pixels is dark.
+    @classmethod
+    def from_image(cls, path, cell_px=WALL_CELL_PX, luminance=WALL_LUMINANCE):
+        if not PIL_AVAILABLE:
+            raise RuntimeError("Pillow is required to load floorplan images")
+
+        # Floorplans are large, trusted local files
+        Image.MAX_IMAGE_PIXELS = None
+        with Image.open(path) as image:
+            gray = np.asarray(image.convert("L"))
+
+        rows = gray.shape[0] // cell_px
+        cols = gray.shape[1] // cell_px
+        # Crop from the top so cell row 0 stays aligned with the bottom edge
+        dark = gray[gray.shape[0] - rows * cell_px:, :cols * cell_px] < luminance
+        walls = dark.reshape(rows, cell_px, cols, cell_px).any(axis=(1, 3))
+        return cls(np.flipud(walls), cell_px)
+
+    def cells(self, points):
+        points = np.asarray(points, dtype=float)
+        n = np.floor(points[..., 0] * self.scale).astype(np.intp)
+        e = np.floor(points[..., 1] * self.scale).astype(np.intp)
+        return n, e
+
+    # True for every (north, east) point in meters that is a wall or off the map
+    def blocked(self, points):
+        n, e = self.cells(points)
+        inside = (n >= 0) & (n < self.rows) & (e >= 0) & (e < self.cols)
+        result = np.ones(n.shape, dtype=bool)
+        result[inside] = self.walls[n[inside], e[inside]]
+        return result
+
+    # True for every straight move from start[i] to end[i] (meters) that touches
+    # a wall cell. The path is sampled at least once per cell it can span.
+    def crosses(self, start, end):
+        start = np.asarray(start, dtype=float)
+        end = np.asarray(end, dtype=float)
+        longest = np.abs(end - start).max() if len(start) else 0.0
+        steps = max(1, int(np.ceil(longest * self.scale)) + 1)
+        t = np.linspace(0.0, 1.0, steps + 1)[None, :, None]
+        path = start[:, None, :] + (end - start)[:, None, :] * t
+        return self.blocked(path).any(axis=1)
+
+
+# Load every <building>-<floor>.png under directory into {(building, floor): WallMap}
+def load_wall_maps(directory, cell_px=WALL_CELL_PX):
+    maps = {}
+    if not PIL_AVAILABLE or not os.path.isdir(directory):
+        return maps
+
+    for name in sorted(os.listdir(directory)):
+        match = FLOORPLAN_NAME.match(name)
+        if match:
+            key = (int(match.group(1)), int(match.group(2)))
+            maps[key] = WallMap.from_image(os.path.join(directory, name), cell_px)
+    return maps
@@ -0,0 +1,382 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from quart import Quart, request, abort
+import log
+import metrics
+from beacon_table import BeaconTable
+from kalman import KalmanBank
+from calibration import CalibrationStore, TX_POWER, PATH_LOSS
+from sensors import convert_rssi_to_distance, px_to_meters, KALMAN_Q, KALMAN_R, MIN_DISTANCE, MAX_DISTANCE, MAX_GDOP
+from solver import solve_positions, range_weights
+
+# Multi-receiver fusion: positions tags centrally from RSSI observations sent
+# by many receivers. Two kinds of receiver report in the same batch format:
+#   - fixed scanners at a known position observing tags (the anchor is the
+#     scanner, the tags are whatever it hears)
+#   - handhelds observing beacons, as main.py does locally (the anchor is the
+#     beacon, the tag is the handheld itself)
+# Either way an observation is a link between a tag and an anchor at a known
+# (building, floor, north, east) position. Links from every receiver share
+# one table (a BeaconTable keyed by (tag, building, floor, north, east)), so
+# a tag heard by several scanners, or a handheld also heard by scanners, is
+# solved from all of them together.
+#
+# Observation batch (POST /observations, JSON; a list of batches is accepted
+# too). Positions are floorplan pixels like beacon keys, offsets are
+# milliseconds after t (Unix seconds):
+#   {"receiver": "scanner-12", "t": 1700000000.0, "anchor": [building, floor, north, east],
+#    "observations": [[tag, rssi, offset], ...]}
+#   {"receiver": "handheld-3", "t": 1700000000.0,
+#    "observations": [[[building, floor, north, east], rssi, offset], ...]}
+#
+# Every SOLVE_INTERVAL all tags are solved at once: each tag is placed on the
+# floor of its nearest link and solved from up to SOLVE_COUNT of its nearest
+# links on that floor by solver.solve_positions. Floors (building, floor)
+# are the shards: floors with at least POOL_MIN_TAGS tags are solved in a
+# process pool, one task per floor, smaller ones inline.
+#
+#   python fusion.py [--port 8090] [--workers N] [--store calibration.json]
+
+FUSION_PORT = 8090
+# Seconds without a sample before a link is dropped
+LINK_EXPIRY = 5.0
+# Seconds between solves of every tag
+SOLVE_INTERVAL = 0.5
+# Nearest links used per tag
+SOLVE_COUNT = 6
+# Worker processes (0 solves every floor inline), and the smallest floor
+# worth shipping to a worker
+POOL_WORKERS = os.cpu_count()
+POOL_MIN_TAGS = 500
+# Per-receiver calibration profiles (see calibration.py)
+CALIBRATION_STORE = "calibration.json"
+
+logger = logging.getLogger("fusion")
+
+# Collected whenever the service runs; updated per batch and per solve
+REGISTRY = metrics.Registry()
+BATCHES = REGISTRY.counter("fusion_batches_total", "Observation batches accepted")
+REJECTED = REGISTRY.counter("fusion_rejected_batches_total", "Observation batches that could not be parsed")
+OBSERVATIONS = REGISTRY.counter("fusion_observations_total", "RSSI observations recorded")
+SOLVE_SECONDS = REGISTRY.histogram("fusion_solve_seconds", "Time taken to solve every tag", metrics.SOLVE_BUCKETS)
+FIXES = REGISTRY.counter("fusion_fixes_total", "Tag positions solved")
+SOLVE_FAILURES = REGISTRY.counter("fusion_solve_failures_total", "Tag solves rejected for poor geometry")
+
+
+# BeaconTable with a tag column: one row per (tag, anchor) link
+class LinkTable(BeaconTable):
+    def __init__(self, **kwargs):
+        self.tag = np.zeros(0, dtype=np.int32)
+        super().__init__(**kwargs)
+
+    def _grow(self, capacity):
+        extra = capacity - self.capacity
+        if extra > 0:
+            self.tag = np.concatenate((self.tag, np.zeros(extra, dtype=np.int32)))
+        super()._grow(capacity)
+
+    def slot(self, key, profile=(TX_POWER, PATH_LOSS)):
+        row = super().slot(key, profile)
+        self.tag[row] = key[0]
+        return row
+
+
+# Convert a batch into (tag, anchor key, rssi, time) tuples.
+# Raises ValueError if the batch is malformed, including non-finite numbers
+# (a NaN time never expires and a NaN position never matches its own key)
+# and integers that do not fit their LinkTable column.
+def parse_batch(batch):
+    try:
+        receiver = str(batch["receiver"])
+        base = _finite(batch["t"])
+        anchor = batch.get("anchor")
+        if anchor is not None:
+            anchor = _anchor_key(anchor)
+            return receiver, [(str(tag), anchor, _integer(rssi, np.int16), base + _finite(offset) / 1000)
+                              for tag, rssi, offset in batch["observations"]]
+        return receiver, [(receiver, _anchor_key(beacon), _integer(rssi, np.int16), base + _finite(offset) / 1000)
+                          for beacon, rssi, offset in batch["observations"]]
+    except (KeyError, TypeError, ValueError, AttributeError, OverflowError) as e:
+        raise ValueError(f"Malformed observation batch: {e!r}") from None
+
+
+def _finite(value):
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"{value} is not a finite number")
+    return value
+
+
+# Column dtypes: building int32, floor int16, RSSI history int16
+def _integer(value, dtype):
+    value = int(_finite(value))
+    info = np.iinfo(dtype)
+    if not info.min <= value <= info.max:
+        raise ValueError(f"{value} is outside {info.min}..{info.max}")
+    return value
+
+
+def _anchor_key(anchor):
+    building_id, floor, loc_north, loc_east = anchor
+    return _integer(building_id, np.int32), _integer(floor, np.int16), _finite(loc_north), _finite(loc_east)
+
+
+# Shared per-tag state: the link table, tag names, and each tag's latest fix
+class FusionState:
+    def __init__(self, expiry=LINK_EXPIRY, store=None, solve_count=SOLVE_COUNT):
+        self.table = LinkTable(kalman=KalmanBank(q=KALMAN_Q, r=KALMAN_R))
+        self.expiry = expiry
+        self.solve_count = solve_count
+        self.store = store if store is not None else CalibrationStore("")
+        self.profiles = {}
+        self.tag_index = {}
+        self.tag_names = []
+        # tag -> latest fix as a dict (see apply())
+        self.positions = {}
+        self._json = None
+
+    def _tag(self, name):
+        index = self.tag_index.get(name)
+        if index is None:
+            index = self.tag_index[name] = len(self.tag_names)
+            self.tag_names.append(name)
+        return index
+
+    # Record a parsed or raw batch; returns the number of observations.
+    # Like SensorCache.record_sensors, all of them are filtered in one step.
+    def record(self, batch):
+        receiver, observations = batch if isinstance(batch, tuple) else parse_batch(batch)
+        profiles = self.profiles.get(receiver)
+        if profiles is None:
+            profiles = self.profiles[receiver] = self.store.profiles(receiver)
+
+        table = self.table
+        rows = []
+        values = []
+        times = []
+        for tag, anchor, rssi, t in observations:
+            key = (self._tag(tag),) + anchor
+            row = table.slots.get(key)
+            if row is None:
+                row = table.slot(key, profiles.lookup(anchor))
+            table.time[row] = t
+            rows.append(row)
+            values.append(rssi)
+            times.append(t)
+
+        if not rows:
+            return 0
+        rows = np.array(rows, dtype=np.intp)
+        table.kalman.update(rows, values, times)
+        filtered_rssi = table.kalman.x[rows]
+        table.avg_rssi[rows] = filtered_rssi
+        table.distance[rows] = np.clip(
+            convert_rssi_to_distance(filtered_rssi, table.tx_power[rows], table.path_loss[rows]),
+            MIN_DISTANCE, MAX_DISTANCE)
+        return len(rows)
+
+    # Drop links not heard from within the expiry, and the fixes of tags left without any
+    def expire(self, now):
+        table = self.table
+        stale = table.active & (table.time < now - self.expiry)
+        if not stale.any():
+            return
+        table.release(np.flatnonzero(stale))
+        heard = set(np.unique(table.tag[table.rows()]).tolist())
+        for index, name in enumerate(self.tag_names):
+            if index not in heard and name in self.positions:
+                del self.positions[name]
+                self._json = None
+
+    # Solve problems for every tag with at least three links on its floor,
+    # grouped by floor: a list of (building, floor, tag indices, points,
+    # distances, weights) padded as solve_positions expects
+    def shards(self):
+        table = self.table
+        rows = table.rows()
+        if not len(rows):
+            return []
+
+        # Group links by tag, nearest first
+        rows = rows[np.lexsort((table.distance[rows], table.tag[rows]))]
+        tags = table.tag[rows]
+        first = np.r_[True, tags[1:] != tags[:-1]]
+        group = np.cumsum(first) - 1
+        nearest = rows[first]
+
+        # Keep the links on the floor of each tag's nearest link, then the
+        # solve_count nearest of those
+        rows = rows[(table.building[rows] == table.building[nearest][group])
+                    & (table.floor[rows] == table.floor[nearest][group])]
+        tags = table.tag[rows]
+        first = np.r_[True, tags[1:] != tags[:-1]]
+        group = np.cumsum(first) - 1
+        rank = np.arange(len(rows)) - np.flatnonzero(first)[group]
+        keep = rank < self.solve_count
+        rows, group, rank = rows[keep], group[keep], rank[keep]
+
+        count = len(nearest)
+        points = np.zeros((count, self.solve_count, 2))
+        distances = np.zeros((count, self.solve_count))
+        weights = np.zeros((count, self.solve_count))
+        points[group, rank, 0] = px_to_meters(table.north[rows])
+        points[group, rank, 1] = px_to_meters(table.east[rows])
+        distances[group, rank] = table.distance[rows]
+        weights[group, rank] = range_weights(table.distance[rows], table.kalman.p[rows], table.path_loss[rows])
+
+        solvable = np.bincount(group, minlength=count) >= 3
+        tag_ids = table.tag[nearest]
+        building = table.building[nearest]
+        floor = table.floor[nearest]
+
+        result = []
+        for building_id, floor_id in set(zip(building[solvable].tolist(), floor[solvable].tolist())):
+            on_floor = solvable & (building == building_id) & (floor == floor_id)
+            result.append((building_id, floor_id, tag_ids[on_floor],
+                           points[on_floor], distances[on_floor], weights[on_floor]))
+        return result
+
+    # Store the solved positions of one shard. Tags whose geometry is worse
+    # than MAX_GDOP keep their previous fix.
+    def apply(self, building_id, floor, tags, positions, dop, now):
+        good = dop <= MAX_GDOP
+        FIXES.inc(int(good.sum()))
+        SOLVE_FAILURES.inc(int((~good).sum()))
+        names = self.tag_names
+        for tag, (loc_north, loc_east), tag_dop in zip(tags[good].tolist(), positions[good].tolist(), dop[good].tolist()):
+            self.positions[names[tag]] = {
+                "tag": names[tag],
+                "building_id": building_id,
+                "floor": floor,
+                "loc_north": loc_north,
+                "loc_east": loc_east,
+                "gdop": round(tag_dop, 3),
+                "time": now,
+            }
+        self._json = None
+
+    # Every tag's latest fix, serialized once per solve
+    def json(self):
+        if self._json is None:
+            self._json = json.dumps(list(self.positions.values()))
+        return self._json
+
+
+# Solves every tag on a schedule, shipping large floors to a process pool
+class FusionService:
+    def __init__(self, state, workers=POOL_WORKERS, min_pool_tags=POOL_MIN_TAGS, interval=SOLVE_INTERVAL):
+        self.state = state
+        self.interval = interval
+        self.min_pool_tags = min_pool_tags
+        self.executor = ProcessPoolExecutor(workers) if workers else None
+        self.solves = 0
+
+    async def solve(self, now=None):
+        if now is None:
+            now = time.time()
+        started = time.perf_counter()
+        state = self.state
+        state.expire(now)
+
+        loop = asyncio.get_running_loop()
+        pooled = []
+        for building_id, floor, tags, points, distances, weights in state.shards():
+            if self.executor is not None and len(tags) >= self.min_pool_tags:
+                job = loop.run_in_executor(self.executor, solve_positions, points, distances, weights)
+                pooled.append((building_id, floor, tags, job))
+            else:
+                state.apply(building_id, floor, tags, *solve_positions(points, distances, weights), now)
+        for building_id, floor, tags, job in pooled:
+            state.apply(building_id, floor, tags, *await job, now)
+
+        self.solves += 1
+        SOLVE_SECONDS.observe(time.perf_counter() - started)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            try:
+                await self.solve()
+            except Exception:
+                logger.exception("Fusion solve failed")
+            await asyncio.sleep(max(0.0, self.interval - (loop.time() - started)))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+
+def create_app(service):
+    app = Quart(__name__)
+    state = service.state
+
+    @app.route("/observations", methods=["POST"])
+    async def post_observations():
+        try:
+            batches = json.loads(await request.get_data())
+            if isinstance(batches, dict):
+                batches = [batches]
+            if not isinstance(batches, list) or not all(isinstance(batch, dict) for batch in batches):
+                raise ValueError("Expected a batch object or a list of them")
+            parsed = [parse_batch(batch) for batch in batches]
+        except ValueError as e:
+            REJECTED.inc()
+            log.event(logger, logging.WARNING, "malformed", "Rejected observation batch",
+                      key=request.remote_addr, error=str(e))
+            abort(400)
+        accepted = sum(state.record(batch) for batch in parsed)
+        BATCHES.inc(len(parsed))
+        OBSERVATIONS.inc(accepted)
+        return {"accepted": accepted}
+
+    @app.route("/tags", methods=["GET"])
+    async def get_tags():
+        return state.json(), {"Content-Type": "application/json"}
+
+    @app.route("/tags/<tag>", methods=["GET"])
+    async def get_tag(tag):
+        fix = state.positions.get(tag)
+        if fix is None:
+            abort(404)
+        return fix
+
+    @app.route("/metrics", methods=["GET"])
+    async def get_metrics():
+        return REGISTRY.render(), {"Content-Type": "text/plain; version=0.0.4"}
+
+    return app
+
+
+async def serve(port=FUSION_PORT, workers=POOL_WORKERS, store=CALIBRATION_STORE):
+    logs = log.Logging()
+    state = FusionState(store=CalibrationStore.load(store))
+    service = FusionService(state, workers)
+    REGISTRY.gauge("fusion_tags", "Tags with a current fix", lambda: len(state.positions))
+    REGISTRY.gauge("fusion_links", "Tag-anchor links currently tracked", lambda: len(state.table))
+
+    solve_task = asyncio.create_task(service.run())
+    logger.info(f"Fusion service listening on port {port} with {workers} solver processes")
+    try:
+        await create_app(service).run_task(host="0.0.0.0", port=port)
+    finally:
+        solve_task.cancel()
+        service.close()
+        logs.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fuse RSSI observations from many receivers into tag positions")
+    parser.add_argument("--port", type=int, default=FUSION_PORT)
+    parser.add_argument("--workers", type=int, default=POOL_WORKERS,
+                        help="solver processes (0 solves every floor in the server process)")
+    parser.add_argument("--store", default=CALIBRATION_STORE, help="calibration store with receiver profiles")
+    args = parser.parse_args()
+    asyncio.run(serve(args.port, args.workers, args.store))
@@ -0,0 +1,120 @@
+import asyncio
+import payload as ips
+import metrics
+
+# What to do when an advertisement arrives and the queue is full
+DROP_OLDEST = "drop_oldest"  # Overwrite the oldest queued advertisement (favor fresh RSSI)
+DROP_NEWEST = "drop_newest"  # Discard the incoming advertisement
+
+
+# Bounded ring queue of raw advertisements.
+# The BleakScanner callback only calls put(), which stores a reference to
+# the (address, service_data bytes, rssi, monotonic time) tuple and returns.
+# A consumer task drains the queue in batches and does the real work.
+class AdvertisementQueue:
+    def __init__(self, capacity=4096, overflow=DROP_OLDEST):
+        if overflow not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+
+        self.capacity = capacity
+        self.overflow = overflow
+        self._buffer = [None] * capacity
+        self._head = 0  # Index of the oldest item
+        self._size = 0
+        self._ready = asyncio.Event()
+
+        # Counters
+        self.enqueued = 0    # Advertisements accepted into the queue
+        self.dropped = 0     # Advertisements lost to overflow
+        self.overflows = 0   # Number of times the queue went from not full to full
+        self.high_water = 0  # Largest depth seen
+
+    def __len__(self):
+        return self._size
+
+    def put(self, item):
+        if self._size == self.capacity:
+            self.dropped += 1
+            if self.overflow == DROP_NEWEST:
+                return False
+            # Overwrite the oldest item in place
+            self._buffer[self._head] = item
+            self._head = (self._head + 1) % self.capacity
+            self.enqueued += 1
+            return True
+
+        self._buffer[(self._head + self._size) % self.capacity] = item
+        self._size += 1
+        self.enqueued += 1
+        if self._size > self.high_water:
+            self.high_water = self._size
+        if self._size == self.capacity:
+            self.overflows += 1
+        self._ready.set()
+        return True
+
+    # Remove and return up to max_items of the oldest advertisements
+    def drain(self, max_items=None):
+        count = self._size if max_items is None else min(max_items, self._size)
+        start = self._head
+        end = start + count
+        if end <= self.capacity:
+            items = self._buffer[start:end]
+            self._buffer[start:end] = [None] * count
+        else:
+            end -= self.capacity
+            items = self._buffer[start:] + self._buffer[:end]
+            self._buffer[start:] = [None] * (self.capacity - start)
+            self._buffer[:end] = [None] * end
+
+        self._head = end % self.capacity
+        self._size -= count
+        if self._size == 0:
+            self._ready.clear()
+        return items
+
+    async def wait(self):
+        await self._ready.wait()
+
+    def stats(self):
+        return {
+            "depth": self._size,
+            "capacity": self.capacity,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "overflows": self.overflows,
+            "high_water": self.high_water,
+        }
+
+
+# Decode a drained batch of advertisements and feed the cache.
+# on_malformed(address, payload, rssi) is called for payloads we can't decode.
+# Returns the number of samples recorded.
+def record_batch(batch, beacons, on_malformed=None):
+    samples = []
+    for address, payload, rssi, timestamp in batch:
+        key = ips.decode(payload)
+        if key is None:
+            if metrics.ENABLED:
+                metrics.MALFORMED.inc()
+            if on_malformed:
+                on_malformed(address, payload, rssi)
+            continue
+        samples.append((key, rssi, timestamp))
+
+    beacons.record_sensors(samples)
+    return len(samples)
+
+
+# Drain the queue in batches and record them (see record_batch).
+# on_batch() is called after each batch has been recorded.
+async def consume(queue, beacons, batch_size=256, on_malformed=None, on_batch=None):
+    while True:
+        await queue.wait()
+        batch = queue.drain(batch_size)
+
+        if record_batch(batch, beacons, on_malformed) and on_batch:
+            on_batch()
+
+        # Let the scanner and web server run between batches
+        await asyncio.sleep(0)
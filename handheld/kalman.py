@@ -1,23 +1,94 @@
-class Kalman1D:
-    def __init__(self, q=0.3, r=9.0, initial_value=None):
-        self.q = q          # Process noise
+import numpy as np
+
+
+# One predict + update step of a scalar random-walk Kalman filter.
+# Works on plain floats as well as NumPy arrays of states.
+def kalman_step(x, p, measurement, q, r):
+    # Prediction step
+    p_pred = p + q
+
+    # Kalman gain
+    k = p_pred / (p_pred + r)
+
+    # Update step
+    x = x + k * (measurement - x)
+    p = (1 - k) * p_pred
+
+    return x, p
+
+
+# A bank of independent 1D Kalman filters, one per slot, with the state for
+# every slot held in arrays so a whole batch of measurements is filtered in
+# a single vectorized step.
+class KalmanBank:
+    def __init__(self, size=0, q=0.3, r=9.0, time_scaled=False):
+        self.q = q          # Process noise (per update, or per second if time_scaled)
         self.r = r          # Measurement noise
-        self.x = initial_value  # State estimate
-        self.p = 1.0        # Estimate uncertainty
+        # When time_scaled is set, process noise grows with the time since a
+        # slot's last update, so a beacon we haven't heard from in a while
+        # trusts its next measurement more.
+        self.time_scaled = time_scaled
+
+        self.x = np.full(size, np.nan)  # State estimates (NaN until first measurement)
+        self.p = np.ones(size)          # Estimate uncertainty
+        self.t = np.zeros(size)         # Time of each slot's last update
+
+    def __len__(self):
+        return len(self.x)
+
+    def resize(self, size):
+        extra = size - len(self.x)
+        if extra <= 0:
+            return
+        self.x = np.concatenate((self.x, np.full(extra, np.nan)))
+        self.p = np.concatenate((self.p, np.ones(extra)))
+        self.t = np.concatenate((self.t, np.zeros(extra)))
+
+    # Forget the state of the given slots
+    def reset(self, indices):
+        self.x[indices] = np.nan
+        self.p[indices] = 1.0
+        self.t[indices] = 0
+
+    # Apply a batch of measurements. indices, measurements and (optionally)
+    # timestamps are equal-length sequences. A slot may appear more than
+    # once; its measurements are applied in the order given.
+    # Returns the filtered value after each measurement.
+    def update(self, indices, measurements, timestamps=None):
+        indices = np.asarray(indices, dtype=np.intp)
+        measurements = np.asarray(measurements, dtype=float)
+        if timestamps is not None:
+            timestamps = np.asarray(timestamps, dtype=float)
+        out = np.empty(len(indices))
+        if len(indices) == 0:
+            return out
+
+        # Split the batch into rounds so each slot appears at most once per
+        # round. Round k holds every slot's k-th measurement.
+        order = np.argsort(indices, kind='stable')
+        sorted_idx = indices[order]
+        starts = np.flatnonzero(np.r_[True, sorted_idx[1:] != sorted_idx[:-1]])
+        rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
 
-    def update(self, measurement):
-        if self.x is None:
-            self.x = measurement
-            return self.x
+        for k in range(rank.max() + 1):
+            sel = order[rank == k]
+            idx = indices[sel]
+            z = measurements[sel]
 
-        # Prediction step
-        p_pred = self.p + self.q
+            q = self.q
+            if self.time_scaled and timestamps is not None:
+                q = self.q * np.maximum(timestamps[sel] - self.t[idx], 0)
 
-        # Kalman gain
-        k = p_pred / (p_pred + self.r)
+            x, p = kalman_step(self.x[idx], self.p[idx], z, q, self.r)
+            # The first measurement of a slot initializes its state directly
+            fresh = np.isnan(self.x[idx])
+            x[fresh] = z[fresh]
+            p[fresh] = self.p[idx][fresh]
 
-        # Update step
-        self.x = self.x + k * (measurement - self.x)
-        self.p = (1 - k) * p_pred
+            self.x[idx] = x
+            self.p[idx] = p
+            if timestamps is not None:
+                self.t[idx] = timestamps[sel]
+            out[sel] = x
 
-        return self.x
\ No newline at end of file
+        return out
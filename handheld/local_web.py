@@ -1,19 +1,36 @@
-from quart import Quart
+from quart import Quart, make_response, abort
 import json
+import logging
 import position
 import asyncio
 from sensors import SensorCache
+from tracker import PositionTracker
+from stream import LiveStream
+import metrics
+
+# Seconds between keep-alive comments on idle /stream connections
+STREAM_KEEPALIVE = 15
+
+logger = logging.getLogger("local_web")
 
 class API:
-    def __init__(self, pos, beacons):
+    def __init__(self, pos, beacons, tracker):
         if type(pos) is not position.Position:
             return
 
         if type(beacons) is not SensorCache:
             return
 
+        if type(tracker) is not PositionTracker:
+            return
+
         self.position = pos
         self.beacons = beacons
+        self.tracker = tracker
+
+        # Push position and beacon changes to /stream subscribers after every solve
+        self.stream = LiveStream(beacons)
+        tracker.listeners.append(self.stream.on_fix)
 
         # Use webroot for static files instead of /static/
         self.app = Quart(__name__, static_url_path='')
@@ -28,21 +45,44 @@ class API:
 
         @self.app.route("/json", methods=["GET"])
         async def get_position():
-            beacons.clear_old_sensors()
-            calc_pos = beacons.trilaterate()
-            if calc_pos is None:
-                return json.dumps({"x": 0, "y": 0, "xm": 0, "ym": 0})
-            x = calc_pos.loc_north
-            y = calc_pos.loc_east
-            if x is None: x = 0
-            if y is None: y = 0
-            return json.dumps({"x": x * 98.4252, "y": y * 98.4252, "xm": x, "ym": y})
+            # Serve the tracker's latest pre-serialized fix; solving happens in the background
+            return self.tracker.latest.json
 
         @self.app.route("/beacons", methods=["GET"])
         async def get_beacons():
             return self.beacons.json()
 
-        print("Webserver Initialized. Visit http://localhost:5000/")
+        # Server-Sent Events stream of "position" and "beacons" (delta) events
+        @self.app.route("/stream", methods=["GET"])
+        async def get_stream():
+            async def events():
+                queue = self.stream.subscribe()
+                try:
+                    for event in self.stream.snapshot():
+                        yield event
+                    while True:
+                        try:
+                            yield await asyncio.wait_for(queue.get(), timeout=STREAM_KEEPALIVE)
+                        except asyncio.TimeoutError:
+                            yield ": keep-alive\n\n"
+                finally:
+                    self.stream.unsubscribe(queue)
+
+            response = await make_response(events(), {
+                "Content-Type": "text/event-stream",
+                "Cache-Control": "no-cache",
+            })
+            response.timeout = None
+            return response
+
+        # Prometheus scrape target; absent when metrics are disabled
+        @self.app.route("/metrics", methods=["GET"])
+        async def get_metrics():
+            if not metrics.ENABLED:
+                abort(404)
+            return metrics.REGISTRY.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+        logger.info("Webserver Initialized. Visit http://localhost:5000/")
 
     async def run(self):
         await self.app.run_task()
\ No newline at end of file
@@ -0,0 +1,204 @@
+import asyncio
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+import tty_color as color
+
+# Logging for the handheld. Records are handed to a QueueHandler, which only
+# appends them to an in-memory queue; a QueueListener thread formats and
+# writes them, so the event loop never blocks on stdout.
+#
+# Log repeatable messages through event() with a kind (the message type the
+# POLICIES below rate limit and sample), an optional key (e.g. a MAC address)
+# and structured fields. The rate limit is checked before anything else, so
+# a noisy beacon costs a dict lookup per message instead of a terminal
+# write; pass fields as a callable to defer building them the same way:
+#   log.event(logger, logging.WARNING, "malformed", "Malformed payload", key=address, rssi=rssi)
+
+# kind: (messages let through per key per window, window seconds, sample 1 in N)
+POLICIES = {
+    "malformed": (3, 60.0, 1),
+    "advertisement": (1, 5.0, 1),
+    "solve_failure": (1, 10.0, 1),
+    "telemetry": (1, 0.0, 10),
+    "telemetry_failure": (1, 30.0, 1),
+}
+# How often summaries of suppressed messages are written (seconds)
+SUMMARY_INTERVAL = 60.0
+
+LEVEL_COLORS = {
+    logging.DEBUG: color.gray,
+    logging.INFO: color.green,
+    logging.WARNING: color.yellow,
+    logging.ERROR: color.red,
+    logging.CRITICAL: color.red,
+}
+
+# RateLimiter consulted by event(), installed by Logging
+_rate_limit = None
+
+
+def event(logger, level, kind, message, key=None, fields=None, **more_fields):
+    if not logger.isEnabledFor(level):
+        return
+    suppressed = 0
+    if _rate_limit is not None:
+        suppressed = _rate_limit.allow(kind, key)
+        if suppressed is None:
+            return
+    fields = dict(fields() if callable(fields) else fields or {}, **more_fields)
+    logger.log(level, message, extra={"kind": kind, "key": key, "fields": fields, "suppressed": suppressed})
+
+
+# Lets through at most `burst` messages per (kind, key) per window, and of
+# those only every Nth when sampling. Suppressed messages are counted; the
+# next message let through for that key carries the count, and summaries()
+# reports counts for keys that went quiet.
+class RateLimiter:
+    def __init__(self, policies=POLICIES, clock=time.monotonic):
+        self.policies = policies
+        self.clock = clock
+        # (kind, key) -> [window start, passed in window, seen, suppressed]
+        self.state = {}
+
+    # None if the message is suppressed, otherwise how many were suppressed
+    # since the last one let through
+    def allow(self, kind, key):
+        policy = self.policies.get(kind)
+        if policy is None:
+            return 0
+        burst, window, sample_every = policy
+
+        now = self.clock()
+        entry = self.state.get((kind, key))
+        if entry is None:
+            entry = self.state[(kind, key)] = [now, 0, 0, 0]
+        elif window and now - entry[0] >= window:
+            entry[0] = now
+            entry[1] = 0
+
+        entry[2] += 1
+        limited = window and entry[1] >= burst
+        sampled_out = (entry[2] - 1) % sample_every
+        if limited or sampled_out:
+            entry[3] += 1
+            return None
+
+        entry[1] += 1
+        suppressed = entry[3]
+        entry[3] = 0
+        return suppressed
+
+    # Summary records for keys with suppressed messages whose window has ended
+    def summaries(self):
+        now = self.clock()
+        records = []
+        for (kind, key), entry in self.state.items():
+            _, window, _ = self.policies[kind]
+            if entry[3] and (not window or now - entry[0] >= window):
+                records.append(logging.makeLogRecord({
+                    "name": "log", "levelno": logging.INFO, "levelname": "INFO",
+                    "msg": f"Suppressed {entry[3]} {kind} messages",
+                    "kind": "summary", "key": key, "fields": {"kind": kind}, "suppressed": entry[3],
+                }))
+                entry[3] = 0
+        return records
+
+
+def _fields(record):
+    fields = dict(getattr(record, "fields", None) or {})
+    if getattr(record, "key", None) is not None:
+        fields = {"key": record.key, **fields}
+    if getattr(record, "suppressed", 0):
+        fields["suppressed"] = record.suppressed
+    return fields
+
+
+# One line per record: time, level, message and key=value fields.
+# Colored with tty_color when use_color is set (only for terminals).
+class TextFormatter(logging.Formatter):
+    def __init__(self, use_color=False):
+        super().__init__()
+        self.use_color = use_color
+
+    def format(self, record):
+        stamp = time.strftime("%H:%M:%S", time.localtime(record.created))
+        level = f"{record.levelname:<7}"
+        message = record.getMessage()
+        fields = _fields(record).items()
+        if self.use_color:
+            level = LEVEL_COLORS.get(record.levelno, str)(level)
+            fields = " ".join(f"{color.blue(name)}={color.yellow(value)}" for name, value in fields)
+        else:
+            fields = " ".join(f"{name}={value}" for name, value in fields)
+        line = f"{stamp} {level} {message}"
+        if fields:
+            line += " " + fields
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+# JSON lines, for files and log collectors
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "kind": getattr(record, "kind", None),
+            "message": record.getMessage(),
+            **_fields(record),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Installs the queue handler on the root logger and starts the listener.
+# sink is a stream or a logging.Handler; text output is colored only when the
+# stream is a TTY. Call stop() on exit to flush what is still queued.
+class Logging:
+    def __init__(self, sink=None, level=logging.INFO, json_format=False, policies=POLICIES):
+        if sink is None:
+            sink = sys.stderr
+        if isinstance(sink, logging.Handler):
+            handler = sink
+            is_tty = False
+        else:
+            handler = logging.StreamHandler(sink)
+            is_tty = hasattr(sink, "isatty") and sink.isatty()
+        handler.setFormatter(JsonFormatter() if json_format else TextFormatter(use_color=is_tty))
+        self.handler = handler
+
+        global _rate_limit
+        self.rate_limit = _rate_limit = RateLimiter(policies)
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = logging.handlers.QueueHandler(self.queue)
+        self.listener = logging.handlers.QueueListener(self.queue, handler)
+
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(self.queue_handler)
+        self.listener.start()
+
+    # Queue a summary of suppressed messages
+    def summarize(self):
+        for record in self.rate_limit.summaries():
+            self.queue.put_nowait(record)
+
+    async def run_summaries(self, interval=SUMMARY_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            self.summarize()
+
+    def stop(self):
+        global _rate_limit
+        self.summarize()
+        logging.getLogger().removeHandler(self.queue_handler)
+        self.listener.stop()
+        if _rate_limit is self.rate_limit:
+            _rate_limit = None
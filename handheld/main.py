@@ -1,117 +1,225 @@
 import asyncio
 # Use the Bluetooth Low Energy platform Agnostic Klient (BLEAK) library
 from bleak import BleakScanner
-import tty_color as color
+import logging
+import log
 from position import Position
 from local_web import API
 from sensors import SensorCache
-from numpy import frombuffer, astype
-from azure_iot import AzureDevice
+from beacon_registry import BeaconRegistry
+from tracker import PositionTracker, publish_telemetry
+from engines import create_engine
+from floorplan import load_wall_maps
+from fingerprint import FingerprintDB
+from azure_iot import AzureDevice, TelemetryUploader, telemetry_record, DEVICE_ID
+from calibration import CalibrationStore
+from ingest import AdvertisementQueue, consume, DROP_OLDEST
+from capture import CaptureWriter
+import payload as ips
+import metrics
 import os
+import time
 
+# Log every advertisement (rate limited per device) at DEBUG level
 DEBUG = False
+# Log sink: a stream or logging.Handler, and whether to write JSON lines
+LOG_SINK = None  # stderr
+LOG_JSON = False
+
+logger = logging.getLogger("main")
+
+# Advertisements waiting to be decoded. When full, INGEST_OVERFLOW decides
+# whether the oldest queued or the incoming advertisement is dropped.
+INGEST_QUEUE_SIZE = 4096
+INGEST_OVERFLOW = DROP_OLDEST
+# Maximum advertisements decoded and filtered per batch
+INGEST_BATCH_SIZE = 256
+
+# Upper bound on position solves per second, however fast samples arrive
+SOLVE_MAX_RATE = 4.0
+# "trilateration" for independent fixes, "particle" for a particle filter
+# that tracks motion and respects the walls drawn in FLOORPLANS, or
+# "fingerprint" to match against a surveyed FINGERPRINT_DB (see survey.py)
+POSITION_ENGINE = "trilateration"
+PARTICLE_COUNT = 10000
+FLOORPLANS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "floorplans")
+FINGERPRINT_DB = "fingerprints.bin"
+# Seconds between queueing the latest position for upload
+TELEMETRY_INTERVAL = 5.0
+# Positions per uploaded message, and the longest a queued position waits to be sent
+TELEMETRY_BATCH_SIZE = 12
+TELEMETRY_FLUSH_INTERVAL = 60.0
+# Positions that cannot be sent (offline, or queue overflow) are kept here
+TELEMETRY_SPOOL = "telemetry.spool"
+# "json", or "binary" for compact messages on metered links (see telemetry_codec.py)
+TELEMETRY_FORMAT = "json"
+
+# Per-beacon TX power and path loss written by txandncal.py, and the receiver
+# (this handheld) whose profiles to use
+CALIBRATION_STORE = "calibration.json"
+RECEIVER_ID = DEVICE_ID
+
+# Collect counters and latency histograms, served at /metrics. When False
+# the instrumented paths skip all metric updates.
+METRICS = True
+
+# Set to a file name to record every beacon advertisement to a capture log
+# for replay.py (see capture.py)
+CAPTURE_FILE = None
+
+# Floorplan beacon positions, used to index beacons spatially for selection
+BEACON_REGISTRY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "beacons.json")
 
 # TODO LIST
 # Test trilateration
 
 async def main():
-    print("CNIT 546 BLE Positioning")
-    print("")
-    print("Scan Results:")
+    logs = log.Logging(LOG_SINK, logging.DEBUG if DEBUG else logging.INFO, LOG_JSON)
+    summary_task = asyncio.create_task(logs.run_summaries())
+    logger.info("CNIT 546 BLE Positioning")
 
     # Store calculated position value
     pos = Position()
 
+    metrics.ENABLED = METRICS
 
-    az = AzureDevice(os.getenv("AZURE_IOT_CONNECTION_STRING"))
 
-    def on_trilaterate(calc_pos):
-        az.send_telemetry(calc_pos)
+    az = AzureDevice(os.getenv("AZURE_IOT_CONNECTION_STRING"), telemetry_format=TELEMETRY_FORMAT)
 
-    beacons = SensorCache(15, on_trilaterate)
+    beacons = configured_cache()
+
+    # Solve in the background whenever new samples arrive, and upload
+    # the latest position on its own schedule
+    tracker = PositionTracker(beacons, SOLVE_MAX_RATE, engine=configured_engine())
+    tracker_task = asyncio.create_task(tracker.run())
+    uploader = TelemetryUploader(az.send_batch, TELEMETRY_SPOOL, TELEMETRY_BATCH_SIZE, TELEMETRY_FLUSH_INTERVAL)
+    uploader_task = asyncio.create_task(uploader.run())
+    telemetry_task = asyncio.create_task(publish_telemetry(
+        tracker, lambda calc_pos: uploader.submit(telemetry_record(calc_pos)), TELEMETRY_INTERVAL))
 
     # Create Quart endpoint
-    web = API(pos, beacons)
+    web = API(pos, beacons, tracker)
     server_task = asyncio.create_task(web.run())
 
     # Reference: https://bleak.readthedocs.io/en/latest/api/scanner.html#starting-and-stopping
     stop_event = asyncio.Event()
 
+    # Advertisements are handed off to a separate task for decoding so the
+    # scanner callback never blocks the event loop shared with the web server
+    queue = AdvertisementQueue(INGEST_QUEUE_SIZE, INGEST_OVERFLOW)
+    ingest_task = asyncio.create_task(
+        consume(queue, beacons, INGEST_BATCH_SIZE, on_malformed=log_malformed, on_batch=tracker.notify))
+
+    if metrics.ENABLED:
+        register_gauges(queue, beacons, tracker, uploader)
+        metrics_task = asyncio.create_task(metrics.monitor_event_loop())
+
+    capture = CaptureWriter(CAPTURE_FILE) if CAPTURE_FILE else None
+    try:
+        async with BleakScanner(scan_callback(queue, capture=capture)) as scanner:
+            await stop_event.wait()
+    finally:
+        if capture is not None:
+            capture.close()
+        logs.stop()
+
+
+# Expose state the pipeline components already track as scrape-time metrics
+def register_gauges(queue, beacons, tracker, uploader):
+    registry = metrics.REGISTRY
+    registry.gauge("ble_ingest_queue_depth", "Advertisements waiting to be decoded", lambda: len(queue))
+    registry.gauge("ble_ingest_dropped_total", "Advertisements lost to ingest queue overflow",
+                   lambda: queue.dropped, kind="counter")
+    registry.gauge("ble_cached_beacons", "Beacons currently in the sensor cache", lambda: len(beacons.table))
+    registry.gauge("ble_solves_total", "Position solves attempted", lambda: tracker.solves, kind="counter")
+    registry.gauge("ble_telemetry_queue_depth", "Positions waiting to be uploaded", lambda: len(uploader.queue))
+    registry.gauge("ble_telemetry_spool_depth", "Positions spooled to disk awaiting upload",
+                   lambda: uploader.spool_depth)
+
+
+# SensorCache with the beacon registry and this receiver's calibration profiles
+def configured_cache():
+    registry = BeaconRegistry.load(BEACON_REGISTRY) if os.path.exists(BEACON_REGISTRY) else BeaconRegistry()
+    profiles = CalibrationStore.load(CALIBRATION_STORE).profiles(RECEIVER_ID)
+    logger.info(f"Loaded {len(profiles)} beacon calibration profiles for {RECEIVER_ID}")
+    return SensorCache(15, registry=registry, profiles=profiles)
+
+
+# The position engine selected by POSITION_ENGINE
+def configured_engine(name=POSITION_ENGINE):
+    if name == "particle":
+        return create_engine(name, count=PARTICLE_COUNT, wall_maps=load_wall_maps(FLOORPLANS))
+    if name == "fingerprint":
+        return create_engine(name, db=FingerprintDB(FINGERPRINT_DB))
+    return create_engine(name)
+
+
+# Build the BleakScanner detection callback, which queues Indoor Positioning
+# payloads stamped with clock() for the ingest task. With a CaptureWriter,
+# every beacon advertisement is also recorded. replay.py drives this same
+# callback from a capture.
+def scan_callback(queue, clock=time.monotonic, capture=None):
     # device: https://bleak.readthedocs.io/en/latest/api/index.html#bleak.backends.device.BLEDevice
     # adv_data: https://bleak.readthedocs.io/en/latest/backends/index.html#bleak.backends.scanner.AdvertisementData
     def callback(device, adv_data):
         if device.name != "blepos":
             return
 
+        if capture is not None:
+            capture.write(device, adv_data)
 
         for uuid, value in adv_data.service_data.items():
             # Check if this is the Indoor Positioning Service
-            if uuid[4:8] == "1821" and len(value) == 7:
-                building_id = int.from_bytes(value[0:2], byteorder='big')
-                floor = value[2]
-                # Use numpy float16 type based on big-endian buffer
-                # ">f2" : '>' means big endian, 'f' means float, '2' means 2 bytes
-                # Once we have float16, convert to native float for more precise math
-                loc_north = frombuffer(value[3:5], dtype=">f2")[0].astype(float)
-                loc_east = frombuffer(value[5:7], dtype=">f2")[0].astype(float)
-
-                beacons.record_sensor(Position(loc_north, loc_east, building_id, floor), adv_data.rssi)
+            if ips.is_indoor_positioning(uuid):
+                # Enqueue a reference to the raw payload; decoding happens in the ingest task
+                queue.put((device.address, value, adv_data.rssi, clock()))
+                if metrics.ENABLED:
+                    metrics.ADVERTISEMENTS.inc()
 
                 if DEBUG:
-                    print_adv(device, adv_data, malformed=False)
+                    log.event(logger, logging.DEBUG, "advertisement", "Advertisement", key=device.address,
+                              fields=lambda: advertisement_fields(device, adv_data))
                 return # Anything after this point implies a malformed/nonstandard payload
 
 
         # Use this if we want to stop scanning for any reason
         #stop_event.set()
 
-        print(color.red("[!!!] MALFORMED PAYLOAD [!!!]"))
-        print_adv(device, adv_data, malformed=True)
-
+        log.event(logger, logging.WARNING, "malformed", "Malformed payload", key=device.address,
+                  fields=lambda: advertisement_fields(device, adv_data))
 
-    async with BleakScanner(callback) as scanner:
-        await stop_event.wait()
+    return callback
 
 
-def print_adv(device, adv_data, malformed=False):
-    # Print MAC Address and the hardcoded friendly name
-    print(f"Device: {color.blue(device.address)} ({color.blue(device.name)})")
+# Report an Indoor Positioning payload the ingest task could not decode
+def log_malformed(address, payload, rssi):
+    log.event(logger, logging.WARNING, "malformed", "Malformed payload", key=address,
+              service_data={ips.SERVICE_UUID: bytes(payload).hex()}, rssi=rssi)
 
-    print(f"\tLocal Name: {color.green(adv_data.local_name)}")
 
-    # Print the manufacturer's data payload.
-    # This traditionally consists of an integer ID assigned to the manufacturer
+# Structured fields describing an advertisement for the log
+def advertisement_fields(device, adv_data):
+    # Manufacturer data traditionally consists of an integer ID assigned to the manufacturer
     # and a bytestring data payload that is static or not service-related.
     # Manufacturer IDs: https://www.bluetooth.com/wp-content/uploads/Files/Specification/HTML/Assigned_Numbers/out/en/Assigned_Numbers.pdf#page=217
-    print("\tManufacturer Data: {")
-    for manufacturer_id, value in adv_data.manufacturer_data.items():
-        print(f"\t\t{color.yellow(hex(manufacturer_id))}: {color.green(value)}")
-    print("\t}")
-
-
-    print("\tService Data: {")
-    if malformed:
-        for uuid, value in adv_data.service_data.items():
-            print(color.yellow(f"\t\t0x{uuid[4:8]}") + ": ", color.green(value))
-    else:
-        for uuid, value in adv_data.service_data.items():
-            print(color.yellow(f"\t\t0x{uuid[4:8]}") + ": {")
-
-            building_id = int.from_bytes(value[0:2], byteorder='big')
-            floor = value[2]
-            loc_north = frombuffer(value[3:5], dtype=">f2")[0].astype(float)
-            loc_east = frombuffer(value[5:7], dtype=">f2")[0].astype(float)
-
-            print(f"\t\t\tBuilding ID: {building_id}")
-            print(f"\t\t\tFloor: {floor}")
-            print(f"\t\t\tLocal North: {loc_north}")
-            print(f"\t\t\tLocal East: {loc_east}")
-
-            print("\t\t}")
-    print("\t}")
-
-    print(f"\tRSSI: {color.yellow(adv_data.rssi)}")
-    print(f"\tTx Power: {color.yellow(adv_data.tx_power)}")
+    service_data = {}
+    for uuid, value in adv_data.service_data.items():
+        key = ips.decode(value) if ips.is_indoor_positioning(uuid) else None
+        if key is None:
+            service_data[uuid[4:8]] = bytes(value).hex()
+        else:
+            building_id, floor, loc_north, loc_east = key
+            service_data[uuid[4:8]] = {"building_id": building_id, "floor": floor,
+                                       "loc_north": loc_north, "loc_east": loc_east}
+
+    return {
+        "name": device.name,
+        "local_name": adv_data.local_name,
+        "manufacturer_data": {hex(m): bytes(v).hex() for m, v in adv_data.manufacturer_data.items()},
+        "service_data": service_data,
+        "rssi": adv_data.rssi,
+        "tx_power": adv_data.tx_power,
+    }
 
 
 if __name__ == '__main__':
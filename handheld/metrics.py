@@ -0,0 +1,149 @@
+import asyncio
+import bisect
+
+# Counters and latency histograms for the handheld hot paths, rendered in the
+# Prometheus text format by the web API's /metrics route.
+#
+# Instrumented code guards every update with `if metrics.ENABLED:`, so with
+# metrics disabled the hot paths pay one attribute check and nothing else.
+# main.py sets ENABLED from its METRICS flag at startup.
+ENABLED = False
+
+# Histogram bucket upper bounds (seconds)
+SOLVE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+TELEMETRY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# How often the event loop lag is sampled (seconds)
+LAG_INTERVAL = 0.1
+
+
+def _labels(names, values):
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+
+
+# Monotonic count, optionally split by label values: inc() for the unlabeled
+# series, inc_labeled(values) with a tuple of values (one per label name)
+# for the labeled ones
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+        self.values = {}
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def inc_labeled(self, values, amount=1):
+        self.values[values] = self.values.get(values, 0) + amount
+
+    def samples(self):
+        if not self.labels:
+            return [(self.name, "", self.value)]
+        return [(self.name, _labels(self.labels, values), value) for values, value in self.values.items()]
+
+
+# Distribution of observations over fixed buckets
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        result = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            result.append((self.name + "_bucket", f'le="{bound}"', cumulative))
+        result.append((self.name + "_bucket", 'le="+Inf"', self.count))
+        result.append((self.name + "_sum", "", self.sum))
+        result.append((self.name + "_count", "", self.count))
+        return result
+
+
+# Value read from fn() at scrape time, for state components already track
+# (queue depth, uploader spool) so the hot path does no extra work. kind may
+# be "counter" for totals a component already counts.
+class Gauge:
+    def __init__(self, name, help, fn, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.kind = kind
+
+    def samples(self):
+        return [(self.name, "", self.fn())]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, buckets):
+        return self.register(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, fn, kind="gauge"):
+        return self.register(Gauge(name, help, fn, kind))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+ADVERTISEMENTS = REGISTRY.counter(
+    "ble_advertisements_total", "Indoor Positioning advertisements received by the scanner callback")
+MALFORMED = REGISTRY.counter(
+    "ble_malformed_payloads_total", "Indoor Positioning payloads that could not be decoded")
+# Labeled by the beacon key tuple itself so counting needs no formatting
+BEACON_SAMPLES = REGISTRY.counter(
+    "ble_beacon_samples_total", "RSSI samples recorded per beacon", labels=("building", "floor", "north", "east"))
+DEDUP_SKIPS = REGISTRY.counter(
+    "ble_dedup_skips_total", "Duplicate samples skipped within the minimum append interval")
+SOLVE_SECONDS = REGISTRY.histogram(
+    "ble_solve_seconds", "Time taken by each position solve", SOLVE_BUCKETS)
+SOLVE_FAILURES = REGISTRY.counter(
+    "ble_solve_failures_total", "Trilateration solves that produced no position", labels=("reason",))
+TELEMETRY_SECONDS = REGISTRY.histogram(
+    "ble_telemetry_send_seconds", "Time taken by each successful telemetry upload", TELEMETRY_BUCKETS)
+TELEMETRY_FAILURES = REGISTRY.counter(
+    "ble_telemetry_failures_total", "Failed telemetry upload attempts")
+LOOP_LAG = REGISTRY.histogram(
+    "ble_event_loop_lag_seconds", "How late the event loop ran a task that was due", LAG_BUCKETS)
+
+
+# Sample event loop lag into LOOP_LAG. Only started when metrics are enabled.
+async def monitor_event_loop(interval=LAG_INTERVAL):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - expected))
+
@@ -0,0 +1,173 @@
+import math
+import time
+import numpy as np
+from position import Position
+from sensors import convert_distance_to_rssi, px_to_meters
+
+PARTICLE_COUNT = 10000
+# Random-walk motion model: standard deviation of each particle's
+# displacement per axis over one second (meters). Walking pace is ~1.4 m/s,
+# and without a motion sensor every direction is equally likely.
+MOTION_SIGMA = 1.0
+# Longest gap between steps (seconds) propagated as motion; anything longer
+# is treated as this long so a stalled scanner doesn't scatter the cloud
+MAX_STEP = 2.0
+# Spread of a single raw RSSI sample around the log-distance model (dB),
+# from receiver noise, multipath and body shadowing
+RSSI_SIGMA = 4.0
+# Resample once the effective number of particles drops below this fraction
+RESAMPLE_THRESHOLD = 0.5
+# Jitter added after resampling (meters) so duplicated particles spread out
+ROUGHENING_SIGMA = 0.05
+# Spread of a fresh particle cloud around the beacons' centroid (meters)
+INIT_SPREAD = 5.0
+# Re-draws for initial particles that land inside walls
+INIT_ATTEMPTS = 5
+# Distances closer than this (meters) are treated as this close
+MIN_RANGE = 0.1
+
+
+# Sequential Monte Carlo position engine. Every particle is a candidate
+# (north, east) position in meters on the current floor; each step moves them
+# by a random walk, kills those whose move crosses a wall, and reweights them
+# by how well the log-distance model explains each beacon's newest RSSI
+# sample. The filter does its own smoothing over time, so it reads raw
+# samples rather than the Kalman-filtered averages trilateration uses.
+# All particles are processed as NumPy arrays in one pass.
+class ParticleFilterEngine:
+    name = "particle"
+
+    def __init__(self, count=PARTICLE_COUNT, wall_maps=None, seed=None):
+        self.count = count
+        # {(building, floor): WallMap}; floors without one are unconstrained
+        self.wall_maps = wall_maps or {}
+        self.rng = np.random.default_rng(seed)
+        self.particles = None
+        self.log_weights = None
+        self.floor_key = None
+        self.last_time = None
+
+        self.steps = 0
+        self.resamples = 0
+        self.restarts = 0
+        self.wall_rejections = 0
+
+    def reset(self):
+        self.particles = None
+        self.log_weights = None
+        self.floor_key = None
+        self.last_time = None
+
+    def stats(self):
+        return {
+            "particles": self.count,
+            "steps": self.steps,
+            "resamples": self.resamples,
+            "restarts": self.restarts,
+            "wall_rejections": self.wall_rejections,
+        }
+
+    def solve(self, beacons, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        table = beacons.table
+        building_id, floor, rows = beacons.select_rows()
+        if len(rows) == 0:
+            return None
+
+        key = (building_id, floor)
+        if self.particles is None or key != self.floor_key:
+            # Need a reasonable fix to seed the cloud, just like trilateration
+            if len(rows) < 3:
+                return None
+            self._initialize(key, beacons, rows)
+            fresh = np.ones(len(rows), dtype=bool)
+            dt = 0.0
+        else:
+            # Only samples that arrived since the last step are new evidence
+            fresh = table.time[rows] > self.last_time
+            dt = min(max(now - self.last_time, 0.0), MAX_STEP)
+        self.last_time = now
+
+        self._predict(dt)
+        if fresh.any():
+            self._update(table, rows[fresh])
+
+        if not np.isfinite(self.log_weights).any():
+            # Every particle was ruled out; start over from the measurements
+            self.restarts += 1
+            self.reset()
+            return None
+
+        weights = self._normalized_weights()
+        if 1.0 / np.sum(weights ** 2) < RESAMPLE_THRESHOLD * self.count:
+            self._resample(weights)
+            weights = self._normalized_weights()
+
+        self.steps += 1
+        north, east = weights @ self.particles
+        calc_pos = Position(float(north), float(east), building_id, floor)
+        # Lets the cache look up beacons around our estimate
+        beacons.last_position = calc_pos
+        return calc_pos
+
+    def _initialize(self, key, beacons, rows):
+        table = beacons.table
+        points = np.column_stack((px_to_meters(table.north[rows]), px_to_meters(table.east[rows])))
+        closeness = 1.0 / np.maximum(table.distance[rows], MIN_RANGE)
+        center = (points * closeness[:, None]).sum(axis=0) / closeness.sum()
+
+        particles = center + self.rng.normal(0.0, INIT_SPREAD, size=(self.count, 2))
+        walls = self.wall_maps.get(key)
+        if walls is not None:
+            for _ in range(INIT_ATTEMPTS):
+                blocked = walls.blocked(particles)
+                if not blocked.any():
+                    break
+                particles[blocked] = center + self.rng.normal(0.0, INIT_SPREAD, size=(int(blocked.sum()), 2))
+
+        self.particles = particles
+        self.log_weights = np.zeros(self.count)
+        self.floor_key = key
+
+    def _predict(self, dt):
+        if dt <= 0:
+            return
+        moved = self.particles + self.rng.normal(0.0, MOTION_SIGMA * math.sqrt(dt), size=self.particles.shape)
+
+        walls = self.wall_maps.get(self.floor_key)
+        if walls is not None:
+            # Nobody walks through walls: particles whose move crosses one die
+            hit = walls.crosses(self.particles, moved)
+            self.log_weights[hit] = -np.inf
+            moved[hit] = self.particles[hit]
+            self.wall_rejections += int(hit.sum())
+
+        self.particles = moved
+
+    def _update(self, table, rows):
+        points = np.column_stack((px_to_meters(table.north[rows]), px_to_meters(table.east[rows])))
+        rssi = table.latest_rssi(rows)
+        variance = RSSI_SIGMA ** 2
+
+        # (particles, beacons) matrix of ranges and expected RSSI
+        north = self.particles[:, 0:1] - points[:, 0]
+        east = self.particles[:, 1:2] - points[:, 1]
+        ranges = np.maximum(np.sqrt(north * north + east * east), MIN_RANGE)
+        residual = rssi - convert_distance_to_rssi(ranges, table.tx_power[rows], table.path_loss[rows])
+        self.log_weights += -0.5 * (residual * residual / variance).sum(axis=1)
+
+    def _normalized_weights(self):
+        weights = np.exp(self.log_weights - self.log_weights.max())
+        return weights / weights.sum()
+
+    # Systematic resampling: one random offset, count evenly spaced picks
+    def _resample(self, weights):
+        picks = (self.rng.random() + np.arange(self.count)) / self.count
+        cumulative = np.cumsum(weights)
+        cumulative[-1] = 1.0
+        index = np.searchsorted(cumulative, picks)
+        self.particles = self.particles[index] + self.rng.normal(0.0, ROUGHENING_SIGMA, size=self.particles.shape)
+        self.log_weights = np.zeros(self.count)
+        self.resamples += 1
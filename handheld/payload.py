@@ -0,0 +1,61 @@
+import struct
+import numpy as np
+
+# Indoor Positioning Service (0x1821) service-data payload.
+# This is the layout broadcast by beacons/broadcast/src/main.c:
+#   uint16  building_id   big endian
+#   uint8   floor
+#   float16 local_north   big endian, pixels on the floorplan
+#   float16 local_east    big endian, pixels on the floorplan
+# Keep both sides in sync if the layout changes.
+SERVICE_UUID = "1821"
+PAYLOAD = struct.Struct(">HBee")
+PAYLOAD_SIZE = PAYLOAD.size
+
+# The same layout as a NumPy structured dtype, for decoding many payloads at once
+PAYLOAD_DTYPE = np.dtype([
+    ("building_id", ">u2"),
+    ("floor", "u1"),
+    ("loc_north", ">f2"),
+    ("loc_east", ">f2"),
+])
+
+# Beacons broadcast static content, so decoded payloads are memoized by their
+# raw bytes. The memo is dropped wholesale if it ever grows past this size.
+MEMO_LIMIT = 4096
+_memo = {}
+
+
+# Check a 128-bit service UUID string for the 16-bit Indoor Positioning Service
+def is_indoor_positioning(uuid):
+    return uuid[4:8] == SERVICE_UUID
+
+
+# Decode a payload into a beacon key tuple (building_id, floor, loc_north, loc_east),
+# or None if it is malformed
+def decode(payload):
+    key = _memo.get(payload)
+    if key is not None:
+        return key
+
+    if len(payload) != PAYLOAD_SIZE:
+        return None
+
+    # 'e' unpacks float16 straight into a native float
+    key = PAYLOAD.unpack(payload)
+    if len(_memo) >= MEMO_LIMIT:
+        _memo.clear()
+    _memo[bytes(payload)] = key
+    return key
+
+
+# Decode a sequence of well-formed payloads into a structured array with one
+# record per payload. Raises ValueError if any payload is the wrong size.
+def decode_batch(payloads):
+    if any(len(p) != PAYLOAD_SIZE for p in payloads):
+        raise ValueError(f"Indoor Positioning payloads must be {PAYLOAD_SIZE} bytes")
+    return np.frombuffer(b"".join(payloads), dtype=PAYLOAD_DTYPE)
+
+
+def encode(building_id, floor, loc_north, loc_east):
+    return PAYLOAD.pack(building_id, floor, loc_north, loc_east)
@@ -0,0 +1,187 @@
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+import main as handheld
+from capture import read_capture, ReplayScanner
+from ingest import AdvertisementQueue, consume, record_batch
+from tracker import PositionTracker
+
+# Replays a capture (see capture.py) through the handheld pipeline: main.py's
+# scanner callback, the ingest queue, SensorCache and the position engine.
+#
+#   python replay.py advertisements.cap [--speed 1] [--engine particle] [--truth walk.jsonl]
+#
+# With --speed 0 (the default) the replay is deterministic: every stage runs
+# synchronously on the recorded timestamps, so results don't depend on how
+# fast the machine is and the wall time is pure processing cost. Any other
+# speed runs the live asyncio tasks against a ReplayScanner at that multiple
+# of the recorded pace, which also measures advertisement-to-fix latency.
+#
+# A truth file is JSON lines of {"t", "north", "east"} (capture seconds,
+# meters); positions between lines are interpolated to score each fix.
+
+
+def load_truth(path):
+    t, north, east = [], [], []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                point = json.loads(line)
+                t.append(point["t"])
+                north.append(point["north"])
+                east.append(point["east"])
+    return np.array(t), np.array(north), np.array(east)
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) else float("nan")
+
+
+# Replay as fast as possible on the capture's clock. The queue is drained
+# after every advertisement and the tracker solves at most max_rate times per
+# capture second, like PositionTracker.run() does in real time.
+def replay_fast(records, beacons, tracker, max_rate=handheld.SOLVE_MAX_RATE):
+    clock = [0.0]
+    queue = AdvertisementQueue(handheld.INGEST_QUEUE_SIZE, handheld.INGEST_OVERFLOW)
+    callback = handheld.scan_callback(queue, clock=lambda: clock[0])
+
+    fixes = []
+    solve_times = []
+    min_interval = 1.0 / max_rate
+    last_solve = -np.inf
+    dirty = False
+
+    started = time.perf_counter()
+    for t, device, adv_data in records:
+        clock[0] = t
+        callback(device, adv_data)
+        if len(queue) and record_batch(queue.drain(handheld.INGEST_BATCH_SIZE), beacons):
+            dirty = True
+
+        if dirty and t - last_solve >= min_interval:
+            solve_started = time.perf_counter()
+            fix = tracker.solve(t)
+            solve_times.append(time.perf_counter() - solve_started)
+            fixes.append((t, fix))
+            last_solve = t
+            dirty = False
+    wall = time.perf_counter() - started
+
+    return {"wall": wall, "fixes": fixes, "solve_times": solve_times, "latencies": []}
+
+
+# Replay through the live tasks at speed times the recorded pace
+async def replay_live(records, beacons, tracker, speed):
+    queue = AdvertisementQueue(handheld.INGEST_QUEUE_SIZE, handheld.INGEST_OVERFLOW)
+    callback = handheld.scan_callback(queue)
+    scanner = ReplayScanner(None, records=records, speed=speed)
+
+    # Time of every advertisement not yet covered by a solve
+    pending = []
+    latencies = []
+    fixes = []
+    solve_times = []
+
+    def arrived(device, adv_data):
+        pending.append(time.monotonic())
+        callback(device, adv_data)
+    scanner.detection_callback = arrived
+
+    def solved(fix, changed):
+        now = time.monotonic()
+        solve_times.append(now - fix_started[0])
+        latencies.extend(now - t for t in pending)
+        pending.clear()
+        fixes.append((scanner.now(), fix))
+
+    # Time solve() so its cost can be reported separately from waiting
+    fix_started = [0.0]
+    solve = tracker.solve
+
+    def timed_solve(now=None):
+        fix_started[0] = time.monotonic()
+        return solve(now)
+    tracker.solve = timed_solve
+    tracker.listeners.append(solved)
+
+    tasks = [
+        asyncio.create_task(consume(queue, beacons, handheld.INGEST_BATCH_SIZE, on_batch=tracker.notify)),
+        asyncio.create_task(tracker.run()),
+    ]
+    started = time.perf_counter()
+    async with scanner:
+        await scanner.finished.wait()
+        # Let the last advertisements reach a solve
+        await asyncio.sleep(tracker.min_interval * 2)
+    wall = time.perf_counter() - started
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return {"wall": wall, "fixes": fixes, "solve_times": solve_times, "latencies": latencies}
+
+
+# Replay records and summarize throughput, solve cost, latency and, given a
+# truth track, accuracy. beacons and engine default to main.py's configuration.
+def replay(records, speed=0, beacons=None, engine=None, truth=None):
+    if beacons is None:
+        beacons = handheld.configured_cache()
+    tracker = PositionTracker(beacons, handheld.SOLVE_MAX_RATE, engine=engine or handheld.configured_engine())
+
+    if speed:
+        result = asyncio.run(replay_live(records, beacons, tracker, speed))
+    else:
+        result = replay_fast(records, beacons, tracker)
+
+    positions = [(t, fix.position) for t, fix in result["fixes"] if fix.position is not None]
+    errors = []
+    if truth is not None and positions:
+        truth_t, truth_north, truth_east = truth
+        t = np.array([t for t, _ in positions])
+        north = np.array([p.loc_north for _, p in positions])
+        east = np.array([p.loc_east for _, p in positions])
+        errors = np.hypot(north - np.interp(t, truth_t, truth_north), east - np.interp(t, truth_t, truth_east))
+
+    duration = records[-1][0] - records[0][0] if records else 0.0
+    return {
+        "advertisements": len(records),
+        "duration": duration,
+        "wall": result["wall"],
+        "rate": len(records) / result["wall"] if result["wall"] else float("inf"),
+        "solves": len(result["fixes"]),
+        "fixes": len(positions),
+        "solve_p50_ms": percentile(result["solve_times"], 50) * 1000,
+        "solve_p99_ms": percentile(result["solve_times"], 99) * 1000,
+        "latency_p50_ms": percentile(result["latencies"], 50) * 1000,
+        "latency_p99_ms": percentile(result["latencies"], 99) * 1000,
+        "error_median": percentile(errors, 50),
+        "error_p90": percentile(errors, 90),
+    }
+
+
+def print_report(stats):
+    print(f"Replayed {stats['advertisements']} advertisements ({stats['duration']:.1f} s of capture) "
+          f"in {stats['wall']:.2f} s: {stats['rate']:.0f} advertisements/s")
+    print(f"Solves: {stats['solves']} ({stats['fixes']} fixes), "
+          f"solve time p50 {stats['solve_p50_ms']:.2f} ms, p99 {stats['solve_p99_ms']:.2f} ms")
+    if not np.isnan(stats["latency_p50_ms"]):
+        print(f"Advertisement-to-fix latency: p50 {stats['latency_p50_ms']:.1f} ms, "
+              f"p99 {stats['latency_p99_ms']:.1f} ms")
+    if not np.isnan(stats["error_median"]):
+        print(f"Position error: median {stats['error_median']:.2f} m, p90 {stats['error_p90']:.2f} m")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay an advertisement capture through the handheld pipeline")
+    parser.add_argument("capture")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="multiple of the recorded pace (default 0: deterministic, as fast as possible)")
+    parser.add_argument("--engine", default=handheld.POSITION_ENGINE, help="position engine (see engines.py)")
+    parser.add_argument("--truth", help="JSON lines ground truth track to score fixes against")
+    args = parser.parse_args()
+
+    truth = load_truth(args.truth) if args.truth else None
+    print_report(replay(read_capture(args.capture), args.speed,
+                        engine=handheld.configured_engine(args.engine), truth=truth))
@@ -1,20 +1,49 @@
 import numbers
-from collections import deque
+import logging
+import log
 from position import Position
 import time
 import json
 import numpy as np
-from kalman import Kalman1D
-
-#TX_POWER = -66
-#PATH_LOSS = 1.61085143652
-
-TX_POWER = -61.623
-PATH_LOSS = 1.806
+import metrics
+from kalman import KalmanBank
+from beacon_table import BeaconTable
+from beacon_registry import BeaconRegistry
+from solver import solve_position, range_weights, gdop, select_geometry
+# Defaults for beacons without a calibration profile
+from calibration import TX_POWER, PATH_LOSS, CalibrationProfiles
+
+# RSSI Kalman filter process and measurement noise
+KALMAN_Q = 0.3
+KALMAN_R = 9.0
+# If True, KALMAN_Q is applied per second since a beacon's last sample
+# rather than per sample
+KALMAN_TIME_SCALED = False
+
+logger = logging.getLogger("sensors")
+
+# Estimated ranges are clipped to this interval (meters)
+MIN_DISTANCE = 0
+MAX_DISTANCE = 12
+
+# Beacon selection: consider the CANDIDATE_COUNT nearest heard beacons
+# (looked up around the last fix when possible), and solve with the
+# SOLVE_COUNT of them that give the best geometry. Give up on a solve whose
+# geometry is worse than MAX_GDOP rather than report a wild position.
+CANDIDATE_COUNT = 8
+SOLVE_COUNT = 5
+MAX_GDOP = 10.0
+# How far the handheld may move between solves (meters) when searching
+# around the last fix
+SEARCH_MARGIN = 3
 
 def convert_rssi_to_distance(rssi, tx_power=TX_POWER, path_loss=PATH_LOSS):
     return 10 ** ((tx_power - rssi) / (10 * path_loss))
 
+# Inverse of convert_rssi_to_distance: the RSSI expected at a distance (meters)
+def convert_distance_to_rssi(distance, tx_power=TX_POWER, path_loss=PATH_LOSS):
+    return tx_power - 10 * path_loss * np.log10(distance)
+
 # With the current floorplan, 1ft=30px
 # First convert to feet, then to pixels
 def meters_to_px(meters):
@@ -26,9 +55,17 @@ def px_to_meters(px):
 
 
 class SensorCache:
-    def __init__(self, expiry_time, on_trilaterate):
-        self.cache = {}
+    def __init__(self, expiry_time, on_trilaterate=None, registry=None, profiles=None):
+        # Per-beacon state lives in a struct-of-arrays table, one row per beacon
+        self.table = BeaconTable(kalman=KalmanBank(q=KALMAN_Q, r=KALMAN_R, time_scaled=KALMAN_TIME_SCALED))
         self.on_trilaterate = on_trilaterate
+        # Spatial index of beacon positions (from the floorplan, plus any beacon
+        # we hear that it doesn't list) used to find candidates near the last fix
+        self.registry = registry if registry is not None else BeaconRegistry()
+        self.last_position = None
+        # Per-beacon TX power and path loss for this receiver, looked up once
+        # when a beacon is first heard and kept in the table alongside it
+        self.profiles = profiles if profiles is not None else CalibrationProfiles()
 
         if not isinstance(expiry_time, numbers.Number):
             expiry_time = 0
@@ -49,122 +86,201 @@ class SensorCache:
         if type(pos) is not Position:
             return
 
-        key = pos.tup()
-        entry = self.cache.get(key)
-        if entry is None:
-            entry = {
-                # Store a history of RSSI values to smooth out fluctuations
-                'history': deque(maxlen=10),
-                'time': 0,
-                'avg_rssi': 0,
-                'distance': 0,
-                'kalman': Kalman1D()
-            }
-
-        now = time.time()
-
-        # If the most recent recorded RSSI is identical, and we recorded it
-        # very recently, skip appending to avoid duplicates coming from
-        # advertisement + scan-response or duplicated callbacks.
-        last_val = entry['history'][-1] if entry['history'] else None
-        if last_val is not None and last_val == rssi:
-            if (now - entry['time']) < self._min_append_interval:
-                # skip duplicate
-                entry['time'] = now
-                self.cache[key] = entry
-                return
-
-        entry['history'].append(rssi)
-        entry['time'] = now
-
-        filtered_rssi = entry['kalman'].update(rssi)
-        entry['avg_rssi'] = filtered_rssi
-
-        min_d = 0  # meters
-        max_d = 12
-#        entry['distance'] = convert_rssi_to_distance(filtered_rssi)
-        dist = convert_rssi_to_distance(filtered_rssi)
-        entry['distance'] = max(min_d, min(max_d, dist))
-
-        # Update the cache
-        self.cache[key] = entry
-
-
-    def clear_old_sensors(self):
-        # Avoid concurrent modification
-        to_remove = []
-        for pos, val in self.cache.items():
-            # If we haven't heard from a beacon in the expiry time
-            if self.expiry_time != 0 and val['time'] < time.time() - self.expiry_time:
-                to_remove.append(pos)
-
-        for pos in to_remove:
-            # Remove the dictionary entry
-            del self.cache[pos]
+        self.record_sensors([(pos.tup(), rssi, time.monotonic())])
+
+
+    # Record a batch of (key, rssi, timestamp) samples, where key is a
+    # Position tuple. Every sample that survives deduplication is filtered
+    # in a single vectorized Kalman step.
+    def record_sensors(self, samples):
+        table = self.table
+        rows = []
+        values = []
+        times = []
+        counting = metrics.ENABLED
+
+        for key, rssi, now in samples:
+            row = table.slots.get(key)
+            if row is None:
+                if key not in self.registry:
+                    self.registry.add(key)
+                row = table.slot(key, self.profiles.lookup(key))
+
+            # If the most recent recorded RSSI is identical, and we recorded it
+            # very recently, skip appending to avoid duplicates coming from
+            # advertisement + scan-response or duplicated callbacks.
+            last_val = table.last_rssi(row)
+            if last_val is not None and last_val == rssi:
+                if (now - table.time[row]) < self._min_append_interval:
+                    # skip duplicate
+                    table.time[row] = now
+                    if counting:
+                        metrics.DEDUP_SKIPS.inc()
+                    continue
+
+            if counting:
+                metrics.BEACON_SAMPLES.inc_labeled(key)
+
+            table.push_history(row, rssi)
+            table.time[row] = now
+            rows.append(row)
+            values.append(rssi)
+            times.append(now)
+
+        if not rows:
+            return
+
+        rows = np.array(rows, dtype=np.intp)
+        table.kalman.update(rows, values, times)
+
+        # Read back the final state, as a beacon may appear more than once per batch
+        filtered_rssi = table.kalman.x[rows]
+        table.avg_rssi[rows] = filtered_rssi
+
+        table.distance[rows] = np.clip(
+            convert_rssi_to_distance(filtered_rssi, table.tx_power[rows], table.path_loss[rows]),
+            MIN_DISTANCE, MAX_DISTANCE)
+
+
+    # now is a monotonic timestamp in the same clock as the samples (default: now)
+    def clear_old_sensors(self, now=None):
+        # If set to 0, never expire beacons
+        if self.expiry_time == 0:
+            return
+        if now is None:
+            now = time.monotonic()
+
+        # Remove every beacon we haven't heard from in the expiry time
+        table = self.table
+        stale = table.active & (table.time < now - self.expiry_time)
+        if stale.any():
+            table.release(np.flatnonzero(stale))
 
     def get_best_sensors(self):
-        sensors = [(val['distance'], pos) for pos, val in self.cache.items()]
-        # Sort by distance (lowest first)
-        sensors.sort(key=lambda x: x[0])
+        table = self.table
+        _, _, rows = self.select_rows()
 
         # Get up to three positions, padding with None if fewer than three
-        best = [pos for _, pos in sensors[:3]]
+        best = [table.keys[row] for row in rows[:3]]
         while len(best) < 3:
             best.append(None)
 
         return best
 
-    def trilaterate(self):
-        a, b, c = self.get_best_sensors()
-        # Retrieve using self.cache[a].rssi
+    # Heard beacons on (building_id, floor) within range of the last fix,
+    # found through the registry grid. Returns None if there is no usable fix,
+    # or if the nearest beacon we hear is not around it: a bad fix must not
+    # keep steering selection toward the beacons near itself.
+    def _rows_near_last_fix(self, building_id, floor, nearest):
+        last = self.last_position
+        if last is None or (last.building_id, last.floor) != (building_id, floor):
+            return None
+
+        table = self.table
+        keys = self.registry.near(building_id, floor, meters_to_px(last.loc_north), meters_to_px(last.loc_east),
+                                  meters_to_px(MAX_DISTANCE + SEARCH_MARGIN))
+        rows = [table.slots[key] for key in keys if key in table.slots]
+        if len(rows) < 3 or nearest not in rows:
+            return None
+        return np.array(rows, dtype=np.intp)
+
+    # Choose the beacons to solve with: those on the nearest beacon's building
+    # and floor, narrowed to the CANDIDATE_COUNT nearest, then to the
+    # SOLVE_COUNT with the best geometry. Returns (building_id, floor, rows)
+    # with rows ordered nearest first.
+    def select_rows(self):
+        table = self.table
+        rows = table.rows()
+        if len(rows) == 0:
+            return None, None, rows
+
+        nearest = rows[np.argmin(table.distance[rows])]
+        building_id = int(table.building[nearest])
+        floor = int(table.floor[nearest])
+
+        candidates = self._rows_near_last_fix(building_id, floor, nearest)
+        if candidates is None:
+            candidates = rows[(table.building[rows] == building_id) & (table.floor[rows] == floor)]
+
+        if len(candidates) > CANDIDATE_COUNT:
+            candidates = candidates[np.argpartition(table.distance[candidates], CANDIDATE_COUNT)[:CANDIDATE_COUNT]]
+        candidates = candidates[np.argsort(table.distance[candidates], kind='stable')]
+
+        if len(candidates) > SOLVE_COUNT:
+            points = np.column_stack((px_to_meters(table.north[candidates]), px_to_meters(table.east[candidates])))
+            weights = range_weights(table.distance[candidates], table.kalman.p[candidates], table.path_loss[candidates])
+            chosen = select_geometry(points, self._anchor(building_id, floor, points, candidates), SOLVE_COUNT, weights)
+            candidates = candidates[np.sort(chosen)]
+
+        return building_id, floor, candidates
+
+    # Where to evaluate geometry: the last fix, or before the first fix on
+    # this floor, the candidate beacons' centroid weighted by closeness
+    def _anchor(self, building_id, floor, points, rows):
+        last = self.last_position
+        if last is not None and (last.building_id, last.floor) == (building_id, floor):
+            return np.array([last.loc_north, last.loc_east])
+        closeness = 1.0 / np.maximum(self.table.distance[rows], 0.1)
+        return (points * closeness[:, None]).sum(axis=0) / closeness.sum()
 
-        p = list()
+    def trilaterate(self):
+        table = self.table
+        if len(table) < 3:
+            return None
 
-        # Implement algorithm
-        for pos in self.get_best_sensors():
-            if not pos:
-                continue
-            _, _, loc_north, loc_east = pos
-            val = self.cache[pos]
-            #p.append([loc_north, loc_east, val['distance']])
-            p.append([px_to_meters(loc_north), px_to_meters(loc_east), val['distance']])
+        building_id, floor, rows = self.select_rows()
 
         # Make sure we have minimum number of beacons
-        if len(p) < 3:
+        if len(rows) < 3:
             return None
 
-        A = 2 * (p[1][0] - p[0][0]), 2 * (p[1][1] - p[0][1])
-        B = 2 * (p[2][0] - p[0][0]), 2 * (p[2][1] - p[0][1])
-        C = p[0][2]**2 - p[1][2]**2 + p[1][0]**2 - p[0][0]**2 + p[1][1]**2 - p[0][1]**2
-        D = p[0][2]**2 - p[2][2]**2 + p[2][0]**2 - p[0][0]**2 + p[2][1]**2 - p[0][1]**2
+        # Nearest first, so the closest beacon anchors the linearized solve
+        points = np.column_stack((px_to_meters(table.north[rows]), px_to_meters(table.east[rows])))
+        distances = table.distance[rows]
+        # Weight each beacon by the uncertainty of its filtered RSSI
+        weights = range_weights(distances, table.kalman.p[rows], table.path_loss[rows])
+
+        if gdop(points, self._anchor(building_id, floor, points, rows)) > MAX_GDOP:
+            log.event(logger, logging.WARNING, "solve_failure", "Beacon geometry too poor to solve (beacons may be collinear)",
+                      key=(building_id, floor), gdop_limit=MAX_GDOP)
+            if metrics.ENABLED:
+                metrics.SOLVE_FAILURES.inc_labeled(("geometry",))
+            # Don't keep judging geometry from a fix we could not confirm
+            self.last_position = None
+            return None
 
-        M = np.array([[A[0], A[1]],
-                      [B[0], B[1]]])
-        Y = np.array([C, D])
+        result = solve_position(points, distances, weights)
+        if result is None:
+            log.event(logger, logging.WARNING, "solve_failure", "Beacons may be collinear or distances invalid",
+                      key=(building_id, floor))
+            if metrics.ENABLED:
+                metrics.SOLVE_FAILURES.inc_labeled(("singular",))
+            return None
 
-        try:
-            x, y = np.linalg.solve(M, Y)
-            building_id, floor, _, _ = a # Extract from best pos tuple
-            calc_pos = Position(x, y, building_id, floor)
+        x, y = result
+        calc_pos = Position(x, y, building_id, floor)
+        self.last_position = calc_pos
+        if self.on_trilaterate:
             self.on_trilaterate(calc_pos)
-            return calc_pos
-        except np.linalg.LinAlgError:
-            print("Error: Beacons may be collinear or distances invalid")
-            return None
+        return calc_pos
 
 
     def json(self):
+        table = self.table
+        rows = table.rows()
         assemble = []
-        for pos, val in self.cache.items():
-            building_id, floor, loc_north, loc_east = pos
+        for row, building_id, floor, loc_north, loc_east, avg_rssi, distance in zip(
+                rows.tolist(), table.building[rows].tolist(), table.floor[rows].tolist(),
+                table.north[rows].tolist(), table.east[rows].tolist(),
+                table.avg_rssi[rows].tolist(), table.distance[rows].tolist()):
             assemble.append({
                 "loc_north": loc_north,
                 "loc_east": loc_east,
                 "building_id": building_id,
                 "floor": floor,
-                "avg_rssi": val['avg_rssi'],
-                "history": list(val['history']),
-                "distance": val['distance']
+                "avg_rssi": avg_rssi,
+                "history": table.history_of(row),
+                "distance": distance
             })
 
         return json.dumps(assemble)
\ No newline at end of file
@@ -0,0 +1,310 @@
+import argparse
+import asyncio
+import math
+import resource
+import time
+import numpy as np
+import main as handheld
+import payload as ips
+from beacon_registry import BeaconRegistry, broadcast_coord
+from capture import ReplayDevice, ReplayAdvertisement
+from calibration import TX_POWER, PATH_LOSS
+from engines import create_engine
+from ingest import AdvertisementQueue, consume
+from local_web import API
+from position import Position
+from sensors import SensorCache, meters_to_px, px_to_meters
+from tracker import PositionTracker
+
+# Synthetic beacon field for load-testing the handheld without radios.
+#
+#   python simulator.py [--beacons 500] [--duration 60] [--engine trilateration]
+#
+# Beacons are spread over a square floor and advertise encoded 0x1821
+# payloads every ADV_INTERVAL_MIN-MAX seconds, like the broadcast firmware.
+# A virtual handheld walks between random waypoints; the RSSI of each
+# advertisement follows the log-distance model plus Gaussian noise, and
+# anything below the receiver's sensitivity is never reported. A
+# BleakScanner-compatible SimulatedScanner feeds main.py's pipeline and the
+# web API in real time, while clients poll the API, and the run reports
+# ingest and solve rates, event loop lag, memory and position error.
+
+# Advertising interval of beacons/broadcast/src/main.c (seconds)
+ADV_INTERVAL_MIN = 0.5
+ADV_INTERVAL_MAX = 1.0
+# Average distance between neighbouring beacons (meters)
+BEACON_SPACING = 4.0
+# Weakest RSSI the receiver reports (dBm)
+SENSITIVITY = -95
+# Spread of each advertisement's RSSI around the model (dB)
+RSSI_NOISE = 4.0
+# Share of heard advertisements the scanner misses (duty cycle, collisions)
+AD_LOSS = 0.3
+# Beacons' spread of TX power around the calibrated default (dB)
+TX_POWER_SPREAD = 0.0
+# Walking speed of the virtual handheld (m/s)
+WALK_SPEED = 1.2
+# Scanner tick: advertisements due within a tick are delivered together
+TICK = 0.02
+# Event loop lag is sampled this often (seconds)
+LAG_INTERVAL = 0.01
+# Requests per second made by simulated web clients, per endpoint
+API_POLL_RATE = {"/json": 10.0, "/beacons": 1.0}
+# Simulated /stream viewers
+STREAM_SUBSCRIBERS = 5
+
+
+# A square floor of beacons on a jittered grid, as (building, floor, north,
+# east) keys in broadcast px and (north, east) positions in meters
+class BeaconField:
+    def __init__(self, count, spacing=BEACON_SPACING, building_id=1, floor=1, seed=None):
+        rng = np.random.default_rng(seed)
+        side = math.ceil(math.sqrt(count))
+        self.size = side * spacing
+        cells = np.array([(i // side, i % side) for i in range(count)], dtype=float)
+        points = (cells + 0.5 + rng.uniform(-0.3, 0.3, size=cells.shape)) * spacing
+
+        self.keys = [(building_id, floor, broadcast_coord(meters_to_px(n)), broadcast_coord(meters_to_px(e)))
+                     for n, e in points]
+        # Use the positions as broadcast so the model matches what the handheld sees
+        self.points = np.array([(px_to_meters(k[2]), px_to_meters(k[3])) for k in self.keys])
+        self.payloads = [ips.encode(*key) for key in self.keys]
+        self.devices = [ReplayDevice(f"C0:{i >> 16 & 0xFF:02X}:{i >> 8 & 0xFF:02X}:{i & 0xFF:02X}:00:00", "blepos")
+                        for i in range(count)]
+        self.tx_power = TX_POWER + rng.normal(0, TX_POWER_SPREAD, count) if TX_POWER_SPREAD else np.full(count, TX_POWER)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def registry(self):
+        registry = BeaconRegistry()
+        for key in self.keys:
+            registry.add(key)
+        return registry
+
+
+# Random waypoint walk across the field. position(t) is deterministic for a seed.
+class Walker:
+    def __init__(self, size, speed=WALK_SPEED, seed=None, margin=2.0):
+        self.rng = np.random.default_rng(seed)
+        self.size = size
+        self.speed = speed
+        self.margin = margin
+        self.start = self._waypoint()
+        self.end = self._waypoint()
+        self.leg_start = 0.0
+        self.leg_time = self._leg_time()
+
+    def _waypoint(self):
+        return self.rng.uniform(self.margin, self.size - self.margin, 2)
+
+    def _leg_time(self):
+        return max(np.hypot(*(self.end - self.start)) / self.speed, 1e-6)
+
+    # Position (meters) at t seconds into the run; t must not decrease
+    def position(self, t):
+        while t > self.leg_start + self.leg_time:
+            self.leg_start += self.leg_time
+            self.start = self.end
+            self.end = self._waypoint()
+            self.leg_time = self._leg_time()
+        return self.start + (self.end - self.start) * ((t - self.leg_start) / self.leg_time)
+
+
+# Stand-in for BleakScanner that delivers the field's advertisements, as
+# heard from the walker's position, to the detection callback in real time
+class SimulatedScanner:
+    def __init__(self, detection_callback=None, field=None, walker=None, seed=None, **kwargs):
+        self.detection_callback = detection_callback
+        self.field = field
+        self.walker = walker
+        self.rng = np.random.default_rng(seed)
+        self.generated = 0
+        self.delivered = 0
+        self._started = None
+        self._task = None
+
+    # Seconds since the scanner started
+    def now(self):
+        return time.monotonic() - self._started
+
+    def truth(self, t):
+        return self.walker.position(t)
+
+    async def start(self):
+        self._started = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def _run(self):
+        field = self.field
+        count = len(field)
+        uuid = f"0000{ips.SERVICE_UUID}-0000-1000-8000-00805f9b34fb"
+        next_time = self.rng.uniform(0, ADV_INTERVAL_MAX, count)
+
+        while True:
+            await asyncio.sleep(TICK)
+            t = self.now()
+            due = np.flatnonzero(next_time <= t)
+            if len(due) == 0:
+                continue
+            next_time[due] += self.rng.uniform(ADV_INTERVAL_MIN, ADV_INTERVAL_MAX, len(due))
+            self.generated += len(due)
+
+            distance = np.maximum(np.hypot(*(field.points[due] - self.walker.position(t)).T), 0.1)
+            rssi = field.tx_power[due] - 10 * PATH_LOSS * np.log10(distance) + self.rng.normal(0, RSSI_NOISE, len(due))
+            heard = (rssi >= SENSITIVITY) & (self.rng.random(len(due)) >= AD_LOSS)
+
+            for i, value in zip(due[heard].tolist(), np.round(rssi[heard]).astype(int).tolist()):
+                self.detection_callback(field.devices[i],
+                                        ReplayAdvertisement("blepos", value, {uuid: field.payloads[i]}, {}, None))
+            self.delivered += int(heard.sum())
+
+
+# Samples how late the event loop wakes a task that asked to sleep interval
+async def monitor_lag(lags, interval=LAG_INTERVAL):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - expected)
+
+
+# Poll an API endpoint through Quart's test client at rate requests/second
+async def poll_api(client, path, rate, latencies):
+    while True:
+        await asyncio.sleep(1.0 / rate)
+        started = time.perf_counter()
+        response = await client.get(path)
+        await response.get_data()
+        latencies.append(time.perf_counter() - started)
+
+
+# Drain a /stream subscription the way a connected browser would
+async def watch_stream(stream, received):
+    queue = stream.subscribe()
+    try:
+        while True:
+            await queue.get()
+            received[0] += 1
+    finally:
+        stream.unsubscribe(queue)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def simulate(beacons=500, duration=60.0, engine="trilateration", seed=546, api=True):
+    field = BeaconField(beacons, seed=seed)
+    walker = Walker(field.size, seed=seed)
+    rss_before = peak_rss_mb()
+
+    cache = SensorCache(15, registry=field.registry())
+    tracker = PositionTracker(cache, handheld.SOLVE_MAX_RATE,
+                              engine=create_engine(engine, **({"seed": seed} if engine == "particle" else {})))
+    queue = AdvertisementQueue(handheld.INGEST_QUEUE_SIZE, handheld.INGEST_OVERFLOW)
+    scanner = SimulatedScanner(handheld.scan_callback(queue), field=field, walker=walker, seed=seed)
+
+    errors = []
+
+    def score(fix, changed):
+        if changed and fix.position is not None:
+            truth = walker.position(scanner.now())
+            errors.append(math.hypot(fix.position.loc_north - truth[0], fix.position.loc_east - truth[1]))
+    tracker.listeners.append(score)
+
+    lags = []
+    latencies = {path: [] for path in API_POLL_RATE}
+    received = [0]
+    tasks = [
+        asyncio.create_task(consume(queue, cache, handheld.INGEST_BATCH_SIZE, on_batch=tracker.notify)),
+        asyncio.create_task(tracker.run()),
+        asyncio.create_task(monitor_lag(lags)),
+    ]
+    if api:
+        web = API(Position(), cache, tracker)
+        client = web.app.test_client()
+        tasks += [asyncio.create_task(poll_api(client, path, rate, latencies[path]))
+                  for path, rate in API_POLL_RATE.items()]
+        tasks += [asyncio.create_task(watch_stream(web.stream, received)) for _ in range(STREAM_SUBSCRIBERS)]
+
+    cpu_started = time.process_time()
+    async with scanner:
+        await asyncio.sleep(duration)
+    cpu = time.process_time() - cpu_started
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    return {
+        "beacons": beacons,
+        "field_m": field.size,
+        "duration": duration,
+        "generated": scanner.generated,
+        "delivered": scanner.delivered,
+        "ingest_rate": queue.enqueued / duration,
+        "dropped": queue.dropped,
+        "queue_high_water": queue.high_water,
+        "cached_beacons": len(cache.table),
+        "solve_rate": tracker.solves / duration,
+        "fixes": len(errors),
+        "cpu": cpu / duration,
+        "lag_p50_ms": float(np.percentile(lags, 50)) * 1000,
+        "lag_p99_ms": float(np.percentile(lags, 99)) * 1000,
+        "lag_max_ms": float(np.max(lags)) * 1000,
+        "rss_mb": peak_rss_mb(),
+        "rss_growth_mb": peak_rss_mb() - rss_before,
+        "error_median": float(np.median(errors)) if errors else float("nan"),
+        "error_p90": float(np.percentile(errors, 90)) if errors else float("nan"),
+        "api_ms": {path: float(np.percentile(values, 99)) * 1000 for path, values in latencies.items() if values},
+        "stream_events": received[0],
+    }
+
+
+def print_report(stats):
+    print(f"{stats['beacons']} beacons over {stats['field_m']:.0f} x {stats['field_m']:.0f} m "
+          f"for {stats['duration']:.0f} s")
+    print(f"Advertisements: {stats['generated'] / stats['duration']:.0f}/s broadcast, "
+          f"{stats['ingest_rate']:.0f}/s ingested, {stats['dropped']} dropped, "
+          f"queue high water {stats['queue_high_water']}")
+    print(f"Beacons cached: {stats['cached_beacons']}")
+    print(f"Solves: {stats['solve_rate']:.1f}/s, {stats['fixes']} new fixes")
+    print(f"CPU: {stats['cpu'] * 100:.1f}% of one core")
+    print(f"Event loop lag: p50 {stats['lag_p50_ms']:.2f} ms, p99 {stats['lag_p99_ms']:.2f} ms, "
+          f"max {stats['lag_max_ms']:.2f} ms")
+    print(f"Peak RSS: {stats['rss_mb']:.1f} MB (+{stats['rss_growth_mb']:.1f} MB during the run)")
+    print(f"Position error: median {stats['error_median']:.2f} m, p90 {stats['error_p90']:.2f} m")
+    for path, p99 in stats["api_ms"].items():
+        print(f"API {path}: p99 {p99:.2f} ms")
+    if stats["api_ms"]:
+        print(f"Stream events delivered: {stats['stream_events']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load-test the handheld with a synthetic beacon field")
+    parser.add_argument("--beacons", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds to run")
+    parser.add_argument("--engine", default="trilateration", help="position engine (see engines.py)")
+    parser.add_argument("--seed", type=int, default=546)
+    parser.add_argument("--no-api", action="store_true", help="don't exercise the web API")
+    args = parser.parse_args()
+
+    print_report(asyncio.run(simulate(args.beacons, args.duration, args.engine, args.seed, not args.no_api)))
@@ -0,0 +1,239 @@
+import math
+import numpy as np
+
+# Maximum Gauss-Newton refinement steps and the step size (meters) at which
+# we consider the estimate converged. Indoor fixes rarely need more than 3-4.
+GN_ITERATIONS = 10
+GN_TOLERANCE = 1e-4
+
+# Smallest range standard deviation (meters) used when weighting beacons.
+# Keeps a single very close beacon from dominating the solve.
+MIN_SIGMA = 0.05
+
+
+# Convert per-beacon RSSI variance (from the Kalman filter) into least-squares
+# weights on the range. Using the log-distance model, a change in RSSI of
+# dRSSI dB changes distance by d * ln(10) / (10 * n) * dRSSI, so the range
+# standard deviation grows linearly with distance.
+def range_weights(distances, rssi_variances, path_loss):
+    distances = np.asarray(distances, dtype=float)
+    rssi_variances = np.asarray(rssi_variances, dtype=float)
+    sigma = distances * (math.log(10) / (10 * np.asarray(path_loss, dtype=float))) * np.sqrt(rssi_variances)
+    sigma = np.maximum(sigma, MIN_SIGMA)
+    return 1.0 / sigma**2
+
+
+# Linearize the range equations by subtracting the first (reference) beacon.
+# For three beacons this is exactly the original closed-form 2x2 system:
+#   2(p_i - p_0) . x = d_0^2 - d_i^2 + |p_i|^2 - |p_0|^2
+# Returns None if the geometry is degenerate (e.g. collinear beacons).
+def linear_solve(points, distances, weights=None):
+    p0 = points[0]
+    A = 2 * (points[1:] - p0)
+    b = (distances[0]**2 - distances[1:]**2
+         + np.sum(points[1:]**2, axis=1) - np.sum(p0**2))
+
+    if weights is not None:
+        w = np.sqrt(weights[1:])
+        A = A * w[:, None]
+        b = b * w
+
+    if len(b) == 2:
+        try:
+            return np.linalg.solve(A, b)
+        except np.linalg.LinAlgError:
+            return None
+
+    x, _, rank, _ = np.linalg.lstsq(A, b, rcond=None)
+    if rank < 2:
+        return None
+    return x
+
+
+# Refine an estimate by minimizing sum(w_i * (|x - p_i| - d_i)^2)
+def gauss_newton(points, distances, weights, x0, iterations=GN_ITERATIONS, tol=GN_TOLERANCE):
+    x = np.array(x0, dtype=float)
+    for _ in range(iterations):
+        diff = x - points
+        ranges = np.hypot(diff[:, 0], diff[:, 1])
+        # Avoid dividing by zero if the estimate sits on top of a beacon
+        ranges = np.maximum(ranges, 1e-9)
+
+        J = diff / ranges[:, None]
+        r = ranges - distances
+
+        JtW = J.T * weights
+        try:
+            step = np.linalg.solve(JtW @ J, -(JtW @ r))
+        except np.linalg.LinAlgError:
+            break
+
+        x += step
+        if np.hypot(step[0], step[1]) < tol:
+            break
+
+    return x
+
+
+# Solve for a 2D position given N >= 3 beacons.
+# points: (N, 2) beacon coordinates in meters
+# distances: (N,) estimated ranges in meters
+# weights: optional (N,) inverse range variances
+# With exactly three beacons this degrades to the closed-form solution.
+# Returns an (x, y) ndarray, or None if the beacons cannot be solved.
+def solve_position(points, distances, weights=None):
+    points = np.asarray(points, dtype=float)
+    distances = np.asarray(distances, dtype=float)
+    if len(points) < 3:
+        return None
+
+    if len(points) == 3:
+        return linear_solve(points, distances)
+
+    if weights is None:
+        weights = np.ones(len(points))
+    else:
+        weights = np.asarray(weights, dtype=float)
+
+    x0 = linear_solve(points, distances, weights)
+    if x0 is None:
+        return None
+
+    return gauss_newton(points, distances, weights, x0)
+
+
+# Geometric dilution of precision of ranging to `points` from `position`:
+# sqrt(trace((H^T W H)^-1)), where the rows of H are unit vectors from the
+# position to each beacon. Roughly "meters of position error per meter of
+# range error" (or, with weights, the expected position error itself).
+# Nearly collinear beacons give large values; fully degenerate ones give inf.
+def gdop(points, position, weights=None):
+    points = np.asarray(points, dtype=float)
+    diff = points - np.asarray(position, dtype=float)
+    ranges = np.maximum(np.hypot(diff[:, 0], diff[:, 1]), 1e-9)
+    H = diff / ranges[:, None]
+    if weights is not None:
+        H = H * np.sqrt(np.asarray(weights, dtype=float))[:, None]
+
+    M = H.T @ H
+    det = M[0, 0] * M[1, 1] - M[0, 1] ** 2
+    if det <= 1e-12 * max(M[0, 0] + M[1, 1], 1e-12) ** 2:
+        return math.inf
+    return math.sqrt((M[0, 0] + M[1, 1]) / det)
+
+
+# Greedily pick up to `count` beacons that keep the weighted GDOP at
+# `position` lowest. points should be ordered by preference (e.g. nearest
+# first): the first point always seeds the set and ties go to earlier points.
+# Each step scores every remaining candidate at once using the closed-form
+# inverse of the 2x2 information matrix. Returns indices into points.
+def select_geometry(points, position, count, weights=None):
+    points = np.asarray(points, dtype=float)
+    n = len(points)
+    if n <= count:
+        return np.arange(n)
+
+    diff = points - np.asarray(position, dtype=float)
+    ranges = np.maximum(np.hypot(diff[:, 0], diff[:, 1]), 1e-9)
+    H = diff / ranges[:, None]
+    w = np.ones(n) if weights is None else np.asarray(weights, dtype=float)
+    # Per-beacon contribution to H^T W H: [a, b; b, d]
+    a = w * H[:, 0] ** 2
+    b = w * H[:, 0] * H[:, 1]
+    d = w * H[:, 1] ** 2
+
+    chosen = [0]
+    remaining = np.ones(n, dtype=bool)
+    remaining[0] = False
+    sum_a, sum_b, sum_d = a[0], b[0], d[0]
+
+    while len(chosen) < count:
+        ca = sum_a + a
+        cb = sum_b + b
+        cd = sum_d + d
+        det = ca * cd - cb ** 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            score = np.where(remaining & (det > 1e-12 * (ca + cd) ** 2), (ca + cd) / det, np.inf)
+
+        best = int(np.argmin(score))
+        if score[best] == np.inf:
+            # Every candidate is degenerate with the current set: take the next preferred one
+            best = int(np.argmax(remaining))
+
+        chosen.append(best)
+        remaining[best] = False
+        sum_a += a[best]
+        sum_b += b[best]
+        sum_d += d[best]
+
+    return np.array(chosen)
+
+
+# Solve many independent positions at once (e.g. every tag on a floor).
+# Each problem has up to K ranges, padded to a common K:
+#   points (T, K, 2), distances (T, K), weights (T, K) with 0 on padding
+# and at least three real ranges per problem, the first being the reference
+# for the linearized start (nearest first, as for solve_position). Every
+# step works on all T problems with the closed-form 2x2 inverse, so the cost
+# is a handful of array operations regardless of T.
+# Returns (positions (T, 2), gdop (T,)); unsolvable problems get NaN
+# positions and infinite GDOP.
+def solve_positions(points, distances, weights, iterations=GN_ITERATIONS, tol=GN_TOLERANCE):
+    points = np.asarray(points, dtype=float)
+    distances = np.asarray(distances, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    used = weights > 0
+
+    # Linearized start, weighted least squares against the reference range
+    p0 = points[:, :1]
+    A = 2 * (points[:, 1:] - p0)
+    b = (distances[:, :1] ** 2 - distances[:, 1:] ** 2
+         + np.sum(points[:, 1:] ** 2, axis=2) - np.sum(p0 ** 2, axis=2))
+    w = weights[:, 1:]
+    x = _solve_2x2(
+        np.sum(w * A[..., 0] ** 2, axis=1), np.sum(w * A[..., 0] * A[..., 1], axis=1),
+        np.sum(w * A[..., 1] ** 2, axis=1),
+        np.sum(w * A[..., 0] * b, axis=1), np.sum(w * A[..., 1] * b, axis=1))
+    # Degenerate linearizations start from the weighted centroid instead
+    centroid = np.sum(weights[..., None] * points, axis=1) / np.sum(weights, axis=1)[:, None]
+    x = np.where(np.isfinite(x), x, centroid)
+
+    # Refine every problem with Gauss-Newton until all steps are below tol
+    for _ in range(iterations):
+        diff = x[:, None, :] - points
+        ranges = np.maximum(np.hypot(diff[..., 0], diff[..., 1]), 1e-9)
+        J = diff / ranges[..., None]
+        r = np.where(used, ranges - distances, 0.0)
+        step = _solve_2x2(
+            np.sum(weights * J[..., 0] ** 2, axis=1), np.sum(weights * J[..., 0] * J[..., 1], axis=1),
+            np.sum(weights * J[..., 1] ** 2, axis=1),
+            -np.sum(weights * J[..., 0] * r, axis=1), -np.sum(weights * J[..., 1] * r, axis=1))
+        # A singular step leaves that problem where it is
+        step = np.nan_to_num(step)
+        x += step
+        if np.all(np.hypot(step[:, 0], step[:, 1]) < tol):
+            break
+
+    # Unweighted GDOP at each solution, as gdop() computes it
+    diff = points - x[:, None, :]
+    ranges = np.maximum(np.hypot(diff[..., 0], diff[..., 1]), 1e-9)
+    H = diff / ranges[..., None]
+    m = used.astype(float)
+    sa = np.sum(m * H[..., 0] ** 2, axis=1)
+    sb = np.sum(m * H[..., 0] * H[..., 1], axis=1)
+    sd = np.sum(m * H[..., 1] ** 2, axis=1)
+    det = sa * sd - sb ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dop = np.where(det > 1e-12 * np.maximum(sa + sd, 1e-12) ** 2, np.sqrt((sa + sd) / det), np.inf)
+    dop[~np.isfinite(x).all(axis=1)] = np.inf
+    return x, dop
+
+
+# Solve [a, b; b, d] x = [e, f] for arrays of 2x2 systems.
+# Singular systems give NaN.
+def _solve_2x2(a, b, d, e, f):
+    det = a * d - b ** 2
+    ok = det > 1e-12 * np.maximum(a + d, 1e-12) ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        det = np.where(ok, det, np.nan)
+        return np.column_stack(((d * e - b * f) / det, (a * f - b * e) / det))
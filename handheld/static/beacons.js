@@ -1,63 +1,50 @@
-let beaconMarkers = [];
-let beaconData = [];
+// Markers keyed by "building,floor,north,east"
+let beaconMarkers = new Map();
 
-export function initBeaconMarkers(map, url, interval) {
-    function addBeacon(lat, long) {
-        let marker = L.marker([lat, long]);
-        marker.addTo(map);
-        beaconMarkers.push(marker);
-        return marker;
-    }
+function beaconKey(beacon) {
+    return `${beacon["building_id"]},${beacon["floor"]},${beacon["loc_north"]},${beacon["loc_east"]}`;
+}
 
-    function updateBeacons() {
-        // Go through existing markers and update RSSI
-        for (let marker of beaconMarkers) {
-            // Find matching beacon in beaconData
-            let match = beaconData.find(beacon => beacon["loc_north"] === marker.getLatLng().lat && beacon["loc_east"] === marker.getLatLng().lng);
+function beaconPopup(beacon) {
+    return `RSSI: ${beacon["avg_rssi"]} dBm\r\nDistance: ${beacon["distance"]}`;
+}
 
-            // If a match is present
-            if (match) {
-                // Update the popup with new RSSI value
-                marker.bindPopup(`RSSI: ${match["avg_rssi"]} dBm\r\nDistance: ${match["distance"]}`);
-            } else { // Stale beacon, remove it
-                // Remove marker from beaconMarkers array
-                let toRemove = beaconMarkers.splice(beaconMarkers.indexOf(marker))[0];
-                // Remove the marker from the map
-                if (toRemove instanceof L.Layer) map.removeLayer(toRemove[0]);
-            }
-        }
+// Apply "beacons" delta events from the server's event stream.
+// Each event lists beacons that appeared or changed, and beacons that expired.
+export function initBeaconMarkers(map, stream) {
+    function updateBeacons(delta) {
+        for (let beacon of delta["updated"]) {
+            if (!beacon.hasOwnProperty("loc_north") || !beacon.hasOwnProperty("loc_east")) continue;
 
-        for (let beacon of beaconData) {
-            // Check if beacon is already present in beaconMarkers
-            let match = beaconMarkers.find(marker => beacon["loc_north"] === marker.getLatLng().lat && beacon["loc_east"] === marker.getLatLng().lng);
-            // Assume already updated if match is found
-            // If no match, add a new marker
-            if (!match) {
+            let key = beaconKey(beacon);
+            let marker = beaconMarkers.get(key);
+            if (marker) {
+                // Update the popup with new RSSI value
+                marker.setPopupContent(beaconPopup(beacon));
+            } else {
                 // New beacon, add it
-                if (beacon.hasOwnProperty("loc_north") && beacon.hasOwnProperty("loc_east") && beacon.hasOwnProperty("avg_rssi")) {
-                    addBeacon(beacon.loc_north, beacon.loc_east).bindPopup(`RSSI: ${beacon["avg_rssi"]} dBm`);
-                }
+                marker = L.marker([beacon.loc_north, beacon.loc_east]).bindPopup(beaconPopup(beacon));
+                marker.addTo(map);
+                beaconMarkers.set(key, marker);
             }
         }
-    }
 
-    // Build HTTP request object that we reuse
-    let beaconsHTTP = new XMLHttpRequest();
-    // Callback function for request complete
-    beaconsHTTP.onreadystatechange = () => {
-        if (beaconsHTTP.readyState === 4 && beaconsHTTP.status === 200) {
-            beaconData = JSON.parse(beaconsHTTP.responseText);
-            updateBeacons();
+        // Stale beacons, remove them
+        for (let beacon of delta["removed"]) {
+            let key = beaconKey(beacon);
+            let marker = beaconMarkers.get(key);
+            if (marker) {
+                map.removeLayer(marker);
+                beaconMarkers.delete(key);
+            }
         }
     }
 
-    // Send a request immediately
-    beaconsHTTP.open("GET", url, true);
-    beaconsHTTP.send();
+    stream.addEventListener("beacons", e => updateBeacons(JSON.parse(e.data)));
 
-    // Send a request indefinitely every 3 seconds
-    setInterval(() => {
-        beaconsHTTP.open("GET", url, true);
-        beaconsHTTP.send();
-    }, interval);
+    // The server resends a full snapshot when we reconnect, so start clean
+    stream.addEventListener("open", () => {
+        for (let marker of beaconMarkers.values()) map.removeLayer(marker);
+        beaconMarkers.clear();
+    });
 }
\ No newline at end of file
@@ -57,7 +57,11 @@ getImageDimensions("./floorplans/0001-04.png").then(dimensions => {
 });
 
 
-/***** ATTEMPT TO RETRIEVE CALCULATED POSITION *****/
+/***** SUBSCRIBE TO LIVE POSITION AND BEACON UPDATES *****/
+
+// The server pushes "position" and "beacons" events whenever they change,
+// so we no longer poll ./json and ./beacons
+const stream = new EventSource("./stream");
 
 const SHOW_POSITION = true;
 
@@ -68,26 +72,13 @@ if (SHOW_POSITION) {
     });
     let positionMarker = L.marker([0, 0], {icon: L.icon(positionIcon)}).addTo(map);
 
-    let posHTTP = new XMLHttpRequest();
-    posHTTP.onreadystatechange = () => {
-        if (posHTTP.readyState === 4 && posHTTP.status === 200) {
-            let posData = JSON.parse(posHTTP.responseText);
-            console.log(posData);
-            if (posData.hasOwnProperty("x") && posData.hasOwnProperty("y")) {
-                positionMarker.setLatLng([posData.x, posData.y]);
-            }
-            //updateBeacons();
+    stream.addEventListener("position", e => {
+        let posData = JSON.parse(e.data);
+        if (posData.hasOwnProperty("x") && posData.hasOwnProperty("y")) {
+            positionMarker.setLatLng([posData.x, posData.y]);
         }
-    }
-
-    posHTTP.open("GET", "./json", true);
-    posHTTP.send();
-
-    setInterval(() => {
-        posHTTP.open("GET", "./json", true);
-        posHTTP.send();
-    }, 1000); // Refresh beacons every 3s
+    });
 }
 
 /***** RETRIEVE LATEST BEACON POSITIONS *****/
-if (SHOW_BEACONS) initBeaconMarkers(map, "./beacons", 3000);
\ No newline at end of file
+if (SHOW_BEACONS) initBeaconMarkers(map, stream);
\ No newline at end of file
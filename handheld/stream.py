@@ -0,0 +1,98 @@
+import asyncio
+import json
+
+# Events buffered per subscriber before the oldest are dropped.
+# A slow browser tab only ever loses stale updates; it never blocks others.
+SUBSCRIBER_BUFFER = 16
+
+# Beacon values are rounded before comparing so filter jitter below this
+# resolution doesn't produce a delta
+RSSI_RESOLUTION = 1
+DISTANCE_RESOLUTION = 2
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+# Fans out position and per-beacon delta events to every /stream subscriber.
+# Each update is serialized once, no matter how many viewers are connected.
+class LiveStream:
+    def __init__(self, beacons):
+        self.beacons = beacons
+        self.subscribers = set()
+        # Last published state, used to compute deltas and to greet new subscribers
+        self.position_event = None
+        self.beacon_state = {}
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_BUFFER)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    def publish(self, event):
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    # Events that bring a new subscriber up to date
+    def snapshot(self):
+        events = []
+        if self.position_event:
+            events.append(self.position_event)
+        events.append(sse("beacons", json.dumps({"updated": list(self.beacon_state.values()), "removed": []})))
+        return events
+
+    # Called by the PositionTracker after every solve
+    def on_fix(self, fix, changed):
+        if changed:
+            self.position_event = sse("position", fix.json)
+            self.publish(self.position_event)
+
+        delta = self.beacon_delta()
+        if delta is not None:
+            self.publish(sse("beacons", json.dumps(delta)))
+
+    # Compare the cache against what we last published and return only the
+    # beacons that appeared, changed or expired (or None if nothing did)
+    def beacon_delta(self):
+        table = self.beacons.table
+        rows = table.rows()
+        current = {}
+        updated = []
+
+        for key, building_id, floor, loc_north, loc_east, avg_rssi, distance in zip(
+                [table.keys[row] for row in rows], table.building[rows].tolist(),
+                table.floor[rows].tolist(), table.north[rows].tolist(), table.east[rows].tolist(),
+                table.avg_rssi[rows].round(RSSI_RESOLUTION).tolist(),
+                table.distance[rows].round(DISTANCE_RESOLUTION).tolist()):
+            previous = self.beacon_state.get(key)
+            if previous is not None and previous["avg_rssi"] == avg_rssi and previous["distance"] == distance:
+                current[key] = previous
+                continue
+
+            entry = {
+                "loc_north": loc_north,
+                "loc_east": loc_east,
+                "building_id": building_id,
+                "floor": floor,
+                "avg_rssi": avg_rssi,
+                "distance": distance
+            }
+            current[key] = entry
+            updated.append(entry)
+
+        removed = [
+            {"loc_north": entry["loc_north"], "loc_east": entry["loc_east"],
+             "building_id": entry["building_id"], "floor": entry["floor"]}
+            for key, entry in self.beacon_state.items() if key not in current
+        ]
+
+        self.beacon_state = current
+        if not updated and not removed:
+            return None
+        return {"updated": updated, "removed": removed}
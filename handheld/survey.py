@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import json
+import os
+import numpy as np
+from fingerprint import beacon_id, compile_survey
+
+# Offline fingerprint survey.
+#
+#   python survey.py record survey.jsonl --building 1 --floor 4 --grid 0,0,20,30,1.5
+#       Walks a grid (north0,east0,north1,east1,step in meters) and records
+#       the RSSI of every beacon in range at each point. Without --grid you
+#       type each point's coordinates instead. Points are appended, so a
+#       survey can be spread over several sessions.
+#   python survey.py compile survey.jsonl fingerprints.bin
+#       Builds the binary database loaded by the fingerprint engine.
+
+# Seconds recorded at each reference point
+SURVEY_DURATION = 10.0
+# Beacons heard fewer times than this at a point are left out of its fingerprint
+MIN_SAMPLES = 3
+
+
+def grid_points(spec):
+    north0, east0, north1, east1, step = (float(v) for v in spec.split(","))
+    for north in np.arange(north0, north1 + step / 2, step):
+        for east in np.arange(east0, east1 + step / 2, step):
+            yield round(float(north), 3), round(float(east), 3)
+
+
+def typed_points():
+    while True:
+        text = input("\nPoint as 'north east' in meters (blank to finish): ").strip()
+        if not text:
+            return
+        try:
+            north, east = (float(v) for v in text.replace(",", " ").split())
+        except ValueError:
+            print("Expected two numbers")
+            continue
+        yield north, east
+
+
+# Average each beacon's samples at a point the same way TX power calibration does
+def fingerprint(samples):
+    # Imported here so `compile` works on machines without a BLE stack
+    from txandncal import smooth_rssi
+
+    return {
+        beacon_id(key): round(float(np.mean(smooth_rssi(values))), 2)
+        for key, values in samples.items()
+        if len(values) >= MIN_SAMPLES
+    }
+
+
+async def record(args):
+    from txandncal import collect_beacon_samples
+
+    points = grid_points(args.grid) if args.grid else typed_points()
+    with open(args.survey, "a") as out:
+        for north, east in points:
+            if args.grid:
+                answer = input(f"\nMove to north={north} m, east={east} m and press Enter (s to skip, q to quit): ")
+                if answer.strip().lower() == "q":
+                    break
+                if answer.strip().lower() == "s":
+                    continue
+
+            samples = await collect_beacon_samples(args.duration)
+            rssi = fingerprint(samples)
+            out.write(json.dumps({
+                "building": args.building,
+                "floor": args.floor,
+                "north": north,
+                "east": east,
+                "rssi": rssi,
+            }) + "\n")
+            out.flush()
+            print(f"Recorded {len(rssi)} beacons at ({north}, {east})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record and compile RSSI fingerprint surveys")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rec = commands.add_parser("record", help="record reference points")
+    rec.add_argument("survey", help="JSON lines file to append to")
+    rec.add_argument("--building", type=int, required=True)
+    rec.add_argument("--floor", type=int, required=True)
+    rec.add_argument("--grid", help="north0,east0,north1,east1,step in meters")
+    rec.add_argument("--duration", type=float, default=SURVEY_DURATION, help="seconds per point")
+
+    comp = commands.add_parser("compile", help="build the binary fingerprint database")
+    comp.add_argument("survey")
+    comp.add_argument("output")
+
+    args = parser.parse_args()
+    if args.command == "record":
+        asyncio.run(record(args))
+    else:
+        points, beacons = compile_survey(args.survey, args.output)
+        print(f"Wrote {points} reference points x {beacons} beacons "
+              f"({os.path.getsize(args.output)} bytes) to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import struct
+
+# Compact binary encoding of position telemetry, the alternative to JSON for
+# uploads from the handheld (Content-Type: MIMETYPE).
+#
+# This file is shared by handheld/ and cloud/, which deploy separately: keep
+# the two copies identical. bench_codec.py refuses to run if they differ.
+#
+# Little-endian. A HEADER carries the record count, the flags, and the first
+# record's time (Unix milliseconds) and position; records follow, each
+# holding its time and position as deltas from the previous record (the
+# first record's deltas are zero), plus its building and floor:
+#   HEADER        magic, version, flags, count, time ms, north, east
+#   DELTA_RECORD  time delta ms, building, floor, north delta, east delta
+# Positions are whole floorplan pixels, as the cloud stores them. Positions
+# more than 32767 px apart, or times more than about 24 days apart, don't
+# fit a delta; such messages use ABSOLUTE_RECORD for every record instead
+# (FLAG_ABSOLUTE). The device is identified by its credentials, not the body.
+MIMETYPE = "application/vnd.blepos.positions"
+MAGIC = b"BP"
+VERSION = 1
+FLAG_ABSOLUTE = 1
+HEADER = struct.Struct("<2sBBHqii")
+DELTA_RECORD = struct.Struct("<iHbhh")
+ABSOLUTE_RECORD = struct.Struct("<qHbii")
+MAX_COUNT = 0xFFFF
+
+
+# Encode telemetry records (dicts with building_id, floor, loc_north,
+# loc_east and timestamp in Unix seconds; other keys are ignored).
+# Raises ValueError if there are too many records or a value is out of range
+# or not finite.
+def encode_positions(records):
+    if not 0 < len(records) <= MAX_COUNT:
+        raise ValueError("Expected 1 to %d records, got %d" % (MAX_COUNT, len(records)))
+    try:
+        rows = [(int(round(r["timestamp"] * 1000)), r["building_id"], r["floor"],
+                 int(round(r["loc_north"])), int(round(r["loc_east"]))) for r in records]
+    except OverflowError as e:
+        # round() of an infinite value; NaN already raises ValueError
+        raise ValueError("Non-finite value in binary telemetry: %s" % e) from None
+    first = rows[0]
+
+    try:
+        parts = [HEADER.pack(MAGIC, VERSION, 0, len(rows), first[0], first[3], first[4])]
+        previous = first
+        for row in rows:
+            parts.append(DELTA_RECORD.pack(row[0] - previous[0], row[1], row[2],
+                                           row[3] - previous[3], row[4] - previous[4]))
+            previous = row
+        return b"".join(parts)
+    except struct.error:
+        pass
+
+    try:
+        parts = [HEADER.pack(MAGIC, VERSION, FLAG_ABSOLUTE, len(rows), first[0], first[3], first[4])]
+        parts.extend(ABSOLUTE_RECORD.pack(*row) for row in rows)
+        return b"".join(parts)
+    except struct.error as e:
+        raise ValueError("Position out of range for binary telemetry: %s" % e) from None
+
+
+# Decode a message into a list of dicts with building_id, floor, loc_north,
+# loc_east (pixels) and timestamp (Unix seconds).
+# Raises ValueError if the message is malformed.
+def decode_positions(data):
+    data = bytes(data)
+    if len(data) < HEADER.size:
+        raise ValueError("Binary telemetry shorter than its header")
+    magic, version, flags, count, t, north, east = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not version %d binary telemetry" % VERSION)
+
+    record = ABSOLUTE_RECORD if flags & FLAG_ABSOLUTE else DELTA_RECORD
+    if len(data) != HEADER.size + count * record.size:
+        raise ValueError("Binary telemetry length does not match its record count")
+
+    positions = []
+    body = memoryview(data)[HEADER.size:]
+    if record is ABSOLUTE_RECORD:
+        for t, building_id, floor, north, east in record.iter_unpack(body):
+            positions.append({"building_id": building_id, "floor": floor,
+                              "loc_north": north, "loc_east": east, "timestamp": t / 1000})
+    else:
+        for dt, building_id, floor, dn, de in record.iter_unpack(body):
+            t += dt
+            north += dn
+            east += de
+            positions.append({"building_id": building_id, "floor": floor,
+                              "loc_north": north, "loc_east": east, "timestamp": t / 1000})
+    return positions
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import time
+from collections import namedtuple
+from sensors import meters_to_px
+from engines import TrilaterationEngine
+import metrics
+
+# Immutable snapshot of the most recent solve.
+# position is a Position in meters (or None if we could not solve),
+# time is the monotonic solve time, seq increases with every solve that
+# produced a position, and json is the pre-serialized /json response body.
+Fix = namedtuple("Fix", ["position", "time", "seq", "json"])
+
+NO_FIX_JSON = json.dumps({"x": 0, "y": 0, "xm": 0, "ym": 0})
+NO_FIX = Fix(None, 0, 0, NO_FIX_JSON)
+
+
+def fix_json(pos):
+    x = pos.loc_north
+    y = pos.loc_east
+    if x is None: x = 0
+    if y is None: y = 0
+    return json.dumps({"x": float(meters_to_px(x)), "y": float(meters_to_px(y)), "xm": float(x), "ym": float(y)})
+
+
+# Recomputes the position in the background whenever new samples arrive,
+# at most max_rate times per second, and publishes the result as `latest`.
+# Readers (the web API, telemetry) only ever read `latest`, so they never
+# trigger a solve themselves. engine is any position engine (see engines.py).
+class PositionTracker:
+    def __init__(self, beacons, max_rate=4.0, idle_interval=1.0, engine=None):
+        self.beacons = beacons
+        self.engine = engine if engine is not None else TrilaterationEngine()
+        # Minimum time between solves
+        self.min_interval = 1.0 / max_rate
+        # Re-check for expired beacons this often even if nothing new arrives
+        self.idle_interval = idle_interval
+        self.latest = NO_FIX
+        self.solves = 0
+        # Called as listener(fix, changed) after every solve
+        self.listeners = []
+        self._dirty = asyncio.Event()
+
+    # Signal that new samples were recorded
+    def notify(self):
+        self._dirty.set()
+
+    # now is a monotonic timestamp in the samples' clock (default: now);
+    # replays pass the recorded time so solves don't depend on replay speed
+    def solve(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        started = time.perf_counter()
+        self.beacons.clear_old_sensors(now)
+        calc_pos = self.engine.solve(self.beacons, now)
+        if metrics.ENABLED:
+            metrics.SOLVE_SECONDS.observe(time.perf_counter() - started)
+        self.solves += 1
+        previous = self.latest
+
+        if calc_pos is not None:
+            self.latest = Fix(calc_pos, now, previous.seq + 1, fix_json(calc_pos))
+        elif len(self.beacons.table) == 0 and previous.position is not None:
+            # Keep serving the last good position, but drop it once every beacon expired
+            self.latest = Fix(None, now, previous.seq, NO_FIX_JSON)
+
+        for listener in self.listeners:
+            listener(self.latest, self.latest is not previous)
+        return self.latest
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._dirty.wait(), timeout=self.idle_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._dirty.clear()
+
+            self.solve()
+
+            # Rate limit: samples arriving meanwhile just set the flag again
+            await asyncio.sleep(self.min_interval)
+
+
+# Submit the latest position on a fixed schedule, independent of how often we solve.
+# submit takes a Position and must not block (e.g. it queues for TelemetryUploader).
+async def publish_telemetry(tracker, submit, interval=5.0):
+    last_seq = 0
+    while True:
+        await asyncio.sleep(interval)
+        fix = tracker.latest
+        if fix.position is None or fix.seq == last_seq:
+            continue
+        last_seq = fix.seq
+        submit(fix.position)
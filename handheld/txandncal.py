@@ -1,30 +1,22 @@
+import argparse
 import asyncio
+import json
 import math
+import time
 import numpy as np
 from bleak import BleakScanner
+from kalman import KalmanBank
+import payload as ips
+from calibration import CalibrationStore, fit_path_loss, MIN_PATH_LOSS, MAX_PATH_LOSS, ANY_BEACON
+from fingerprint import beacon_id
+from azure_iot import DEVICE_ID
 
-# ---------------- Kalman Filter ---------------- #
-class Kalman1D:
-    def __init__(self, Q=0.01, R=4.0):
-        self.Q = Q
-        self.R = R
-        self.x = None
-        self.P = 1.0
-
-    def update(self, measurement):
-        if self.x is None:
-            self.x = measurement
-            return self.x
-
-        self.P += self.Q
-        K = self.P / (self.P + self.R)
-        self.x = self.x + K * (measurement - self.x)
-        self.P = (1 - K) * self.P
-        return self.x
-
+# Profiles written here are loaded by main.py for this receiver
+CALIBRATION_STORE = "calibration.json"
 
 # ---------------- BLE RSSI Collection ---------------- #
-async def collect_rssi_samples(mac, num_samples=40, scan_time=1.0):
+# If keys is given, the position the beacon broadcasts is added to it
+async def collect_rssi_samples(mac, num_samples=40, scan_time=1.0, keys=None):
     samples = []
 
     def detection_callback(device, advertisement_data):
@@ -32,6 +24,12 @@ async def collect_rssi_samples(mac, num_samples=40, scan_time=1.0):
             if advertisement_data.rssi is not None:
                 samples.append(advertisement_data.rssi)
                 print(f"RSSI {len(samples)}: {advertisement_data.rssi} dBm")
+            if keys is not None:
+                for uuid, value in advertisement_data.service_data.items():
+                    if ips.is_indoor_positioning(uuid):
+                        key = ips.decode(value)
+                        if key is not None:
+                            keys.add(key)
 
     scanner = BleakScanner(detection_callback)
     await scanner.start()
@@ -49,19 +47,52 @@ async def collect_rssi_samples(mac, num_samples=40, scan_time=1.0):
     return samples
 
 
+# Same collection loop, but for every Indoor Positioning beacon in range at
+# once, keyed by the position it broadcasts rather than its MAC address.
+# Used by survey.py to record a fingerprint at one reference point.
+async def collect_beacon_samples(duration=10.0, scan_time=1.0):
+    samples = {}
+
+    def detection_callback(device, advertisement_data):
+        if advertisement_data.rssi is None:
+            return
+        for uuid, value in advertisement_data.service_data.items():
+            if ips.is_indoor_positioning(uuid):
+                key = ips.decode(value)
+                if key is not None:
+                    samples.setdefault(key, []).append(advertisement_data.rssi)
+
+    scanner = BleakScanner(detection_callback)
+    await scanner.start()
+
+    elapsed = 0.0
+    while elapsed < duration:
+        await asyncio.sleep(scan_time)
+        elapsed += scan_time
+        print(f"{elapsed:.0f}s: {len(samples)} beacons, {sum(len(v) for v in samples.values())} samples")
+
+    await scanner.stop()
+    return samples
+
+
+# Calibration uses a slower, more trusting filter than the live cache
+CALIBRATION_Q = 0.01
+CALIBRATION_R = 4.0
+
+
 def smooth_rssi(samples):
-    kf = Kalman1D()
-    return [kf.update(r) for r in samples]
+    kf = KalmanBank(1, q=CALIBRATION_Q, r=CALIBRATION_R)
+    return kf.update(np.zeros(len(samples), dtype=int), samples).tolist()
 
 
 # ---------------- TX Power @ 1m ---------------- #
-async def calibrate_tx_power(mac):
+async def calibrate_tx_power(mac, keys=None):
     confirm = input("\nAre you exactly 1 meter away? (y/n): ").lower()
     if confirm != 'y':
         print("❌ TX power calibration must be done at 1 meter.")
         exit()
 
-    samples = await collect_rssi_samples(mac)
+    samples = await collect_rssi_samples(mac, keys=keys)
     smoothed = smooth_rssi(samples)
     tx_power = np.mean(smoothed)
 
@@ -72,18 +103,24 @@ async def calibrate_tx_power(mac):
 
 
 # ---------------- Path Loss Exponent @ 2–5m ---------------- #
-async def calibrate_path_loss(mac, tx_power):
+# n is fitted by least squares over every smoothed sample at every distance.
+# The per-distance estimates are still returned for display.
+async def calibrate_path_loss(mac, tx_power, keys=None):
     distances = [2, 3, 4, 5]
     n_values = {}
+    all_distances = []
+    all_rssi = []
 
     print("\n📏 Path Loss Exponent Calibration\n")
 
     for d in distances:
         input(f"➡️ Move to {d} meters and press Enter...")
 
-        samples = await collect_rssi_samples(mac)
+        samples = await collect_rssi_samples(mac, keys=keys)
         smoothed = smooth_rssi(samples)
         avg_rssi = np.mean(smoothed)
+        all_distances.extend([d] * len(smoothed))
+        all_rssi.extend(smoothed)
 
         n = (tx_power - avg_rssi) / (10 * math.log10(d))
         n_values[d] = n
@@ -92,18 +129,267 @@ async def calibrate_path_loss(mac, tx_power):
         print(f"Avg RSSI: {round(avg_rssi, 2)} dBm")
         print(f"Estimated n: {round(n, 3)}\n")
 
-    n_avg = np.mean(list(n_values.values()))
-    return n_avg, n_values
+    _, n_fit, rms = fit_path_loss(all_distances, all_rssi, tx_power)
+    return n_fit, n_values, rms, len(all_rssi)
+
+
+# Store the result for this beacon and receiver. Beacons are identified by
+# the position they broadcast, which is how the positioning cache keys them;
+# a beacon that did not broadcast one becomes the receiver's default profile.
+def save_profile(path, receiver, keys, mac, tx_power, path_loss, rms, samples):
+    if not MIN_PATH_LOSS <= path_loss <= MAX_PATH_LOSS:
+        print(f"❌ Path loss exponent {round(path_loss, 3)} is implausible; profile not saved.")
+        return
+
+    if len(keys) == 1:
+        beacon = beacon_id(next(iter(keys)))
+    else:
+        if keys:
+            print(f"⚠️ {mac} broadcast {len(keys)} different positions.")
+        else:
+            print(f"⚠️ {mac} did not broadcast an Indoor Positioning payload.")
+        if input(f"Save as the default profile for receiver {receiver}? (y/n): ").lower() != 'y':
+            return
+        beacon = ANY_BEACON
+
+    store = CalibrationStore.load(path)
+    store.set(receiver, beacon, tx_power, path_loss, mac=mac, rms=round(rms, 3), samples=samples)
+    store.save()
+    print(f"💾 Saved profile for beacon {beacon} on receiver {receiver} to {path}")
+
+
+# ---------------- Scripted Calibration ---------------- #
+# Calibrates many beacons at once without prompts. The schedule is a JSON file:
+#   {
+#     "distances": [1, 2, 3, 4, 5],   meters, in the order they are visited
+#     "beacons": ["AA:BB:CC:DD:EE:FF"], MACs to calibrate; omit for every beacon
+#                                       broadcasting an Indoor Positioning payload
+#     "samples": 40,                  stop a beacon at this many samples per distance,
+#     "confidence": 0.5,              or once the standard error of its mean RSSI is
+#     "min_samples": 10,              below this many dB with at least min_samples
+#     "settle": 5,                    samples dropped per beacon at each distance
+#     "move_time": 10,                seconds allowed to walk to each distance
+#     "timeout": 60                   longest time spent collecting at one distance
+#   }
+# Every field but distances is optional.
+SCHEDULE_DEFAULTS = {
+    "beacons": None,
+    "samples": 40,
+    "confidence": 0.5,
+    "min_samples": 10,
+    "settle": 5,
+    "move_time": 10.0,
+    "timeout": 60.0,
+}
+# Without a beacon list, a distance is finished early only once every beacon
+# heard so far is done and at least this long has been spent collecting
+DISCOVERY_TIME = 5.0
+# How often the scheduler checks for a timed out distance (seconds)
+POLL_INTERVAL = 0.25
+
+
+def load_schedule(path):
+    with open(path) as f:
+        schedule = dict(SCHEDULE_DEFAULTS, **json.load(f))
+    if not schedule.get("distances"):
+        raise ValueError(f"{path}: schedule needs at least one distance")
+    return schedule
+
+
+# One shared scanner feeds per-MAC sample buffers for the current distance.
+# The schedule advances from the detection callback as soon as every beacon
+# has reached its target (or the distance times out), so a replayed capture
+# steps through it exactly as the live session did. Time is read from the
+# scanner's now() when it has one (see capture.ReplayScanner).
+class ScheduledCalibration:
+    def __init__(self, schedule, scanner_factory=BleakScanner):
+        self.schedule = schedule
+        self.scanner_factory = scanner_factory
+        self.macs = {mac.lower() for mac in schedule["beacons"]} if schedule["beacons"] else None
+        # {mac: {distance: [rssi]}} and {mac: {broadcast position}}
+        self.samples = {}
+        self.keys = {}
+        self.complete = asyncio.Event()
+
+        self._clock = time.monotonic
+        self._step = -1
+        self._distance = None
+        self._start_at = 0.0
+        self._deadline = 0.0
+        self._skip = {}
+        self._done = set()
+
+    async def run(self):
+        scanner = self.scanner_factory(self._callback)
+        self._clock = getattr(scanner, "now", time.monotonic)
+        finished = getattr(scanner, "finished", None)
+
+        await scanner.start()
+        self._advance(self._clock())
+        try:
+            while not self.complete.is_set():
+                if finished is not None and finished.is_set():
+                    print("⚠️ Capture ended before the schedule finished")
+                    break
+                try:
+                    await asyncio.wait_for(self.complete.wait(), POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                # No advertisements at all still has to end the distance
+                now = self._clock()
+                if self._distance is not None and now >= self._deadline:
+                    self._finish_step(now)
+        finally:
+            await scanner.stop()
+        return self.samples
+
+    def _advance(self, now):
+        self._step += 1
+        if self._step >= len(self.schedule["distances"]):
+            self._distance = None
+            self.complete.set()
+            return
+
+        self._distance = self.schedule["distances"][self._step]
+        self._start_at = now + self.schedule["move_time"]
+        self._deadline = self._start_at + self.schedule["timeout"]
+        self._skip = {}
+        self._done = set()
+        print(f"➡️ Move to {self._distance} m, collecting in {self.schedule['move_time']:g} s")
+
+    def _finish_step(self, now):
+        counts = [len(by_distance.get(self._distance, [])) for by_distance in self.samples.values()]
+        print(f"Distance {self._distance} m: {len(self._done)}/{len(counts)} beacons reached target, "
+              f"{sum(counts)} samples")
+        self._advance(now)
+
+    def _callback(self, device, advertisement_data):
+        mac = device.address.lower()
+        if self.macs is not None and mac not in self.macs:
+            return
+
+        key = None
+        for uuid, value in advertisement_data.service_data.items():
+            if ips.is_indoor_positioning(uuid):
+                key = ips.decode(value)
+        if key is not None:
+            self.keys.setdefault(mac, set()).add(key)
+        elif self.macs is None:
+            return
+
+        rssi = advertisement_data.rssi
+        if self._distance is None or rssi is None:
+            return
+        now = self._clock()
+        if now >= self._deadline:
+            self._finish_step(now)
+            return
+        if now < self._start_at or mac in self._done:
+            return
+
+        # Drop the first samples after a move, like collect_rssi_samples does
+        skip = self._skip.get(mac, self.schedule["settle"])
+        if skip > 0:
+            self._skip[mac] = skip - 1
+            return
+
+        buffer = self.samples.setdefault(mac, {}).setdefault(self._distance, [])
+        buffer.append(rssi)
+        if self._target_reached(buffer):
+            self._done.add(mac)
+            if self._step_complete(now):
+                self._finish_step(now)
+
+    def _target_reached(self, buffer):
+        count = len(buffer)
+        if count >= self.schedule["samples"]:
+            return True
+        if count < max(self.schedule["min_samples"], 2):
+            return False
+        return np.std(buffer, ddof=1) / math.sqrt(count) <= self.schedule["confidence"]
+
+    def _step_complete(self, now):
+        if self.macs is not None:
+            return self._done >= self.macs
+        return self._done >= set(self.samples) and now >= self._start_at + DISCOVERY_TIME
+
+    # Fit each beacon's profile from its smoothed samples. TX power is the
+    # mean at 1 m when the schedule visits 1 m, otherwise it is fitted too.
+    def fit(self):
+        results = []
+        for mac, by_distance in sorted(self.samples.items()):
+            smoothed = {d: smooth_rssi(values) for d, values in by_distance.items() if values}
+            if len(smoothed) < 2:
+                print(f"⚠️ {mac}: samples at fewer than two distances, skipped")
+                continue
+
+            distances = [d for d, values in smoothed.items() for _ in values]
+            rssi = [v for values in smoothed.values() for v in values]
+            tx_power = np.mean(smoothed[1]) if 1 in smoothed else None
+            tx_power, path_loss, rms = fit_path_loss(distances, rssi, tx_power)
+            results.append({
+                "mac": mac,
+                "keys": self.keys.get(mac, set()),
+                "tx_power": tx_power,
+                "path_loss": path_loss,
+                "rms": rms,
+                "samples": len(rssi),
+            })
+        return results
+
+
+# Store scripted results. Unlike save_profile() nothing is asked, so beacons
+# that cannot be identified by a single broadcast position are skipped.
+def save_profiles(path, receiver, results):
+    store = CalibrationStore.load(path)
+    saved = 0
+    for result in results:
+        mac = result["mac"]
+        if len(result["keys"]) != 1:
+            print(f"⚠️ {mac}: broadcast {len(result['keys'])} positions, not saved")
+            continue
+        if not MIN_PATH_LOSS <= result["path_loss"] <= MAX_PATH_LOSS:
+            print(f"⚠️ {mac}: path loss exponent {round(result['path_loss'], 3)} is implausible, not saved")
+            continue
+        store.set(receiver, beacon_id(next(iter(result["keys"]))), result["tx_power"], result["path_loss"],
+                  mac=mac, rms=round(result["rms"], 3), samples=result["samples"])
+        saved += 1
+    store.save()
+    print(f"💾 Saved {saved} profiles for receiver {receiver} to {path}")
+
+
+async def run_schedule(args):
+    schedule = load_schedule(args.schedule)
+    if args.replay:
+        from capture import replay_scanner
+        scanner_factory = replay_scanner(args.replay, args.speed)
+    else:
+        scanner_factory = BleakScanner
+
+    calibration = ScheduledCalibration(schedule, scanner_factory)
+    await calibration.run()
+    results = calibration.fit()
+
+    print("\n🎯 Calibration Results")
+    print("MAC               | TX power (dBm) |     n | RMS (dB) | samples")
+    for result in results:
+        print(f"{result['mac']:17s} | {result['tx_power']:14.2f} | {result['path_loss']:5.3f} "
+              f"| {result['rms']:8.2f} | {result['samples']:7d}")
+
+    if not args.dry_run:
+        save_profiles(args.store, args.receiver, results)
 
 
 # ---------------- Main ---------------- #
-async def main():
+async def main(store=CALIBRATION_STORE):
     print("\n📡 BLE RSSI Calibration Tool\n")
 
     mac = input("Enter BLE MAC address (AA:BB:CC:DD:EE:FF): ").strip()
+    receiver = input(f"Receiver ID [{DEVICE_ID}]: ").strip() or DEVICE_ID
 
-    tx_power = await calibrate_tx_power(mac)
-    n_avg, n_map = await calibrate_path_loss(mac, tx_power)
+    keys = set()
+    tx_power = await calibrate_tx_power(mac, keys)
+    n_fit, n_map, rms, samples = await calibrate_path_loss(mac, tx_power, keys)
 
     print("\n🎯 Final Calibration Results")
     print("---------------------------")
@@ -112,8 +398,23 @@ async def main():
     for d, n in n_map.items():
         print(f"n @ {d} m:", round(n, 3))
 
-    print("Average Path Loss Exponent n:", round(n_avg, 3))
+    print("Path Loss Exponent n (least squares):", round(n_fit, 3))
+    print("RMS residual:", round(rms, 2), "dB")
+
+    save_profile(store, receiver, keys, mac, tx_power, n_fit, rms, samples)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Calibrate beacon TX power and path loss")
+    parser.add_argument("--schedule", help="run non-interactively from a JSON distance schedule")
+    parser.add_argument("--replay", help="with --schedule, read advertisements from a capture instead of the radio")
+    parser.add_argument("--speed", type=float, default=0, help="replay speed (1 = as recorded, 0 = as fast as possible)")
+    parser.add_argument("--store", default=CALIBRATION_STORE, help="calibration profile store to update")
+    parser.add_argument("--receiver", default=DEVICE_ID, help="receiver the profiles are for")
+    parser.add_argument("--dry-run", action="store_true", help="print results without saving them")
+    args = parser.parse_args()
+
+    if args.schedule:
+        asyncio.run(run_schedule(args))
+    else:
+        asyncio.run(main(args.store))